@@ -16,44 +16,119 @@
 
 import time
 
-from . import utils
+# The activity counted, in the order kept in buckets.  The counts
+# after 'stores' are those returned by Connection.getActivityCounts.
+COUNTS = (
+    'connections',
+    'loads',
+    'stores',
+    'load_bytes',
+    'store_bytes',
+    'commits',
+    'commit_time',
+    'conflicts',
+    'cache_hits',
+    'cache_misses',
+    'pool_wait',
+    )
 
 
 class ActivityMonitor(object):
     """ZODB load/store activity monitor
 
-    This simple implementation just keeps a small log in memory
-    and iterates over the log when getActivityAnalysis() is called.
+    Activity is counted in a fixed number of time buckets, each
+    covering history_length / buckets seconds, which are reused as
+    time passes.  Recording the activity of a closed connection takes
+    constant time, and analysis takes time proportional to the number
+    of buckets, regardless of how many connections were closed.
 
-    It assumes that log entries are added in chronological sequence.
+    Buckets are updated without locking, so counts may occasionally
+    be lost when connections are closed at the same time by different
+    threads.
     """
 
-    def __init__(self, history_length=3600):
+    def __init__(self, history_length=3600, buckets=360):
         self.history_length = history_length  # Number of seconds
-        self.log = []                     # [(time, loads, stores)]
-        self.trim_lock = utils.Lock()
+        self.buckets = buckets
+        self._reset()
+
+    def _reset(self):
+        self._width = float(self.history_length) / self.buckets
+        # Each bucket is a list of the number of the bucket's time
+        # period, followed by the counts.
+        self._ring = [[None] + [0] * len(COUNTS)
+                      for i in range(self.buckets)]
+
+    def _bucket(self, now):
+        number = int(now // self._width)
+        ring = self._ring
+        i = number % self.buckets
+        bucket = ring[i]
+        if bucket[0] != number:
+            bucket = ring[i] = [number] + [0] * len(COUNTS)
+        return bucket
 
     def closedConnection(self, conn):
-        log = self.log
-        now = time.time()
         loads, stores = conn.getTransferCounts(1)
-        log.append((now, loads, stores))
-        self.trim(now)
+        try:
+            getActivityCounts = conn.getActivityCounts
+        except AttributeError:
+            counts = {}
+        else:
+            counts = getActivityCounts(True)
+        self.record(time.time(), loads, stores, **counts)
+
+    def record(self, now, loads=0, stores=0, connections=1, **counts):
+        """Add activity at the given time
+
+        Keyword arguments can be given for any of the counts returned
+        by ``getActivityAnalysis``.
+        """
+        bucket = self._bucket(now)
+        bucket[1] += connections
+        bucket[2] += loads
+        bucket[3] += stores
+        for i, name in enumerate(COUNTS[3:], 4):
+            value = counts.get(name)
+            if value:
+                bucket[i] += value
+
+    def _buckets(self, start, end):
+        # Return the buckets for periods overlapping start to end,
+        # with their start times, in time order.
+        width = self._width
+        first = int(start // width)
+        last = int(end // width)
+        result = [(bucket[0] * width, bucket) for bucket in self._ring
+                  if bucket[0] is not None and first <= bucket[0] <= last]
+        result.sort(key=lambda item: item[0])
+        return result
+
+    @property
+    def log(self):
+        """Times and load and store counts of periods with activity
+        """
+        now = time.time()
+        return [(t, bucket[2], bucket[3])
+                for t, bucket in self._buckets(now - self.history_length,
+                                               now)]
 
     def trim(self, now):
-        with self.trim_lock:
-            log = self.log
-            cutoff = now - self.history_length
-            n = 0
-            loglen = len(log)
-            while n < loglen and log[n][0] < cutoff:
-                n = n + 1
-            if n:
-                del log[:n]
+        cutoff = int((now - self.history_length) // self._width)
+        ring = self._ring
+        for i, bucket in enumerate(ring):
+            if bucket[0] is not None and bucket[0] < cutoff:
+                ring[i] = [None] + [0] * len(COUNTS)
 
     def setHistoryLength(self, history_length):
+        now = time.time()
+        old = self._buckets(now - self.history_length, now)
         self.history_length = history_length
-        self.trim(time.time())
+        self._reset()
+        cutoff = now - history_length
+        for t, bucket in old:
+            if t >= cutoff:
+                self.record(t, **dict(zip(COUNTS, bucket[1:])))
 
     def getHistoryLength(self):
         return self.history_length
@@ -66,44 +141,16 @@ class ActivityMonitor(object):
         if end == 0:
             end = now
         for n in range(divisions):
-            res.append({
-                'start': start + (end - start) * n / divisions,
-                'end': start + (end - start) * (n + 1) / divisions,
-                'loads': 0,
-                'stores': 0,
-                'connections': 0,
-                })
-
-        div = res[0]
-        div_end = div['end']
-        div_index = 0
-        connections = 0
-        total_loads = 0
-        total_stores = 0
-        for t, loads, stores in self.log:
-            if t < start:
-                # We could use a binary search to find the start.
-                continue
-            elif t > end:
-                # We could use a binary search to find the end also.
-                break
-            while t > div_end:
-                div['loads'] = total_loads
-                div['stores'] = total_stores
-                div['connections'] = connections
-                total_loads = 0
-                total_stores = 0
-                connections = 0
-                div_index = div_index + 1
-                if div_index < divisions:
-                    div = res[div_index]
-                    div_end = div['end']
-            connections = connections + 1
-            total_loads = total_loads + loads
-            total_stores = total_stores + stores
-
-        div['stores'] = div['stores'] + total_stores
-        div['loads'] = div['loads'] + total_loads
-        div['connections'] = div['connections'] + connections
+            div = dict.fromkeys(COUNTS, 0)
+            div['start'] = start + (end - start) * n / divisions
+            div['end'] = start + (end - start) * (n + 1) / divisions
+            res.append(div)
+
+        span = float(end - start) or 1.0
+        for t, bucket in self._buckets(start, end):
+            n = int((max(t, start) - start) * divisions / span)
+            div = res[min(n, divisions - 1)]
+            for name, value in zip(COUNTS, bucket[1:]):
+                div[name] += value
 
         return res
@@ -142,6 +142,24 @@ class BaseStorage(UndoLogCompatible):
             self._oid = last
             return last
 
+    def new_oids(self, count):
+        if type(self).new_oid != BaseStorage.new_oid:
+            # A subclass allocates oids its own way, so don't compute
+            # them from self._oid behind its back.
+            new_oid = self.new_oid
+            return [new_oid() for i in range(count)]
+
+        if self._is_read_only:
+            raise POSException.ReadOnlyError()
+
+        with self._lock:
+            last_as_long, = _structunpack(">Q", self._oid)
+            oids = [_structpack(">Q", last_as_long + i)
+                    for i in range(1, count + 1)]
+            if oids:
+                self._oid = oids[-1]
+            return oids
+
     # Update the maximum oid in use, under protection of a lock.  The
     # maximum-in-use attribute is changed only if possible_new_max_oid is
     # larger than its current value.
@@ -12,10 +12,13 @@
 #
 ##############################################################################
 
+import collections
 import logging
+import time
 
 import six
 import zope.interface
+from ZODB import utils
 from ZODB.POSException import ConflictError
 from ZODB.loglevels import BLATHER
 from ZODB._compat import (
@@ -232,11 +235,76 @@ def persistent_id(object):
         return None
     return object.data
 
+def _statistics(self):
+    stats = getattr(self, '_crs_stats', None)
+    if stats is None:
+        stats = self._crs_stats = dict(
+            conflicts=0, resolved=0, resolve_time=0.0,
+            cache_hits=0, cache_misses=0)
+    return stats
+
+class _RecordCache(object):
+    # Records to resolve conflicts against, shared by the threads
+    # committing to a storage, least recently used first.
+
+    def __init__(self):
+        self._lock = utils.Lock()
+        self._records = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._records)
+
+    def pop(self, key):
+        with self._lock:
+            return self._records.pop(key, None)
+
+    def add(self, key, data, size):
+        with self._lock:
+            records = self._records
+            records[key] = data
+            while len(records) > size:
+                records.popitem(False)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+_cache_lock = utils.Lock()
+def _cache(self):
+    cache = getattr(self, '_crs_cache', None)
+    if cache is None:
+        with _cache_lock:
+            cache = getattr(self, '_crs_cache', None)
+            if cache is None:
+                cache = self._crs_cache = _RecordCache()
+    return cache
+
+def _remember(self, oid, serial, data):
+    _cache(self).add((oid, serial), data,
+                     getattr(self, 'conflict_cache_size', 0))
+
+def _loadSerial(self, oid, serial):
+    # Load a record to resolve a conflict against.  Records are
+    # cached, because conflicts on frequently updated objects are
+    # resolved against the same committed revisions again and again.
+    stats = _statistics(self)
+    data = _cache(self).pop((oid, serial))
+    if data is None:
+        stats['cache_misses'] += 1
+        data = self.loadSerial(oid, serial)
+    else:
+        stats['cache_hits'] += 1
+    _remember(self, oid, serial, data)
+    return data
+
 _unresolvable = {}
 def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
                          committedData=b''):
     # class_tuple, old, committed, newstate = ('',''), 0, 0, 0
     klass = 'n/a'
+    stats = _statistics(self)
+    stats['conflicts'] += 1
+    start = time.time()
     try:
         prfactory = PersistentReferenceFactory()
         newpickle = self._crs_untransform_record_data(newpickle)
@@ -265,9 +333,11 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
             raise ConflictError
 
 
-        oldData = self.loadSerial(oid, oldSerial)
-        if not committedData:
-            committedData  = self.loadSerial(oid, committedSerial)
+        oldData = _loadSerial(self, oid, oldSerial)
+        if committedData:
+            _remember(self, oid, committedSerial, committedData)
+        else:
+            committedData = _loadSerial(self, oid, committedSerial)
 
         newstate = unpickler.load()
         old       = state(self, oid, oldSerial, prfactory, oldData)
@@ -279,7 +349,10 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
         pickler = PersistentPickler(persistent_id, file, _protocol)
         pickler.dump(meta)
         pickler.dump(resolved)
-        return self._crs_transform_record_data(file.getvalue())
+        resolved = self._crs_transform_record_data(file.getvalue())
+        stats['resolved'] += 1
+        stats['resolve_time'] += time.time() - start
+        return resolved
     except (ConflictError, BadClassName) as e:
         logger.debug(
             "Conflict resolution on %s failed with %s: %s",
@@ -293,6 +366,7 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
         logger.exception(
             "Unexpected error while trying to resolve conflict on %s", klass)
 
+    stats['resolve_time'] += time.time() - start
     raise ConflictError(oid=oid, serials=(committedSerial, oldSerial),
                         data=newpickle)
 
@@ -301,6 +375,28 @@ class ConflictResolvingStorage(object):
 
     tryToResolveConflict = tryToResolveConflict
 
+    # The number of records kept to resolve conflicts against
+    conflict_cache_size = 100
+
+    _crs_cache = _crs_stats = None
+
+    def conflictResolutionStatistics(self):
+        """Return a dictionary of conflict-resolution statistics
+
+        The statistics are the numbers of conflicts that resolution
+        was attempted for and that were resolved, the total time
+        spent resolving them, in seconds, and the numbers of records
+        resolved against that were and weren't found in the cache.
+        """
+        stats = dict(_statistics(self))
+        stats['cached'] = len(self._crs_cache or ())
+        return stats
+
+    def _crs_clear_cache(self):
+        # Cached records may have been packed away.
+        if self._crs_cache is not None:
+            self._crs_cache.clear()
+
     _crs_transform_record_data = _crs_untransform_record_data = (
         lambda self, o: o)
 
@@ -20,6 +20,7 @@ import tempfile
 import warnings
 import os
 import time
+from timeit import default_timer
 
 from persistent import PickleCache
 
@@ -50,6 +51,7 @@ from ZODB import utils
 import six
 
 from .mvccadapter import HistoricalStorageAdapter
+from .mvccadapter import _new_oids
 
 from . import valuedoc
 from . import _compat
@@ -106,6 +108,26 @@ class Connection(ExportImport, object):
 
         self._db = db
         self.large_record_size = db.large_record_size
+        self.store_batch_size = db.store_batch_size
+        self.savepoint_memory_size = db.savepoint_memory_size
+
+        # Metrics, shared by the database's connections.
+        metrics = db.metrics
+        self._load_seconds = metrics.histogram(
+            'zodb_connection_load_seconds',
+            'Time spent loading object records from the storage')
+        self._store_seconds = metrics.histogram(
+            'zodb_connection_store_seconds',
+            'Time spent storing object records in the storage')
+        self._vote_seconds = metrics.histogram(
+            'zodb_connection_tpc_vote_seconds',
+            'Time spent voting on transactions')
+        self._finish_seconds = metrics.histogram(
+            'zodb_connection_tpc_finish_seconds',
+            'Time spent finishing transactions')
+        self._cache_evictions = metrics.counter(
+            'zodb_connection_cache_evictions_total',
+            'Objects removed from connection caches by garbage collection')
 
         # historical connection
         self.before = before
@@ -136,6 +158,20 @@ class Connection(ExportImport, object):
         self._reset_counter = global_reset_counter
         self._load_count = 0   # Number of objects unghosted
         self._store_count = 0  # Number of objects stored
+        # Records and bytes written to savepoint storage, and the
+        # number of times it was spilled to a temporary file.
+        self._savepoint_counts = [0, 0, 0]
+        # Activity reported to the database's activity monitor, see
+        # getActivityCounts.
+        self._load_bytes = 0
+        self._store_bytes = 0
+        self._commit_count = 0
+        self._commit_time = 0.0
+        self._tpc_start = None
+        self._conflict_count = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._pool_wait = 0.0
 
         # Cache which can ghostify (forget the state of) objects not
         # recently used. Its API is roughly that of a dict, with
@@ -168,6 +204,10 @@ class Connection(ExportImport, object):
         # objects added as a side-effect of storing a modified object.
         self._added_during_commit = None
 
+        # During commit, if records are stored in batches, this is a
+        # list of (oid, serial, data) records not yet stored.
+        self._store_batch = None
+
         # During commit, all objects go to either _modified or _creating:
 
         # Dict of oid->flag of new objects (without serial), either
@@ -193,7 +233,7 @@ class Connection(ExportImport, object):
 
         # To support importFile(), implemented in the ExportImport base
         # class, we need to run _importDuringCommit() from our commit()
-        # method.  If _import is not None, it is a two-tuple of arguments
+        # method.  If _import is not None, it is a tuple of arguments
         # to pass to _importDuringCommit().
         self._import = None
 
@@ -235,16 +275,18 @@ class Connection(ExportImport, object):
             raise ConnectionStateError("The database connection is closed")
 
         obj = self._cache.get(oid, None)
+        if obj is None:
+            obj = self._added.get(oid, None)
+            if obj is None:
+                obj = self._pre_cache.get(oid, None)
         if obj is not None:
-            return obj
-        obj = self._added.get(oid, None)
-        if obj is not None:
-            return obj
-        obj = self._pre_cache.get(oid, None)
-        if obj is not None:
+            self._cache_hits += 1
             return obj
 
+        self._cache_misses += 1
+        start = default_timer()
         p, _ = self._storage.load(oid)
+        self._load_seconds.observe(default_timer() - start)
         obj = self._reader.getGhost(p)
 
         # Avoid infiniate loop if obj tries to load its state before
@@ -267,7 +309,15 @@ class Connection(ExportImport, object):
         """Reduce cache size to target size.
         """
         for connection in six.itervalues(self.connections):
-            connection._cache.incrgc()
+            connection._incrgc()
+
+    def _incrgc(self):
+        cache = self._cache
+        count = cache.cache_non_ghost_count
+        cache.incrgc()
+        evicted = count - cache.cache_non_ghost_count
+        if evicted > 0:
+            self._cache_evictions.inc(evicted)
 
     __onCloseCallbacks = None
     def onCloseCallback(self, f):
@@ -284,7 +334,7 @@ class Connection(ExportImport, object):
                                        "a transaction")
 
         if self._cache is not None:
-            self._cache.incrgc() # This is a good time to do some GC
+            self._incrgc() # This is a good time to do some GC
 
         # Call the close callbacks.
         if self.__onCloseCallbacks is not None:
@@ -401,6 +451,32 @@ class Connection(ExportImport, object):
             self._store_count = 0
         return res
 
+    def getSavepointCounts(self, clear=False):
+        """Returns savepoint storage counts."""
+        res = tuple(self._savepoint_counts)
+        if clear:
+            self._savepoint_counts[:] = [0, 0, 0]
+        return res
+
+    def getActivityCounts(self, clear=False):
+        """Returns counts of activity other than objects transferred."""
+        res = dict(
+            load_bytes=self._load_bytes,
+            store_bytes=self._store_bytes,
+            commits=self._commit_count,
+            commit_time=self._commit_time,
+            conflicts=self._conflict_count,
+            cache_hits=self._cache_hits,
+            cache_misses=self._cache_misses,
+            pool_wait=self._pool_wait,
+            )
+        if clear:
+            self._load_bytes = self._store_bytes = 0
+            self._commit_count = self._conflict_count = 0
+            self._cache_hits = self._cache_misses = 0
+            self._commit_time = self._pool_wait = 0.0
+        return res
+
     # Connection methods
     ##########################################################################
 
@@ -416,6 +492,7 @@ class Connection(ExportImport, object):
         # they've been unadded. This will make the code in _abort
         # confused.
         self._abort()
+        self._abortImport()
 
         if self._savepoint_storage is not None:
             self._abort_savepoint()
@@ -462,6 +539,7 @@ class Connection(ExportImport, object):
     def _tpc_cleanup(self):
         """Performs cleanup operations to support tpc_finish and tpc_abort."""
         self._conflicts.clear()
+        self._tpc_start = None
         self._needs_to_join = True
         self._registered_objects = []
         self._creating.clear()
@@ -478,32 +556,37 @@ class Connection(ExportImport, object):
         # _creating is a list of oids of new objects, which is used to
         # remove them from the cache if a transaction aborts.
         self._creating.clear()
+        self._tpc_start = default_timer()
         self._normal_storage.tpc_begin(meta_data)
 
     def commit(self, transaction):
         """Commit changes to an object"""
         transaction = transaction.data(self)
 
-        if self._savepoint_storage is not None:
+        try:
+            if self._savepoint_storage is not None:
 
-            # We first checkpoint the current changes to the savepoint
-            self.savepoint()
+                # We first checkpoint the current changes to the savepoint
+                self.savepoint()
 
-            # then commit all of the savepoint changes at once
-            self._commit_savepoint(transaction)
+                # then commit all of the savepoint changes at once
+                self._commit_savepoint(transaction)
 
-            # No need to call _commit since savepoint did.
+                # No need to call _commit since savepoint did.
 
-        else:
-            self._commit(transaction)
+            else:
+                self._commit(transaction)
 
-        for oid, serial in six.iteritems(self._readCurrent):
-            try:
-                self._storage.checkCurrentSerialInTransaction(
-                    oid, serial, transaction)
-            except ConflictError:
-                self._cache.invalidate(oid)
-                raise
+            for oid, serial in six.iteritems(self._readCurrent):
+                try:
+                    self._storage.checkCurrentSerialInTransaction(
+                        oid, serial, transaction)
+                except ConflictError:
+                    self._cache.invalidate(oid)
+                    raise
+        except ConflictError:
+            self._conflict_count += 1
+            raise
 
     def _commit(self, transaction):
         """Commit changes to an object"""
@@ -512,9 +595,10 @@ class Connection(ExportImport, object):
             raise ReadOnlyHistoryError()
 
         if self._import:
-            # We are importing an export file. We alsways do this
-            # while making a savepoint so we can copy export data
-            # directly to our storage, typically a TmpStore.
+            # We are importing an export file.  We usually do this
+            # while making a savepoint, so we copy export data
+            # directly to a TmpStore.  Deferred imports are written
+            # straight to our storage when committing.
             self._importDuringCommit(transaction, *self._import)
             self._import = None
 
@@ -526,6 +610,13 @@ class Connection(ExportImport, object):
 
         self._added_during_commit = []
 
+        # Records are pickled in batches and stored together, if the
+        # storage supports it.
+        if self.store_batch_size and hasattr(self._storage, 'storeMany'):
+            self._store_batch = []
+        else:
+            self._store_batch = None
+
         for obj in self._registered_objects:
             oid = obj._p_oid
             assert oid
@@ -550,6 +641,10 @@ class Connection(ExportImport, object):
             self._store_objects(ObjectWriter(obj), transaction)
         self._added_during_commit = None
 
+        if self._store_batch:
+            self._storage.storeMany(self._store_batch, transaction)
+        self._store_batch = None
+
     def _store_objects(self, writer, transaction):
         for obj in writer:
             oid = obj._p_oid
@@ -592,17 +687,31 @@ class Connection(ExportImport, object):
                     assert serial is not None # See _uncommitted
                     self._modified.pop() # not modified
                     continue
+                start = default_timer()
                 s = self._storage.storeBlob(oid, serial, p, blobfilename,
                                             '', transaction)
+                self._store_seconds.observe(default_timer() - start)
                 # we invalidate the object here in order to ensure
                 # that that the next attribute access of its name
                 # unghostify it, which will cause its blob data
                 # to be reattached "cleanly"
                 obj._p_invalidate()
+            elif self._store_batch is not None:
+                batch = self._store_batch
+                batch.append((oid, serial, p))
+                if len(batch) >= self.store_batch_size:
+                    start = default_timer()
+                    self._storage.storeMany(batch, transaction)
+                    self._store_seconds.observe(default_timer() - start)
+                    del batch[:]
+                s = None
             else:
+                start = default_timer()
                 s = self._storage.store(oid, serial, p, '', transaction)
+                self._store_seconds.observe(default_timer() - start)
 
             self._store_count += 1
+            self._store_bytes += len(p)
             # Put the object in the cache before handling the
             # response, just in case the response contains the
             # serial number for a newly created object
@@ -630,8 +739,7 @@ class Connection(ExportImport, object):
     def tpc_abort(self, transaction):
         transaction = transaction.data(self)
 
-        if self._import:
-            self._import = None
+        self._abortImport()
 
         if self._savepoint_storage is not None:
             self._abort_savepoint()
@@ -689,12 +797,16 @@ class Connection(ExportImport, object):
 
         transaction = transaction.data(self)
 
+        start = default_timer()
         try:
             s = vote(transaction)
-        except ReadConflictError as v:
-            if v.oid:
+        except ConflictError as v:
+            self._conflict_count += 1
+            if isinstance(v, ReadConflictError) and v.oid:
                 self._cache.invalidate(v.oid)
             raise
+        finally:
+            self._vote_seconds.observe(default_timer() - start)
         if s:
             # Resolved conflicts.
             for oid in s:
@@ -707,7 +819,9 @@ class Connection(ExportImport, object):
         """
         transaction = transaction.data(self)
 
+        start = default_timer()
         serial = self._storage.tpc_finish(transaction)
+        self._finish_seconds.observe(default_timer() - start)
         assert type(serial) is bytes, repr(serial)
         for oid_iterator in self._modified, self._creating:
             for oid in oid_iterator:
@@ -716,6 +830,9 @@ class Connection(ExportImport, object):
                 if obj is not None and obj._p_changed is not None:
                     obj._p_changed = 0
                     obj._p_serial = serial
+        if self._tpc_start is not None:
+            self._commit_time += default_timer() - self._tpc_start
+        self._commit_count += 1
         self._tpc_cleanup()
 
     def sortKey(self):
@@ -762,7 +879,7 @@ class Connection(ExportImport, object):
             self.newTransaction(transaction, False)
 
         # Now is a good time to collect some garbage.
-        self._cache.incrgc()
+        self._incrgc()
 
     # Transaction-manager synchronization -- ISynchronizer
     ##########################################################################
@@ -793,9 +910,16 @@ class Connection(ExportImport, object):
                 raise
 
         try:
-            p, serial = self._storage.load(oid)
+            preloaded = self._preloaded
+            if preloaded is not None and oid in preloaded:
+                p, serial = preloaded.pop(oid)
+            else:
+                start = default_timer()
+                p, serial = self._storage.load(oid)
+                self._load_seconds.observe(default_timer() - start)
 
             self._load_count += 1
+            self._load_bytes += len(p)
 
             self._reader.setGhostState(obj, p)
             obj._p_serial = serial
@@ -808,12 +932,45 @@ class Connection(ExportImport, object):
                 obj._p_blob_committed = self._storage.loadBlob(oid, serial)
 
         except ConflictError:
+            self._conflict_count += 1
             raise
         except:
             self._log.exception("Couldn't load state for %s %s",
                                 className(obj), oid_repr(oid))
             raise
 
+    # Records loaded by setstateMany() for setstate() to consume.
+    _preloaded = None
+
+    def setstateMany(self, objects):
+        """Load the state of many ghost objects at once
+
+        The records for all of the ghosts among the given objects are
+        loaded with a single call to the storage's ``loadMany`` method,
+        if it has one, which is typically much faster than loading
+        them one at a time.  Objects that aren't ghosts are ignored.
+        """
+        if self.opened is None:
+            raise ConnectionStateError("The database connection is closed")
+
+        ghosts = [obj for obj in objects
+                  if obj._p_jar is self and obj._p_changed is None]
+        if not ghosts:
+            return
+
+        try:
+            loadMany = self._storage.loadMany
+        except AttributeError:
+            pass
+        else:
+            self._preloaded = loadMany([obj._p_oid for obj in ghosts])
+
+        try:
+            for obj in ghosts:
+                obj._p_activate()
+        finally:
+            self._preloaded = None
+
     def register(self, obj):
         """Register obj with the current transaction manager.
 
@@ -925,7 +1082,7 @@ class Connection(ExportImport, object):
         transaction_manager.registerSynch(self)
 
         if self._cache is not None:
-            self._cache.incrgc() # This is a good time to do some GC
+            self._incrgc() # This is a good time to do some GC
 
         if delegate:
             # delegate open to secondary connections
@@ -992,7 +1149,9 @@ class Connection(ExportImport, object):
 
     def savepoint(self):
         if self._savepoint_storage is None:
-            tmpstore = TmpStore(self._normal_storage)
+            tmpstore = TmpStore(self._normal_storage,
+                                self.savepoint_memory_size,
+                                self._savepoint_counts)
             self._savepoint_storage = tmpstore
             self._storage = self._savepoint_storage
 
@@ -1034,7 +1193,8 @@ class Connection(ExportImport, object):
         self._savepoint_storage = None
         try:
             self._log.debug("Committing savepoints of size %s", src.getSize())
-            oids = sorted(src.index.keys())
+            # Read the records in the order they were written.
+            oids = sorted(src.index, key=src.index.__getitem__)
 
             # Copy invalidating and creating info from temporary storage:
             self._modified.extend(oids)
@@ -1132,10 +1292,17 @@ class Savepoint(object):
 
 @implementer(IBlobStorage)
 class TmpStore(object):
-    """A storage-like thing to support savepoints."""
+    """A storage-like thing to support savepoints.
+
+    Records are kept in memory until more than memory_size bytes have
+    been written, and then in a temporary file, after which
+    memory_size is 0.  If counts is given,
+    it's a list to which the numbers of records and bytes written and
+    of spills to a temporary file are added.
+    """
 
 
-    def __init__(self, storage):
+    def __init__(self, storage, memory_size=0, counts=None):
         self._storage = storage
         for method in (
             'getName', 'new_oid', 'getSize', 'sortKey',
@@ -1143,7 +1310,12 @@ class TmpStore(object):
             ):
             setattr(self, method, getattr(storage, method))
 
-        self._file = tempfile.TemporaryFile(prefix='TmpStore')
+        self.memory_size = memory_size
+        if memory_size:
+            self._file = _compat.BytesIO()
+        else:
+            self._file = tempfile.TemporaryFile(prefix='TmpStore')
+        self.counts = [0, 0, 0] if counts is None else counts
         # position: current file position
         # _tpos: file position at last commit point
         self.position = 0
@@ -1156,42 +1328,89 @@ class TmpStore(object):
     def __len__(self):
         return len(self.index)
 
+    def new_oids(self, count):
+        return _new_oids(self._storage, count)
+
     def close(self):
         self._file.close()
         if self._blob_dir is not None:
             remove_committed_dir(self._blob_dir)
             self._blob_dir = None
 
+    def new_oids(self, count):
+        return _new_oids(self._storage, count)
+
     def load(self, oid, version=''):
         pos = self.index.get(oid)
         if pos is None:
             return self._storage.load(oid)
+        return self._read(pos, oid)
+
+    def loadMany(self, oids):
+        """Return a dictionary mapping oids to pickle data and serials.
+
+        Records in temporary storage are read in the order they were
+        written.
+        """
+        result = {}
+        index = self.index
+        missing = []
+        written = []
+        for oid in oids:
+            pos = index.get(oid)
+            if pos is None:
+                missing.append(oid)
+            else:
+                written.append((pos, oid))
+        for pos, oid in sorted(written):
+            result[oid] = self._read(pos, oid)
+        if missing:
+            try:
+                loadMany = self._storage.loadMany
+            except AttributeError:
+                for oid in missing:
+                    result[oid] = self._storage.load(oid)
+            else:
+                result.update(loadMany(missing))
+        return result
+
+    def _read(self, pos, oid):
         self._file.seek(pos)
-        h = self._file.read(8)
-        oidlen = u64(h)
-        read_oid = self._file.read(oidlen)
-        if read_oid != oid:
+        h = self._file.read(len(oid) + 24)
+        if u64(h[:8]) != len(oid) or h[8:-16] != oid:
             raise POSException.StorageSystemError('Bad temporary storage')
-        h = self._file.read(16)
-        size = u64(h[8:])
-        serial = h[:8]
-        return self._file.read(size), serial
+        serial = h[-16:-8]
+        return self._file.read(u64(h[-8:])), serial
 
     def store(self, oid, serial, data, version, transaction):
         # we have this funny signature so we can reuse the normal non-commit
         # commit logic
         assert version == ''
-        self._file.seek(self.position)
         l = len(data)
         if serial is None:
             serial = z64
         header = p64(len(oid)) + oid + serial + p64(l)
+        end = self.position + l + len(header)
+        if self.memory_size and end > self.memory_size:
+            self._spill()
+        self._file.seek(self.position)
         self._file.write(header)
         self._file.write(data)
         self.index[oid] = self.position
-        self.position += l + len(header)
+        self.position = end
+        counts = self.counts
+        counts[0] += 1
+        counts[1] += l + len(header)
         return serial
 
+    def _spill(self):
+        # Move the records kept in memory to a temporary file.
+        self.memory_size = 0
+        f = tempfile.TemporaryFile(prefix='TmpStore')
+        f.write(self._file.getvalue()[:self.position])
+        self._file = f
+        self.counts[2] += 1
+
     def storeBlob(self, oid, serial, data, blobfilename, version,
                   transaction):
         assert version == ''
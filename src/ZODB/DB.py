@@ -18,6 +18,7 @@ import sys
 import logging
 import datetime
 import time
+from timeit import default_timer
 import warnings
 
 from . import utils
@@ -25,6 +26,7 @@ from . import utils
 from ZODB.broken import find_global
 from ZODB.utils import z64
 from ZODB.Connection import Connection, TransactionMetaData
+from ZODB.metrics import Registry
 from ZODB._compat import Pickler, _protocol, BytesIO
 import ZODB.serialize
 
@@ -377,6 +379,9 @@ class DB(object):
                  databases=None,
                  xrefs=True,
                  large_record_size=1<<24,
+                 shared_cache_size_bytes=0,
+                 store_batch_size=0,
+                 savepoint_memory_size=1<<20,
                  **storage_args):
         """Create an object database.
 
@@ -424,6 +429,19 @@ class DB(object):
         :param int large_record_size: When object records are saved
              that are larger than this, a warning is issued,
              suggesting that blobs should be used instead.
+        :param int shared_cache_size_bytes: If non-zero, the size of
+             a record cache shared by all of the database's
+             connections.  Records loaded by one connection can then
+             be used by others without being read from the storage
+             again.
+        :param int store_batch_size: If non-zero, the maximum number
+             of object records that connections pass to their
+             storage's ``storeMany`` method at once when committing.
+             By default, records are stored one at a time.
+        :param int savepoint_memory_size: The number of bytes of
+             savepoint data that connections keep in memory before
+             writing savepoint data to a temporary file.  If 0,
+             savepoint data are always written to a temporary file.
         :param storage_args: Extra keywork arguments passed to a
              storage constructor if a path name or None is passed as
              the storage argument.
@@ -451,14 +469,17 @@ class DB(object):
         else:
             assert not storage_args
 
-        self.storage = storage
-
         if IMVCCStorage.providedBy(storage):
             self._mvcc_storage = storage
         else:
+            if shared_cache_size_bytes:
+                from .sharedcache import SharedCacheStorage
+                storage = SharedCacheStorage(storage, shared_cache_size_bytes)
             from .mvccadapter import MVCCAdapter
             self._mvcc_storage = MVCCAdapter(storage)
 
+        self.storage = storage
+
         self.references = ZODB.serialize.referencesf
 
         if (not hasattr(storage, 'tpc_vote')) and not storage.isReadOnly():
@@ -481,6 +502,17 @@ class DB(object):
         self.xrefs = xrefs
 
         self.large_record_size = large_record_size
+        self.store_batch_size = store_batch_size
+        self.savepoint_memory_size = savepoint_memory_size
+
+        # Metrics of the database, its connections and its storage.
+        self.metrics = Registry(database=database_name)
+        storage_metrics = getattr(storage, 'metrics', None)
+        if isinstance(storage_metrics, Registry):
+            self.metrics.include(storage_metrics)
+        self._pool_wait_seconds = self.metrics.histogram(
+            'zodb_pool_checkout_wait_seconds',
+            'Time spent waiting to check a connection out of the pool')
 
         # Make sure we have a root:
         with self.transaction(u'initial database creation') as conn:
@@ -633,6 +665,20 @@ class DB(object):
         return sorted(
             m, key=lambda x: (x['connection'], x['ngsize'], x['size']))
 
+    def sharedCacheStatistics(self):
+        """Return statistics for the shared record cache
+
+        A dictionary is returned with the numbers of cache hits,
+        misses and evictions, and the number of records and bytes in
+        the cache.  None is returned if the database doesn't have a
+        shared cache.
+        """
+        try:
+            cache = self.storage.shared_cache
+        except AttributeError:
+            return None
+        return cache.statistics()
+
     def close(self):
         """Close the database and its underlying storage.
 
@@ -758,7 +804,13 @@ class DB(object):
                 DeprecationWarning, 2)
             transaction_manager = None
 
-        with self._lock:
+        waited = 0.0
+        if not self._lock.acquire(False):
+            # Only time the wait for the pool when there is one.
+            start = default_timer()
+            self._lock.acquire()
+            waited = default_timer() - start
+        try:
             # result <- a connection
             if before is not None:
                 result = self.historical_pool.pop(before)
@@ -786,8 +838,11 @@ class DB(object):
             # (note we already have the lock)
             self.pool.availableGC()
             self.historical_pool.availableGC()
+        finally:
+            self._lock.release()
 
-
+        result._pool_wait += waited
+        self._pool_wait_seconds.observe(waited)
         result.open(transaction_manager)
         return result
 
@@ -311,22 +311,25 @@ class DemoStorage(ConflictResolvingStorage):
                 self._next_oid = random.randint(1, 1<<62)
 
     def pack(self, t, referencesf, gc=None):
-        if gc is None:
-            if self._temporary_changes:
-                return self.changes.pack(t, referencesf)
-        elif self._temporary_changes:
-            return self.changes.pack(t, referencesf, gc=gc)
-        elif gc:
-            raise TypeError(
-                "Garbage collection isn't supported"
-                " when there is a base storage.")
-
         try:
-            self.changes.pack(t, referencesf, gc=False)
-        except TypeError as v:
-            if 'gc' in str(v):
-                pass # The gc arg isn't supported. Don't pack
-            raise
+            if gc is None:
+                if self._temporary_changes:
+                    return self.changes.pack(t, referencesf)
+            elif self._temporary_changes:
+                return self.changes.pack(t, referencesf, gc=gc)
+            elif gc:
+                raise TypeError(
+                    "Garbage collection isn't supported"
+                    " when there is a base storage.")
+
+            try:
+                self.changes.pack(t, referencesf, gc=False)
+            except TypeError as v:
+                if 'gc' in str(v):
+                    pass # The gc arg isn't supported. Don't pack
+                raise
+        finally:
+            self._crs_clear_cache()
 
     def pop(self):
         """Close the changes database and return the base.
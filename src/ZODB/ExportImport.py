@@ -13,84 +13,181 @@
 ##############################################################################
 """Support for database export and import."""
 
+import collections
+import functools
 import logging
 import os
+import zlib
 from tempfile import TemporaryFile
 
 import six
 
 from ZODB.blob import Blob
+from ZODB.fsIndex import fsIndex
 from ZODB.interfaces import IBlobStorage
+from ZODB.mvccadapter import _new_oids
 from ZODB.POSException import ExportError
 from ZODB.serialize import referencesf
-from ZODB.utils import p64, u64, cp, mktemp
-from ZODB._compat import PersistentPickler, Unpickler, BytesIO, _protocol
+from ZODB.utils import p64, u64, fastcp, mktemp
+from ZODB._compat import PersistentPickler, PersistentUnpickler, Unpickler
+from ZODB._compat import BytesIO, _protocol
 
 
 logger = logging.getLogger('ZODB.ExportImport')
 
 class ExportImport(object):
 
-    def exportFile(self, oid, f=None):
+    def exportFile(self, oid, f=None, compress=False, progress=None,
+                   batch_size=100):
+        """Export an object and the objects reachable from it
+
+        The records are written to f, which may be a file name or an
+        open file.  If f isn't given, a temporary file is used.  The
+        file is returned.
+
+        Objects are visited breadth first.  Their records are loaded
+        in batches of batch_size, using the storage's ``loadMany``
+        method, if it has one.  If compress is true, the export is
+        compressed with zlib.  If progress is given, it's called after
+        each batch with the number of objects and the number of bytes
+        of object records exported so far.
+        """
         if f is None:
             f = TemporaryFile(prefix="EXP")
         elif isinstance(f, six.string_types):
             f = open(f,'w+b')
-        f.write(b'ZEXP')
-        oids = [oid]
-        done_oids = {}
-        done = done_oids.__contains__
-        load = self._storage.load
+        if compress:
+            f.write(compressed_export_magic)
+            out = CompressingWriter(f)
+        else:
+            f.write(b'ZEXP')
+            out = f
+        oids = collections.deque([oid])
+        done = fsIndex()
         supports_blobs = IBlobStorage.providedBy(self._storage)
+        count = size = 0
         while oids:
-            oid = oids.pop(0)
-            if oid in done_oids:
-                continue
-            done_oids[oid] = True
-            try:
-                p, serial = load(oid)
-            except:
-                logger.debug("broken reference for oid %s", repr(oid),
-                             exc_info=True)
-            else:
-                referencesf(p, oids)
-                f.writelines([oid, p64(len(p)), p])
+            batch = []
+            while oids and len(batch) < batch_size:
+                oid = oids.popleft()
+                if oid not in done:
+                    done[oid] = 0
+                    batch.append(oid)
+
+            for oid, p, serial in self._loadForExport(batch):
+                for ref in referencesf(p):
+                    if ref not in done:
+                        oids.append(ref)
+                out.writelines([oid, p64(len(p)), p])
+                count += 1
+                size += len(p)
 
                 if supports_blobs:
                     if not isinstance(self._reader.getGhost(p), Blob):
                         continue # not a blob
 
                     blobfilename = self._storage.loadBlob(oid, serial)
-                    f.write(blob_begin_marker)
-                    f.write(p64(os.stat(blobfilename).st_size))
-                    blobdata = open(blobfilename, "rb")
-                    cp(blobdata, f)
-                    blobdata.close()
-
-        f.write(export_end_marker)
+                    with open(blobfilename, "rb") as blobdata:
+                        # The open file is written even if packing
+                        # removes it.
+                        out.write(blob_begin_marker)
+                        out.write(p64(os.fstat(blobdata.fileno()).st_size))
+                        fastcp(blobdata, out)
+
+            if progress is not None:
+                progress(count, size)
+
+        out.write(export_end_marker)
+        if compress:
+            out.flush()
         return f
 
-    def importFile(self, f, clue='', customImporters=None):
+    def _loadForExport(self, oids):
+        # Return (oid, data, serial) for each of the given objects
+        # that can be loaded, in order.
+        try:
+            loadMany = self._storage.loadMany
+        except AttributeError:
+            pass
+        else:
+            try:
+                loaded = loadMany(oids)
+            except Exception:
+                # Some of the references are broken.  Load the records
+                # one at a time to find out which.
+                pass
+            else:
+                return [(oid, ) + tuple(loaded[oid]) for oid in oids]
+
+        result = []
+        load = self._storage.load
+        for oid in oids:
+            try:
+                p, serial = load(oid)
+            except:
+                logger.debug("broken reference for oid %s", repr(oid),
+                             exc_info=True)
+            else:
+                result.append((oid, p, serial))
+        return result
+
+    def importFile(self, f, clue='', customImporters=None, defer=False):
+        """Import objects exported with exportFile
+
+        f may be a file name or an open file.  The imported objects
+        are added to the current transaction.
+
+        Normally, the export is read right away, into the savepoint
+        storage of the transaction, and the imported root object is
+        returned.  If defer is true, the export is read when the
+        transaction is committed and its records are written straight
+        to the storage, rather than being copied from the savepoint
+        storage.  The imported objects can't be used until then, so
+        the object id of the imported root is returned instead.  An
+        open file must be left open until the transaction is
+        committed or aborted.  A file opened given its name is closed
+        then.
+        """
         # This is tricky, because we need to work in a transaction!
 
         if isinstance(f, six.string_types):
+            if defer:
+                return self._importFile(open(f, 'rb'), clue,
+                                        customImporters, defer, True)
             with open(f, 'rb') as fp:
                 return self.importFile(fp, clue=clue,
                                        customImporters=customImporters)
 
+        return self._importFile(f, clue, customImporters, defer, False)
+
+    def _importFile(self, f, clue, customImporters, defer, close):
+        opened = f if close else None
         magic = f.read(4)
-        if magic != b'ZEXP':
-            if customImporters and magic in customImporters:
-                f.seek(0)
-                return customImporters[magic](self, f, clue)
-            raise ExportError("Invalid export header")
+        if magic == compressed_export_magic:
+            f = DecompressingReader(f)
+        elif magic != b'ZEXP':
+            try:
+                if customImporters and magic in customImporters:
+                    f.seek(0)
+                    return customImporters[magic](self, f, clue)
+                raise ExportError("Invalid export header")
+            finally:
+                if close:
+                    f.close()
 
         t = self.transaction_manager.get()
         if clue:
             t.note(clue)
 
+        if defer:
+            # The root's oid is allocated now, so it can be returned.
+            return_oid_list = [self.new_oid()]
+            self._import = f, return_oid_list, opened
+            self._register()
+            return return_oid_list[0]
+
         return_oid_list = []
-        self._import = f, return_oid_list
+        self._import = f, return_oid_list, None
         self._register()
         t.savepoint(optimistic=True)
         # Return the root imported object.
@@ -99,14 +196,39 @@ class ExportImport(object):
         else:
             return None
 
-    def _importDuringCommit(self, transaction, f, return_oid_list):
+    def _importDuringCommit(self, transaction, f, return_oid_list,
+                            opened=None):
         """Import data during two-phase commit.
 
         Invoked by the transaction manager mid commit.
         Appends one item, the OID of the first object created,
-        to return_oid_list.
+        to return_oid_list, unless it already contains the oid to
+        use for the first object.  If opened is given, it's the file
+        opened by importFile, which is closed afterwards.
         """
+        try:
+            self._importRecords(transaction, f, return_oid_list)
+        finally:
+            if opened is not None:
+                opened.close()
+
+    def _abortImport(self):
+        """Forget an import that wasn't done, when a transaction aborts
+        """
+        if self._import:
+            opened = self._import[2]
+            self._import = None
+            if opened is not None:
+                opened.close()
+
+    def _importRecords(self, transaction, f, return_oid_list):
         oids = {}
+        new_oid = functools.partial(next, _allocate_oids(self._storage))
+        store_batch_size = self.store_batch_size
+        if store_batch_size and hasattr(self._storage, 'storeMany'):
+            batch = []
+        else:
+            batch = None
 
         # IMPORTANT: This code should be consistent with the code in
         # serialize.py. It is currently out of date and doesn't handle
@@ -128,17 +250,15 @@ class ExportImport(object):
                 oid = oids[ooid]
             else:
                 if klass is None:
-                    oid = self._storage.new_oid()
+                    oid = new_oid()
                 else:
-                    oid = self._storage.new_oid(), klass
+                    oid = new_oid(), klass
                 oids[ooid] = oid
 
             return Ghost(oid)
 
-        while 1:
-            header = f.read(16)
-            if header == export_end_marker:
-                break
+        header = f.read(16)
+        while header != export_end_marker:
             if len(header) != 16:
                 raise ExportError("Truncated export file")
 
@@ -154,44 +274,130 @@ class ExportImport(object):
                 oid = oids[ooid]
                 if isinstance(oid, tuple):
                     oid = oid[0]
+            elif return_oid_list:
+                oids[ooid] = oid = return_oid_list[0]
             else:
-                oids[ooid] = oid = self._storage.new_oid()
+                oids[ooid] = oid = new_oid()
                 return_oid_list.append(oid)
 
-            # Blob support
-            blob_begin = f.read(len(blob_begin_marker))
-            if blob_begin == blob_begin_marker:
+            # Blob support.  The record is followed by either blob
+            # data or the next header, so we read a header's worth
+            # rather than seeking back, which compressed exports
+            # can't do.
+            header = f.read(16)
+            if header[:len(blob_begin_marker)] == blob_begin_marker:
                 # Copy the blob data to a temporary file
                 # and remember the name
-                blob_len = u64(f.read(8))
+                blob_len = header[len(blob_begin_marker):]
+                blob_len = u64(blob_len + f.read(8 - len(blob_len)))
                 blob_filename = mktemp()
                 blob_file = open(blob_filename, "wb")
-                cp(f, blob_file, blob_len)
+                fastcp(f, blob_file, blob_len)
                 blob_file.close()
+                header = f.read(16)
             else:
-                f.seek(-len(blob_begin_marker),1)
                 blob_filename = None
 
-            pfile = BytesIO(data)
-            unpickler = Unpickler(pfile)
-            unpickler.persistent_load = persistent_load
+            refs = []
+            unpickler = PersistentUnpickler(None, refs.append, BytesIO(data))
+            unpickler.noload()
+            unpickler.noload()
+            if refs:
+                # The references have to be remapped.  Records
+                # without references are stored as they are.
+                pfile = BytesIO(data)
+                unpickler = Unpickler(pfile)
+                unpickler.persistent_load = persistent_load
 
-            newp = BytesIO()
-            pickler = PersistentPickler(persistent_id, newp, _protocol)
+                newp = BytesIO()
+                pickler = PersistentPickler(persistent_id, newp, _protocol)
 
-            pickler.dump(unpickler.load())
-            pickler.dump(unpickler.load())
-            data = newp.getvalue()
+                pickler.dump(unpickler.load())
+                pickler.dump(unpickler.load())
+                data = newp.getvalue()
 
             if blob_filename is not None:
                 self._storage.storeBlob(oid, None, data, blob_filename,
                                         '', transaction)
+            elif batch is not None:
+                batch.append((oid, None, data))
+                if len(batch) >= store_batch_size:
+                    self._storage.storeMany(batch, transaction)
+                    batch = []
             else:
                 self._storage.store(oid, None, data, '', transaction)
 
+        if batch:
+            self._storage.storeMany(batch, transaction)
+
+
+def _allocate_oids(storage, size=16, largest=256):
+    """Generate new oids, allocated from a storage in growing blocks
+
+    The number of records in an export file isn't known up front, so
+    the oids left over from the last block are lost; the block size is
+    kept small to bound that waste.
+    """
+    while True:
+        for oid in _new_oids(storage, size):
+            yield oid
+        size = min(size * 2, largest)
 
 export_end_marker = b'\377'*16
 blob_begin_marker = b'\000BLOBSTART'
+compressed_export_magic = b'ZEXZ'
+
+class CompressingWriter(object):
+    """Write data to a file, compressed with zlib"""
+
+    def __init__(self, f):
+        self._file = f
+        self._compressor = zlib.compressobj()
+
+    def write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def flush(self):
+        self._file.write(self._compressor.flush())
+
+class DecompressingReader(object):
+    """Read data from a file compressed with zlib"""
+
+    # The maximum amount of data read or decompressed at once.
+    chunk_size = 1 << 16
+
+    def __init__(self, f):
+        self._file = f
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._pos = 0
+
+    def read(self, size):
+        buffer = self._buffer
+        pos = self._pos
+        if len(buffer) - pos < size:
+            chunks = [buffer[pos:]]
+            have = len(chunks[0])
+            decompressor = self._decompressor
+            while have < size:
+                data = decompressor.unconsumed_tail
+                if not data:
+                    data = self._file.read(self.chunk_size)
+                    if not data:
+                        chunks.append(decompressor.flush())
+                        break
+                data = decompressor.decompress(data, self.chunk_size)
+                chunks.append(data)
+                have += len(data)
+            buffer = b''.join(chunks)
+            pos = 0
+        self._buffer = buffer
+        self._pos = pos + size
+        return buffer[pos:pos + size]
 
 class Ghost(object):
     __slots__ = ("oid",)
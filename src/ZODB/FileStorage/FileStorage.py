@@ -16,16 +16,26 @@
 from __future__ import print_function
 
 import binascii
+import bisect
+import collections
 import contextlib
 import errno
+import itertools
 import logging
+import mmap
+import multiprocessing
 import os
+import shutil
+import threading
 import time
+import zlib
 from struct import pack
 from struct import unpack
+from timeit import default_timer
 
 from persistent.TimeStamp import TimeStamp
 from six import string_types as STRING_TYPES
+from six.moves import queue
 from zc.lockfile import LockFile
 from zope.interface import alsoProvides
 from zope.interface import implementer
@@ -34,6 +44,7 @@ from .. import utils
 
 from ZODB.blob import BlobStorageMixin
 from ZODB.blob import link_or_copy
+from ZODB.blob import MANIFEST
 from ZODB.blob import remove_committed
 from ZODB.blob import remove_committed_dir
 from ZODB.BaseStorage import BaseStorage
@@ -49,9 +60,14 @@ from ZODB.FileStorage.format import FileStorageFormatter
 from ZODB.FileStorage.format import TRANS_HDR
 from ZODB.FileStorage.format import TRANS_HDR_LEN
 from ZODB.FileStorage.format import TxnHeader
+from ZODB.metrics import Registry
 from ZODB.FileStorage.fspack import FileStoragePacker
+from ZODB.interfaces import IBlobRecordPacking
 from ZODB.interfaces import IBlobStorageRestoreable
 from ZODB.interfaces import IExternalGC
+from ZODB.interfaces import IMultiLoadStorage
+from ZODB.interfaces import IMultiOidStorage
+from ZODB.interfaces import IMultiStoreStorage
 from ZODB.interfaces import IStorage
 from ZODB.interfaces import IStorageCurrentRecordIteration
 from ZODB.interfaces import IStorageIteration
@@ -65,10 +81,12 @@ from ZODB.POSException import StorageError
 from ZODB.POSException import StorageSystemError
 from ZODB.POSException import StorageTransactionError
 from ZODB.POSException import UndoError
+from ZODB.fsIndex import fsArrayIndex
 from ZODB.fsIndex import fsIndex
 from ZODB.utils import as_bytes
 from ZODB.utils import as_text
 from ZODB.utils import cp
+from ZODB.utils import fastcp
 from ZODB.utils import load_current
 from ZODB.utils import mktemp
 from ZODB.utils import p64
@@ -133,6 +151,9 @@ class TempFormatter(FileStorageFormatter):
         IStorageUndoable,
         IStorageCurrentRecordIteration,
         IExternalGC,
+        IMultiLoadStorage,
+        IMultiOidStorage,
+        IMultiStoreStorage,
         )
 class FileStorage(
     FileStorageFormatter,
@@ -145,10 +166,18 @@ class FileStorage(
 
     # Set True while a pack is in progress; undo is blocked for the duration.
     _pack_is_in_progress = False
+    _pack_processes = 0
+    _pack_timings = None
 
     def __init__(self, file_name, create=False, read_only=False, stop=None,
                  quota=None, pack_gc=True, pack_keep_old=True, packer=None,
-                 blob_dir=None):
+                 blob_dir=None, prefetch_cache_size=0, prefetch_threads=2,
+                 mmap_reads=False, group_commit=False, group_commit_delay=0,
+                 group_commit_size=100, array_index=False,
+                 index_rebuild_processes=0, index_checkpoint_interval=0,
+                 pack_processes=0, tid_cache_size=100000,
+                 tid_index_interval=100, revision_index_size=0,
+                 blob_layout='automatic', blob_fsync=True):
         """Create a file storage
 
         :param str file_name: Path to store data file
@@ -171,6 +200,76 @@ class FileStorage(
            :interface:`packer <ZODB.FileStorage.interfaces.IFileStoragePacker>`.
         :param str blob_dir: A blob-directory path name.
            Blobs will be supported if this option is provided.
+        :param int prefetch_cache_size: The maximum number of records
+           read ahead by :meth:`prefetch` that are kept until they're
+           loaded.  By default, prefetching is disabled.
+        :param int prefetch_threads: The number of background threads
+           used to read records requested by :meth:`prefetch`.
+        :param bool mmap_reads: Flag indicating whether object records
+           should be read from a read-only memory map of the data
+           file, rather than from pooled file objects.  This avoids
+           contention for the file pool and the system calls needed
+           to seek and read.  The map is extended as the file grows.
+        :param bool group_commit: Flag indicating whether the data of
+           transactions committed concurrently should be made durable
+           with a single ``fsync``.  :meth:`tpc_finish` still doesn't
+           return until a transaction's data are durable, but the
+           commit lock is released, and the data are made visible,
+           before then, so other transactions can be added to the
+           batch.  If syncing fails, the failure is logged and the
+           storage is closed, as the transaction is already committed.
+        :param float group_commit_delay: The maximum number of seconds
+           to wait for more transactions before syncing a batch.  By
+           default, a batch contains the transactions finished while
+           the previous batch was being synced.
+        :param int group_commit_size: The number of transactions in a
+           batch beyond which we don't wait for more.
+        :param bool array_index: Flag indicating whether the in-memory
+           index should be a :class:`~ZODB.fsIndex.fsArrayIndex`,
+           which uses less memory and is saved in a binary format that
+           loads much faster, rather than a :class:`~ZODB.fsIndex.fsIndex`.
+        :param int index_rebuild_processes: The number of processes
+           used to scan the data file when the index has to be
+           rebuilt, or when many transactions were added after the
+           index was saved.  By default, the file is scanned by the
+           opening process alone.
+        :param int index_checkpoint_interval: The number of bytes
+           of committed data after which changes to the index are
+           saved in the background.  This bounds the amount of data
+           that has to be scanned when the storage is opened after it
+           wasn't closed cleanly.  By default, the index is only saved
+           when the storage is closed or packed.
+        :param int pack_processes: The number of processes used to
+           extract object references from records when packing with
+           garbage collection.  By default, references are extracted
+           by the packing thread.
+        :param int tid_cache_size: The number of data records whose
+           transaction ids are kept in memory, so that conflicts can
+           usually be detected when objects are stored without
+           reading from the data file.  Transaction ids of recently
+           committed and stored records are kept.
+        :param int tid_index_interval: The number of transactions per
+           entry of a sparse index of transaction ids to file
+           positions, used to find transactions by id when iterating
+           from a start transaction and when undoing.  The index is
+           saved with the object index, and built when the object
+           index is rebuilt from the file and when the file is packed.
+           Until it covers the whole file, and if 0, transactions are
+           found by searching the file.
+        :param int revision_index_size: The number of data record
+           positions kept in memory for objects with many revisions,
+           so that historical loads of them, with ``loadBefore`` and
+           ``loadSerial``, don't follow their chains of previous
+           records.  Indexing an object reads the headers of up to
+           this many of its records.  By default, the index isn't
+           kept, and previous records are always followed.
+        :param str blob_layout: The layout of the blob directory,
+           ``bushy``, ``lawn`` or ``content``, which stores identical
+           blob content once.  By default, the layout of an existing
+           blob directory is used, and new directories are ``bushy``.
+        :param bool blob_fsync: Flag indicating whether the blob files
+           of a transaction, and the directories they're added to, are
+           synced to disk when the transaction is voted.
 
         A file storage stores data in a single file that behaves like
         a traditional transaction log. New data records are appended
@@ -199,6 +298,15 @@ class FileStorage(
            long because it's necessary to scan the data file to build
            the index.
 
+        .index_delta
+           Changes made to the index since the ``.index`` file was
+           saved, written periodically if an index checkpoint
+           interval is given.
+
+        .tid_index
+           A sparse index of transaction ids to file positions, saved
+           with the ``.index`` file.
+
         .lock
            A lock file preventing multiple processes from opening a
            file storage on non-read-only mode.
@@ -249,6 +357,16 @@ class FileStorage(
 
         self._pack_gc = pack_gc
         self.pack_keep_old = pack_keep_old
+        self._prefetch_cache_size = prefetch_cache_size
+        self._prefetch_threads = prefetch_threads
+        self._mmap_reads = mmap_reads
+        self._pack_processes = pack_processes
+        self._tid_cache_size = tid_cache_size
+        self._tids = collections.OrderedDict() # {pos -> tid}
+        if revision_index_size:
+            self._revisions = RevisionIndex(revision_index_size)
+        if array_index:
+            self._index_class = fsArrayIndex
         if packer is not None:
             self.packer = packer
 
@@ -288,7 +406,18 @@ class FileStorage(
             self._file = open(file_name, 'w+b')
             self._file.write(packed_version)
 
-        self._files = FilePool(self._file_name)
+        self.metrics = Registry(storage=file_name)
+        self._fsync_seconds = self.metrics.histogram(
+            'zodb_filestorage_fsync_seconds',
+            'Time spent syncing committed data to disk')
+        self._files = FilePool(self._file_name, self.metrics.histogram(
+            'zodb_filestorage_file_pool_wait_seconds',
+            'Time spent waiting for a file to read from'))
+        tid_index = None
+        if tid_index_interval:
+            tid_index = self._restore_tid_index(tid_index_interval)
+        checkpointing = index_checkpoint_interval and not read_only
+        changes = {} if checkpointing else None
         r = self._restore_index()
         if r is not None:
             self._used_index = 1 # Marker for testing
@@ -298,16 +427,33 @@ class FileStorage(
             self._pos, self._oid, tid = read_index(
                 self._file, file_name, index, tindex, stop,
                 ltid=ltid, start=start, read_only=read_only,
+                processes=index_rebuild_processes, tid_index=tid_index,
+                changes=changes,
                 )
         else:
             self._used_index = 0 # Marker for testing
             self._pos, self._oid, tid = read_index(
                 self._file, file_name, index, tindex, stop,
-                read_only=read_only,
+                read_only=read_only, processes=index_rebuild_processes,
+                progress=self._index_progress, tid_index=tid_index,
                 )
             self._save_index()
+            start = self._pos
 
         self._ltid = tid
+        if tid_index is not None and tid_index.pos > self._pos:
+            # The file was truncated, or we're time traveling.
+            tid_index = TransactionIndex(tid_index_interval)
+        self._tid_index = tid_index
+
+        if checkpointing:
+            self._checkpointer = IndexCheckpointer(
+                self.__name__, self._index_class, start,
+                index_checkpoint_interval)
+            if start < self._pos:
+                # Checkpoints pick up where the saved deltas left off,
+                # with the changes found scanning the rest of the file.
+                self._checkpointer.update(changes, self._pos)
 
         # self._pos should always point just past the last
         # transaction.  During 2PC, data is written after _pos.
@@ -326,16 +472,25 @@ class FileStorage(
 
         self._quota = quota
 
+        if group_commit and not read_only:
+            self._group_commit = GroupCommit(
+                self._file, self._pos, group_commit_delay, group_commit_size,
+                self._fsync_seconds)
+
         if blob_dir:
             self.blob_dir = os.path.abspath(blob_dir)
             if create and os.path.exists(self.blob_dir):
                 remove_committed_dir(self.blob_dir)
 
-            self._blob_init(blob_dir)
+            self._blob_init(blob_dir, blob_layout, blob_fsync)
             alsoProvides(self, IBlobStorageRestoreable)
         else:
             self.blob_dir = None
             self._blob_init_no_blobs()
+            if packer is None:
+                # Our packer can report the blob records it removes
+                # to blob storages wrapping us.
+                alsoProvides(self, IBlobRecordPacking)
 
     def copyTransactionsFrom(self, other):
         if self.blob_dir:
@@ -343,19 +498,30 @@ class FileStorage(
         else:
             return BaseStorage.copyTransactionsFrom(self, other)
 
+    _mapped = None
+
     def _initIndex(self, index, tindex):
         self._index=index
         self._tindex=tindex
         self._index_get=index.get
+        if self._mmap_reads:
+            # Mapped readers don't lock out packing, so the map is
+            # tied to the index it's consistent with.
+            self._mapped = MappedFile(self._file_name, index)
 
     def __len__(self):
         return len(self._index)
 
+    _index_class = fsIndex
+
     def _newIndexes(self):
         # hook to use something other than builtin dict
-        return fsIndex(), {}
+        return self._index_class(), {}
 
     _saved = 0
+    _checkpointer = None
+    _tid_index = None
+
     def _save_index(self):
         """Write the database index to a file to support quick startup."""
 
@@ -365,6 +531,10 @@ class FileStorage(
         index_name = self.__name__ + '.index'
         tmp_name = index_name + '.index_tmp'
 
+        if self._checkpointer is not None:
+            # Don't save the index while checkpoints are written.
+            self._checkpointer.flush()
+
         self._index.save(self._pos, tmp_name)
 
         try:
@@ -374,6 +544,14 @@ class FileStorage(
                 pass
             os.rename(tmp_name, index_name)
         except: pass
+        else:
+            # The saved index includes any saved changes.
+            if self._checkpointer is not None:
+                self._checkpointer.reset(self._pos)
+            else:
+                remove_index_deltas(self.__name__)
+            if self._tid_index is not None:
+                self._tid_index.save(self.__name__ + '.tid_index')
 
         self._saved += 1
 
@@ -384,6 +562,73 @@ class FileStorage(
                 os.remove(index_name)
             except OSError:
                 pass
+        remove_index_deltas(self.__name__)
+        try:
+            os.remove(self.__name__ + '.tid_index')
+        except OSError:
+            pass
+
+    def _restore_tid_index(self, interval):
+        # Load the saved transaction index, if it's consistent with
+        # the file, or return a new one.
+        tid_index = TransactionIndex.load(self.__name__ + '.tid_index')
+        if tid_index is not None and tid_index.interval == interval:
+            try:
+                if self._tid_index_sane(tid_index):
+                    return tid_index
+            except Exception:
+                pass
+            logger.warning("Ignoring transaction index for %s",
+                           self._file_name)
+        return TransactionIndex(interval)
+
+    def _tid_index_sane(self, tid_index):
+        self._file.seek(0, 2)
+        if self._file.tell() < tid_index.pos:
+            return False
+        if tid_index.positions:
+            tid, _, _ = self._read_txn_tid(tid_index.positions[-1])
+            if tid != tid_index.tids[-1]:
+                return False
+        if tid_index.pos > 4:
+            # The index should end at the end of a transaction.
+            self._file.seek(tid_index.pos - 8)
+            tl = u64(self._file.read(8))
+            if self._read_txn_tid(tid_index.pos - 8 - tl)[1] != tl:
+                return False
+        return True
+
+    def _read_txn_tid(self, pos):
+        # Return the id, length and status of the transaction at pos.
+        self._file.seek(pos)
+        h = self._file.read(TRANS_HDR_LEN)
+        if len(h) != TRANS_HDR_LEN:
+            raise CorruptedDataError(None, h, pos)
+        tid, tl, status = unpack(TRANS_HDR, h)[:3]
+        return tid, tl, as_text(status)
+
+    def _tid_index_covers_file(self):
+        # Whether the transaction index covers all of the committed
+        # transactions.  It doesn't if it wasn't saved, or was
+        # damaged, when the object index was, until the object index
+        # is rebuilt or the file is packed.  Must be called with the
+        # lock held.
+        return (self._tid_index is not None and
+                self._tid_index.pos == self._pos)
+
+    def _txn_pos(self, tid):
+        # Return the position of the first transaction with an id at
+        # least tid, or the end of the file, using the transaction
+        # index, which must cover the file.  Must be called with the
+        # lock held.
+        end = self._pos
+        pos = self._tid_index.find(tid)
+        while pos < end:
+            _tid, tl, _ = self._read_txn_tid(pos)
+            if _tid >= tid:
+                break
+            pos += tl + 8
+        return pos
 
     def _sane(self, index, pos):
         """Sanity check saved index data by reading the last undone trans
@@ -449,20 +694,25 @@ class FileStorage(
 
             return ltid
 
+    def _index_progress(self, pos, file_size):
+        logger.info("%s: index rebuilt up to %s of %s bytes",
+                    self.__name__, pos, file_size)
+
     def _restore_index(self):
         """Load database index to support quick startup."""
         # Returns (index, pos, tid), or None in case of error.
-        # The index returned is always an instance of fsIndex.  If the
-        # index cached in the file is a Python dict, it's converted to
-        # fsIndex here, and, if we're not in read-only mode, the .index
-        # file is rewritten with the converted fsIndex so we don't need to
-        # convert it again the next time.
+        # The index returned is always an instance of the index class,
+        # fsIndex by default.  If the index cached in the file is a
+        # Python dict, it's converted here, and, if we're not in
+        # read-only mode, the .index file is rewritten with the
+        # converted index so we don't need to convert it again the
+        # next time.
         file_name=self.__name__
         index_name=file_name+'.index'
 
         if os.path.exists(index_name):
             try:
-                info = fsIndex.load(index_name)
+                info = self._index_class.load(index_name)
             except:
                 logger.exception('loading index')
                 return None
@@ -481,19 +731,17 @@ class FileStorage(
             # Convert dictionary indexes to fsIndexes *or* convert fsIndexes
             # which have a dict `_data` attribute to a new fsIndex (newer
             # fsIndexes have an OOBTree as `_data`).
-            newindex = fsIndex()
+            newindex = self._index_class()
             newindex.update(index)
             index = newindex
             if not self._is_read_only:
                 # Save the converted index.
-                f = open(index_name, 'wb')
-                p = Pickler(f, _protocol)
-                info['index'] = index
-                p.dump(info)
-                f.close()
+                index.save(pos, index_name)
                 # Now call this method again to get the new data.
                 return self._restore_index()
 
+        pos = read_index_deltas(file_name, index, pos)
+
         tid = self._sane(index, pos)
         if not tid:
             return None
@@ -501,6 +749,13 @@ class FileStorage(
         return index, pos, tid
 
     def close(self):
+        self._blob_close()
+        if self._checkpointer is not None:
+            self._checkpointer.close()
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        if self._mapped is not None:
+            self._mapped.close()
         self._file.close()
         self._files.close()
         if hasattr(self,'_lock_file'):
@@ -516,9 +771,20 @@ class FileStorage(
     def getSize(self):
         return self._pos
 
-    def _lookup_pos(self, oid):
+    def _mapped_for_reading(self):
+        # Return the memory map to read records from, or None if they
+        # should be read from the file pool.  While a transaction is
+        # being finished, readers wait for it in the pool, as they
+        # must see its data once its invalidations have been sent.
+        if self._files.blocked:
+            return None
+        return self._mapped
+
+    def _lookup_pos(self, oid, index=None):
+        if index is None:
+            index = self._index
         try:
-            return self._index[oid]
+            return index[oid]
         except KeyError:
             raise POSKeyError(oid)
         except TypeError:
@@ -530,56 +796,290 @@ class FileStorage(
         """Return pickle data and serial number."""
         assert not version
 
+        mapped = self._mapped_for_reading()
+        if mapped is not None:
+            pos = self._lookup_pos(oid, mapped.index)
+            return self._load_impl(oid, pos, mapped.reader())
+
         with self._files.get() as _file:
             pos = self._lookup_pos(oid)
-            h = self._read_data_header(pos, oid, _file)
-            if h.plen:
-                data = _file.read(h.plen)
-                return data, h.tid
-            elif h.back:
-                # Get the data from the backpointer, but tid from
-                # current txn.
-                data = self._loadBack_impl(oid, h.back, _file=_file)[0]
-                return data, h.tid
-            else:
-                raise POSKeyError(oid)
+            return self._load_impl(oid, pos, _file)
+
+    def _load_impl(self, oid, pos, _file):
+        h = self._read_data_header(pos, oid, _file)
+        if h.plen:
+            data = _file.read(h.plen)
+            return data, h.tid
+        elif h.back:
+            # Get the data from the backpointer, but tid from
+            # current txn.
+            data = self._loadBack_impl(oid, h.back, _file=_file)[0]
+            return data, h.tid
+        else:
+            raise POSKeyError(oid)
+
+    def loadMany(self, oids):
+        """Return a dictionary mapping oids to pickle data and serials.
+
+        The records are read in file order using a single pooled file.
+        """
+        result = {}
+        mapped = self._mapped_for_reading()
+        if mapped is not None:
+            _file = mapped.reader()
+            for pos, oid in self._sorted_positions(oids, mapped.index):
+                result[oid] = self._load_impl(oid, pos, _file)
+            return result
+
+        with self._files.get() as _file:
+            for pos, oid in self._sorted_positions(oids):
+                result[oid] = self._load_impl(oid, pos, _file)
+        return result
+
+    def _sorted_positions(self, oids, index=None):
+        # Return (pos, oid) pairs for the given oids, in file order.
+        lookup_pos = self._lookup_pos
+        return sorted(set((lookup_pos(oid, index), oid) for oid in oids))
 
     def loadSerial(self, oid, serial):
         with self._lock:
             pos = self._lookup_pos(oid)
-            while 1:
-                h = self._read_data_header(pos, oid)
-                if h.tid == serial:
-                    break
-                pos = h.prev
-                if h.tid < serial or not pos:
+            head = pos
+            h = None
+            indexed = self._indexed_revisions(oid, pos, self._file)
+            if indexed is not None:
+                tids, positions = indexed
+                i = bisect.bisect_left(tids, serial)
+                if i < len(tids) and tids[i] == serial:
+                    h = self._read_data_header(positions[i], oid)
+                elif i:
                     raise POSKeyError(oid)
+                else:
+                    # Only the newest revisions of objects with very
+                    # many are indexed.  Follow the chain from the
+                    # oldest indexed revision.
+                    pos = self._read_data_header(positions[0], oid).prev
+                    head = None
+            if h is None:
+                walked = 0
+                while 1:
+                    if not pos:
+                        raise POSKeyError(oid)
+                    h = self._read_data_header(pos, oid)
+                    if h.tid == serial:
+                        break
+                    if h.tid < serial:
+                        raise POSKeyError(oid)
+                    pos = h.prev
+                    walked += 1
+                if (head is not None and self._revisions is not None and
+                        walked > self._revisions.threshold):
+                    self._index_revisions(oid, head, self._file)
+                    h = self._read_data_header(pos, oid)
             if h.plen:
                 return self._file.read(h.plen)
             else:
                 return self._loadBack_impl(oid, h.back)[0]
 
     def loadBefore(self, oid, tid):
+        if self._prefetcher is not None:
+            r = self._prefetcher.get(oid, tid)
+            if r is not None:
+                return r
+
+        mapped = self._mapped_for_reading()
+        if mapped is not None:
+            pos = self._lookup_pos(oid, mapped.index)
+            return self._loadBefore_impl(oid, pos, tid, mapped.reader())
+
         with self._files.get() as _file:
             pos = self._lookup_pos(oid)
-            end_tid = None
-            while True:
+            return self._loadBefore_impl(oid, pos, tid, _file)
+
+    def _loadBefore_impl(self, oid, pos, tid, _file):
+        end_tid = None
+        head = pos
+        h = None
+        indexed = self._indexed_revisions(oid, pos, _file)
+        if indexed is not None:
+            tids, positions = indexed
+            i = bisect.bisect_left(tids, tid)
+            if i:
+                if i < len(tids):
+                    end_tid = tids[i]
+                h = self._read_data_header(positions[i - 1], oid, _file)
+            else:
+                # Only the newest revisions of objects with very many
+                # are indexed.  Follow the chain from the oldest
+                # indexed revision.
+                end_tid = tids[0]
+                pos = self._read_data_header(positions[0], oid, _file).prev
+                head = None
+        if h is None:
+            walked = 0
+            while pos:
                 h = self._read_data_header(pos, oid, _file)
                 if h.tid < tid:
                     break
 
                 pos = h.prev
                 end_tid = h.tid
-                if not pos:
-                    return None
+                walked += 1
+
+            if (head is not None and self._revisions is not None and
+                    walked > self._revisions.threshold):
+                self._index_revisions(oid, head, _file)
+                if pos:
+                    h = self._read_data_header(pos, oid, _file)
+            if not pos:
+                return None
 
-            if h.plen:
-                return _file.read(h.plen), h.tid, end_tid
-            elif h.back:
-                data, _, _, _ = self._loadBack_impl(oid, h.back, _file=_file)
-                return data, h.tid, end_tid
-            else:
-                raise POSKeyError(oid)
+        if h.plen:
+            return _file.read(h.plen), h.tid, end_tid
+        elif h.back:
+            data, _, _, _ = self._loadBack_impl(oid, h.back, _file=_file)
+            return data, h.tid, end_tid
+        else:
+            raise POSKeyError(oid)
+
+    def _index_revisions(self, oid, pos, _file):
+        # Read and index the revisions of an object, given the position
+        # of its current record.  At most the index's size are read.
+        revisions = self._revisions
+        generation = revisions.generation
+        head = pos
+        tids = []
+        positions = []
+        while pos and len(tids) < revisions.size:
+            h = self._read_data_header(pos, oid, _file)
+            tids.append(h.tid)
+            positions.append(pos)
+            pos = h.prev
+        tids.reverse()
+        positions.reverse()
+        revisions.set(oid, head, tids, positions, generation)
+
+    def _indexed_revisions(self, oid, pos, _file):
+        # Return the transaction ids and positions of an object's
+        # revisions, oldest first, given the position of its current
+        # record, or None if the object isn't indexed.
+        revisions = self._revisions
+        if revisions is None:
+            return None
+        generation = revisions.generation
+        entry = revisions.get(oid)
+        if entry is None:
+            return None
+        head, tids, positions = entry
+        if pos == head:
+            return tids, positions
+        if pos < head:
+            # We're reading as of an earlier state of the index.
+            i = bisect.bisect_left(positions, pos)
+            if i < len(positions) and positions[i] == pos:
+                return tids[:i + 1], positions[:i + 1]
+        else:
+            # Add the revisions committed since the object was indexed.
+            new_tids = []
+            new_positions = []
+            p = pos
+            while p > head:
+                h = self._read_data_header(p, oid, _file)
+                new_tids.append(h.tid)
+                new_positions.append(p)
+                p = h.prev
+            if p == head:
+                tids = tids + new_tids[::-1]
+                positions = positions + new_positions[::-1]
+                revisions.set(oid, pos, tids, positions, generation)
+                return tids, positions
+        revisions.discard(oid)
+        return None
+
+    def revisionIndexStatistics(self):
+        """Return a dictionary of revision index statistics
+
+        None is returned if the revision index isn't enabled.
+        """
+        if self._revisions is not None:
+            return self._revisions.statistics()
+
+    def loadBeforeMany(self, oids, tid):
+        """Return a dictionary mapping oids to loadBefore results.
+
+        Rather than checking a file out of the pool for each object,
+        the current positions of all of the objects are looked up
+        first and the records are read in file order using a single
+        pooled file.
+        """
+        result = {}
+        mapped = self._mapped_for_reading()
+        if mapped is not None:
+            _file = mapped.reader()
+            for pos, oid in self._sorted_positions(oids, mapped.index):
+                result[oid] = self._loadBefore_impl(oid, pos, tid, _file)
+            return result
+
+        with self._files.get() as _file:
+            for pos, oid in self._sorted_positions(oids):
+                result[oid] = self._loadBefore_impl(oid, pos, tid, _file)
+        return result
+
+    _prefetcher = None
+    _group_commit = None
+    _revisions = None
+
+    def groupCommitStatistics(self):
+        """Return a dictionary of group-commit statistics
+
+        None is returned if group commit isn't enabled.
+        """
+        if self._group_commit is not None:
+            return self._group_commit.statistics()
+
+    def packStatistics(self):
+        """Return the time taken by each phase of the last pack
+
+        The dictionary returned maps phase names to seconds:
+
+        index
+           Scanning the file up to the pack time.
+        reachable
+           Finding the records reachable as of the pack time.
+        copy
+           Copying records up to the pack time.
+        catch_up
+           Copying transactions committed while packing, without the
+           commit lock.
+        locked
+           Copying the remaining transactions, with the commit lock.
+        swap
+           Replacing the data file with the packed file, with the
+           commit lock.
+
+        None is returned if the storage hasn't been packed by the
+        default packer.
+        """
+        if self._pack_timings is not None:
+            return dict(self._pack_timings)
+
+    def prefetch(self, oids, tid):
+        """Read the records for the given oids in the background
+
+        The records that would be returned by ``loadBefore(oid, tid)``
+        are read by background threads and kept, in a bounded cache,
+        until they're loaded.  Nothing is done unless the storage was
+        opened with a non-zero ``prefetch_cache_size``.
+        """
+        if not self._prefetch_cache_size:
+            return
+        if self._prefetcher is None:
+            with self._lock:
+                if self._prefetcher is None:
+                    self._prefetcher = Prefetcher(
+                        self, self._prefetch_cache_size,
+                        self._prefetch_threads)
+        self._prefetcher.prefetch(oids, tid)
 
     def store(self, oid, oldserial, data, version, transaction):
         if self._is_read_only:
@@ -595,8 +1095,7 @@ class FileStorage(
             committed_tid = None
             pnv = None
             if old:
-                h = self._read_data_header(old, oid)
-                committed_tid = h.tid
+                committed_tid = self._record_tid(old, oid)
 
                 if oldserial != committed_tid:
                     data = self.tryToResolveConflict(oid, committed_tid,
@@ -616,6 +1115,80 @@ class FileStorage(
                 raise FileStorageQuotaError(
                     "The storage quota has been exceeded.")
 
+    def storeMany(self, records, transaction):
+        if self._is_read_only:
+            raise ReadOnlyError()
+        if transaction is not self._transaction:
+            raise StorageTransactionError(self, transaction)
+
+        with self._lock:
+            # Look up the records' current positions and read the
+            # transaction ids we don't know, in file order.
+            index_get = self._index_get
+            records = [(oid, oldserial, data, index_get(oid, 0))
+                       for oid, oldserial, data in records]
+            tids = self._tids
+            for old, oid in sorted(
+                    (old, oid) for oid, _, _, old in records
+                    if old and old not in tids):
+                self._record_tid(old, oid)
+
+            pos = self._pos
+            tid = self._tid
+            tindex = self._tindex
+            here = pos + self._tfile.tell() + self._thl
+            last = None
+            max_oid = self._oid
+            buffer = []
+            for oid, oldserial, data, old in records:
+                if oid > max_oid:
+                    max_oid = oid
+                if old:
+                    committed_tid = self._record_tid(old, oid)
+
+                    if oldserial != committed_tid:
+                        data = self.tryToResolveConflict(oid, committed_tid,
+                                                         oldserial, data)
+                        self._resolved.append(oid)
+
+                tindex[oid] = last = here
+                new = DataHeader(oid, tid, old, pos, 0, len(data))
+                buffer.append(new.asString())
+                buffer.append(data)
+                here += DATA_HDR_LEN + len(data)
+
+            if max_oid > self._oid:
+                self.set_max_oid(max_oid)
+
+            # All of the records are written at once.
+            self._tfile.write(b''.join(buffer))
+
+            # Check quota
+            if (self._quota is not None and last is not None and
+                last > self._quota):
+                raise FileStorageQuotaError(
+                    "The storage quota has been exceeded.")
+
+    def _record_tid(self, pos, oid):
+        # Return the id of the transaction that wrote the data record
+        # at pos.  Must call with the lock held.
+        tid = self._tids.get(pos)
+        if tid is None:
+            tid = self._read_data_header(pos, oid).tid
+            self._cache_tids((pos,), tid)
+        return tid
+
+    def _cache_tids(self, positions, tid):
+        # Remember the transaction id of the data records at the given
+        # positions.  Records don't change until the file is packed.
+        size = self._tid_cache_size
+        if size:
+            tids = self._tids
+            for pos in positions:
+                tids[pos] = tid
+            while len(tids) > size:
+                tids.popitem(False)
+
     def deleteObject(self, oid, oldserial, transaction):
         if self._is_read_only:
             raise ReadOnlyError()
@@ -626,8 +1199,7 @@ class FileStorage(
             old = self._index_get(oid, 0)
             if not old:
                 raise POSKeyError(oid)
-            h = self._read_data_header(old, oid)
-            committed_tid = h.tid
+            committed_tid = self._record_tid(old, oid)
 
             if oldserial != committed_tid:
                 raise ConflictError(
@@ -777,10 +1349,13 @@ class FileStorage(
                 raise FileStorageError('too much extension data')
 
     def tpc_vote(self, transaction):
+        if transaction is not self._transaction:
+            raise StorageTransactionError(
+                "tpc_vote called with wrong transaction")
+        # Blob files are put in place before the transaction is
+        # written, without blocking readers.
+        self._blob_tpc_vote()
         with self._lock:
-            if transaction is not self._transaction:
-                raise StorageTransactionError(
-                    "tpc_vote called with wrong transaction")
             dlen = self._tfile.tell()
             if not dlen:
                 return # No data in this trans
@@ -810,21 +1385,44 @@ class FileStorage(
             return self._resolved
 
     def tpc_finish(self, transaction, f=None):
-        with self._files.write_lock():
-            with self._lock:
-                if transaction is not self._transaction:
-                    raise StorageTransactionError(
-                        "tpc_finish called with wrong transaction")
-                try:
-                    tid = self._tid
-                    if f is not None:
-                        f(tid)
-                    self._finish(tid, *self._ude)
-                    self._clear_temp()
-                finally:
-                    self._ude = None
-                    self._transaction = None
-                    self._commit_lock.release()
+        with self._lock:
+            if transaction is not self._transaction:
+                raise StorageTransactionError(
+                    "tpc_finish called with wrong transaction")
+            try:
+                tid = self._tid
+                self._finish(tid, *self._ude)
+
+                # Readers that start once invalidations have been sent
+                # must see the new data, so they wait while the
+                # invalidations are sent and the data are made visible.
+                # Readers that are already running only read data
+                # committed earlier, so we don't wait for them.
+                with self._files.finish_lock():
+                    try:
+                        if f is not None:
+                            f(tid)
+                    finally:
+                        if self._nextpos:
+                            self._finish_publish(tid)
+                self._clear_temp()
+                end = self._nextpos
+            finally:
+                self._ude = None
+                self._transaction = None
+                self._commit_lock.release()
+
+        if end and self._group_commit is not None:
+            try:
+                self._group_commit.sync(end)
+            except Exception:
+                # The transaction is committed and visible, so we
+                # don't raise in the second phase of the commit.  As
+                # when _finish fails to sync, we can't go on.
+                logger.critical("Failure syncing committed data. Closing.",
+                                exc_info=True)
+                if not self._file.closed:
+                    self.close()
         return tid
 
     def _finish(self, tid, u, d, e):
@@ -849,12 +1447,30 @@ class FileStorage(
         # This is a separate method to allow tests to replace it with
         # something broken. :)
 
+        # Readers only read data before self._pos, so they don't
+        # wait while the new data are written to disk.
         self._file.flush()
-        if fsync is not None:
+        if self._group_commit is not None:
+            # The data are synced by tpc_finish, after the commit lock
+            # is released.
+            self._group_commit.written(self._nextpos)
+        elif fsync is not None:
+            start = default_timer()
             fsync(self._file.fileno())
+            self._fsync_seconds.observe(default_timer() - start)
 
+    def _finish_publish(self, tid):
+        # Make the data written by the transaction visible to readers.
+        if self._tid_index is not None:
+            self._tid_index.add(
+                tid, self._tstatus, self._pos, self._nextpos)
         self._pos = self._nextpos
         self._index.update(self._tindex)
+        self._cache_tids(self._tindex.values(), tid)
+        if self._checkpointer is not None:
+            self._checkpointer.update(self._tindex, self._pos)
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate(self._tindex, tid)
         self._ltid = tid
         self._blob_tpc_finish()
 
@@ -863,7 +1479,7 @@ class FileStorage(
             self._file.truncate(self._pos)
             self._files.flush()
             self._nextpos=0
-            self._blob_tpc_abort()
+        self._blob_tpc_abort()
 
     def _undoDataInfo(self, oid, pos, tpos):
         """Return the tid, data pointer, and data for the oid record at pos
@@ -1050,6 +1666,15 @@ class FileStorage(
           return self._tid, tindex.keys()
 
     def _txn_find(self, tid, stop_at_pack):
+        if self._tid_index_covers_file():
+            pos = self._txn_pos(tid)
+            if pos < self._pos and self._read_txn_tid(pos)[0] == tid:
+                if stop_at_pack and self._tid_index.packed > pos:
+                    # The transaction is before the last pack.
+                    raise UndoError("Invalid transaction id")
+                return pos
+            raise UndoError("Invalid transaction id")
+
         pos = self._pos
         while pos > 39:
             self._file.seek(pos - 8)
@@ -1110,7 +1735,7 @@ class FileStorage(
                             with self.openCommittedBlobFile(
                                 h.oid, userial) as sfp:
                                 with open(tmp, 'wb') as dfp:
-                                    cp(sfp, dfp)
+                                    fastcp(sfp, dfp)
                             self._blob_storeblob(h.oid, self._tid, tmp)
 
                 new = DataHeader(h.oid, self._tid, ipos, otloc, 0, len(p))
@@ -1179,11 +1804,14 @@ class FileStorage(
         # simply adapt the old interface to the new.  We don't really
         # want to invest much in the old packer, at least for now.
         assert referencesf is not None
-        p = FileStoragePacker(storage, referencesf, stop, gc)
+        p = FileStoragePacker(storage, referencesf, stop, gc,
+                              storage._pack_blob_records)
+        storage._pack_timings = p.timings
         try:
             opos = p.pack()
             if opos is None:
                 return None
+            storage._pack_tid_index = p.tid_index
             return opos, p.index
         finally:
             p.close()
@@ -1197,6 +1825,37 @@ class FileStorage(
         Also, data back pointers that point before packtss are resolved and
         the associated data are copied, since the old records are not copied.
         """
+        self._pack(t, referencesf, gc)
+
+    _pack_blob_records = None
+    _pack_tid_index = None
+
+    def packBlobRecords(self, pack_time, referencesf, is_blob_record,
+                        dry_run=False):
+        """Pack, returning the oids and tids of the blob records removed
+
+        See :class:`ZODB.interfaces.IBlobRecordPacking`.
+        """
+        if self.blob_dir:
+            raise FileStorageError(
+                "Storages with blob directories remove their own blob files")
+        removed = []
+        if not dry_run:
+            self._pack(pack_time, referencesf, None, (is_blob_record, removed))
+            return removed
+
+        if not self._index:
+            return removed
+        stop = TimeStamp(*time.gmtime(pack_time)[:5]+(pack_time%60,)).raw()
+        p = FileStoragePacker(self, referencesf, stop, self._pack_gc,
+                              (is_blob_record, removed))
+        try:
+            p.preview()
+        finally:
+            p.close()
+        return removed
+
+    def _pack(self, t, referencesf, gc, blob_records=None):
         if self._is_read_only:
             raise ReadOnlyError()
 
@@ -1212,6 +1871,7 @@ class FileStorage(
             if self._pack_is_in_progress:
                 raise FileStorageError('Already packing')
             self._pack_is_in_progress = True
+            self._pack_blob_records = blob_records
 
         if gc is None:
             gc = self._pack_gc
@@ -1235,14 +1895,31 @@ class FileStorage(
                 return
             have_commit_lock = True
             opos, index = pack_result
+            swap_start = time.time()
+            if self._group_commit is not None:
+                # Don't leave transactions waiting to be synced in the
+                # old file.
+                self._group_commit.sync(self._pos)
             with self._files.write_lock():
                 with self._lock:
                     self._files.empty()
+                    if self._mapped is not None:
+                        # The maps must be closed too, for the file to
+                        # be renamed on Windows.  Readers still using
+                        # one see the old file, which is consistent
+                        # with the old index, and it's closed when
+                        # they're done.
+                        self._mapped.close()
                     self._file.close()
                     try:
                         os.rename(self._file_name, oldpath)
                     except Exception:
                         self._file = open(self._file_name, 'r+b')
+                        if self._mapped is not None:
+                            self._mapped = MappedFile(self._file_name,
+                                                      self._index)
+                        if self._group_commit is not None:
+                            self._group_commit.reset(self._file, self._pos)
                         raise
 
                     # OK, we're beyond the point of no return
@@ -1250,6 +1927,31 @@ class FileStorage(
                     self._file = open(self._file_name, 'r+b')
                     self._initIndex(index, self._tindex)
                     self._pos = opos
+                    if self._checkpointer is not None:
+                        # Saved changes refer to the old file.
+                        self._checkpointer.reset(opos)
+                    if self._group_commit is not None:
+                        self._group_commit.reset(self._file, opos)
+                    if self._prefetcher is not None:
+                        self._prefetcher.clear()
+                    self._tids.clear()
+                    if self._revisions is not None:
+                        self._revisions.clear()
+                    if self._tid_index is not None:
+                        # Our packer indexes the transactions it
+                        # writes.
+                        tid_index = self._pack_tid_index
+                        if tid_index is None or tid_index.pos != opos:
+                            tid_index = self._tid_index.empty()
+                        self._tid_index = tid_index
+                    self._crs_clear_cache()
+
+            timings = self._pack_timings
+            if timings is not None:
+                timings['swap'] = time.time() - swap_start
+                logger.info("%s packed: %s", self.__name__, ', '.join(
+                    "%s %.3fs" % (phase, seconds)
+                    for phase, seconds in sorted(timings.items())))
 
             # We're basically done.  Now we need to deal with removed
             # blobs and removing the .old file (see further down).
@@ -1264,6 +1966,8 @@ class FileStorage(
                 self._commit_lock.release()
             with self._lock:
                 self._pack_is_in_progress = False
+                self._pack_blob_records = None
+                self._pack_tid_index = None
 
         if not self.pack_keep_old:
             os.remove(oldpath)
@@ -1315,6 +2019,10 @@ class FileStorage(
             os.mkdir(old)
             link_or_copy(os.path.join(self.blob_dir, '.layout'),
                          os.path.join(old, '.layout'))
+            manifest_path = os.path.join(self.blob_dir, MANIFEST)
+            if os.path.exists(manifest_path):
+                # Copied, as the manifest is appended to.
+                shutil.copyfile(manifest_path, os.path.join(old, MANIFEST))
             def handle_file(path):
                 newpath = old+path[lblob_dir:]
                 dest = os.path.dirname(newpath)
@@ -1322,18 +2030,34 @@ class FileStorage(
                     os.makedirs(dest)
                 os.rename(path, newpath)
             handle_dir = handle_file
+        elif fshelper.layout.content_addressed:
+            # Helpers that remove an oid dir or revision file, noting
+            # the stored content it linked to, to be collected.
+            contents = set()
+            def handle_file(path):
+                content = fshelper.getLinkedContent(path)
+                if content is not None:
+                    contents.add(content)
+                remove_committed(path)
+            def handle_dir(path):
+                for name in os.listdir(path):
+                    handle_file(os.path.join(path, name))
+                remove_committed_dir(path)
         else:
             # Helpers that remove an oid dir or revision file.
             handle_file = remove_committed
             handle_dir = remove_committed_dir
 
         # Fist step: move or remove oids or revisions
+        removed_oids = []
+        removed = []
         with open(os.path.join(self.blob_dir, '.removed'), 'rb') as fp:
             for line in fp:
                 line = binascii.unhexlify(line.strip())
 
                 if len(line) == 8:
                     # oid is garbage, re/move dir
+                    removed_oids.append(line)
                     path = fshelper.getPathForOID(line)
                     if not os.path.exists(path):
                         # Hm, already gone. Odd.
@@ -1347,6 +2071,7 @@ class FileStorage(
                         "Bad record in ", self.blob_dir, '.removed')
 
                 oid, tid = line[:8], line[8:]
+                removed.append((oid, tid))
                 path = fshelper.getBlobFilename(oid, tid)
                 if not os.path.exists(path):
                     # Hm, already gone. Odd.
@@ -1355,23 +2080,46 @@ class FileStorage(
                 assert not os.path.exists(path)
                 maybe_remove_empty_dir_containing(path)
 
+        if fshelper.manifest is not None:
+            fshelper.manifest.removeOIDs(removed_oids)
+            fshelper.manifest.remove(removed)
+            fshelper.manifest.compact()
+
         os.remove(os.path.join(self.blob_dir, '.removed'))
 
+        if fshelper.layout.content_addressed and not self.pack_keep_old:
+            # Only the content removed files linked to is checked;
+            # kept old files still link to their content.
+            fshelper.collectContent(contents)
+
         if not self.pack_keep_old:
             return
 
         # Second step, copy remaining files.
-        for path, dir_names, file_names in os.walk(self.blob_dir):
-            for file_name in file_names:
-                if not file_name.endswith('.blob'):
-                    continue
-                file_path = os.path.join(path, file_name)
-                dest = os.path.dirname(old+file_path[lblob_dir:])
-                if not os.path.exists(dest):
-                    os.makedirs(dest)
-                link_or_copy(file_path, old+file_path[lblob_dir:])
+        if fshelper.manifest is not None:
+            file_paths = [fshelper.getBlobFilename(oid, tid)
+                          for oid, tid, size in fshelper.manifest.items()]
+            file_paths = [path for path in file_paths
+                          if os.path.exists(path)]
+        else:
+            file_paths = [
+                os.path.join(path, file_name)
+                for path, dir_names, file_names in os.walk(self.blob_dir)
+                for file_name in file_names
+                if file_name.endswith('.blob')
+                ]
+        for file_path in file_paths:
+            dest = os.path.dirname(old+file_path[lblob_dir:])
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+            link_or_copy(file_path, old+file_path[lblob_dir:])
 
     def iterator(self, start=None, stop=None):
+        if start and self._tid_index is not None:
+            with self._lock:
+                if self._tid_index_covers_file():
+                    pos = self._txn_pos(start)
+                    return FileIterator(self._file_name, stop=stop, pos=pos)
         return FileIterator(self._file_name, start, stop)
 
     def lastInvalidations(self, count):
@@ -1402,7 +2150,8 @@ class FileStorage(
 
     def cleanup(self):
         """Remove all files created by this storage."""
-        for ext in '', '.old', '.tmp', '.lock', '.index', '.pack':
+        for ext in ('', '.old', '.tmp', '.lock', '.index', '.index_delta',
+                    '.tid_index', '.pack'):
             try:
                 os.remove(self._file_name + ext)
             except OSError as e:
@@ -1573,7 +2322,9 @@ def recover(file_name):
 
 
 def read_index(file, name, index, tindex, stop=b'\377'*8,
-               ltid=z64, start=4, maxoid=z64, recover=0, read_only=0):
+               ltid=z64, start=4, maxoid=z64, recover=0, read_only=0,
+               processes=0, progress=None, chunk_size=1<<26,
+               tid_index=None, changes=None):
     """Scan the file storage and update the index.
 
     Returns file position, max oid, and last transaction id.  It also
@@ -1598,6 +2349,18 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
     maxoid -- ignored (it meant something prior to ZODB 3.2.6; the argument
               still exists just so the signature of read_index() stayed the
               same)
+    processes -- if greater than 1, the file is scanned by a pool of
+                 this many processes, each scanning chunks of
+                 chunk_size bytes, which is much faster for large
+                 files.  Whatever the pool can't scan with certainty is
+                 scanned serially.  This is ignored when recovering.
+    progress -- a callable called with the scan position and the file
+                size as the scan proceeds, roughly every chunk_size
+                bytes
+    tid_index -- a TransactionIndex that's extended with the
+                 transactions scanned, if it ends where they start
+    changes -- a dictionary that's also updated with the index
+               entries for the transactions scanned
 
     The file position returned is the position just after the last
     valid transaction record.  The oid returned is the maximum object
@@ -1625,10 +2388,21 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
     index_get = index.get
 
     pos = start
-    seek(start)
+    if (processes > 1 and not recover and
+            file_size - start > chunk_size):
+        pos, ltid = _read_index_parallel(
+            file.name, index, start, file_size, stop, ltid,
+            processes, progress, chunk_size, changes, tid_index)
+
+    seek(pos)
     tid = b'\0' * 7 + b'\1'
+    next_progress = pos + chunk_size
 
     while 1:
+        if progress is not None and pos >= next_progress:
+            progress(pos, file_size)
+            next_progress = pos + chunk_size
+
         # Read the transaction record
         h = read(TRANS_HDR_LEN)
         if not h:
@@ -1702,6 +2476,8 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
                 panic('%s has inconsistent transaction length at %s',
                       name, pos)
             pos = tend + 8
+            if tid_index is not None:
+                tid_index.add(tid, status, tpos, pos)
             continue
 
         pos = tpos + TRANS_HDR_LEN + ul + dl + el
@@ -1745,7 +2521,11 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
         pos += 8
 
         index.update(tindex)
+        if changes is not None:
+            changes.update(tindex)
         tindex.clear()
+        if tid_index is not None:
+            tid_index.add(tid, status, tpos, pos)
 
     # Caution:  fsIndex doesn't have an efficient __nonzero__ or __len__.
     # That's why we do try/except instead.  fsIndex.maxKey() is fast.
@@ -1755,9 +2535,223 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
         # The index is empty.
         pass # maxoid is already equal to z64
 
+    if progress is not None and pos > start:
+        progress(pos, file_size)
+
     return pos, maxoid, ltid
 
 
+def _read_index_parallel(name, index, start, file_size, stop, ltid,
+                         processes, progress, chunk_size, changes=None,
+                         tid_index=None):
+    """Update the index from a pool of processes scanning chunks of a file
+
+    Chunk scans are merged in file order, for as long as each one
+    starts where the previous one ended and the first records of the
+    objects in it point back to the records the index has for them.
+    The transactions merged are added to tid_index, if given.  Returns
+    the position and id of the last transaction merged, for the caller
+    to continue scanning from.
+    """
+    tasks = ((name, offset, min(offset + chunk_size, file_size), stop,
+              offset == start, tid_index is not None)
+             for offset in range(start, file_size, chunk_size))
+    index_get = index.get
+    pos = start
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Limit the number of scanned chunks waiting to be merged.
+        pending = collections.deque(
+            pool.apply_async(_read_index_chunk, (task,))
+            for task in itertools.islice(tasks, processes * 2))
+        while pending:
+            result = pending.popleft().get()
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(_read_index_chunk, (task,)))
+            if result is None:
+                # No transaction starts in the chunk.
+                continue
+
+            (tpos, end, first_tid, last_tid, reductions, positions, prevs,
+             transactions) = result
+            if (tpos != pos or first_tid is None or
+                    any(index_get(oid, 0) != prev
+                        for oid, prev in prevs.items())):
+                # The previous chunk ended early, or we were fooled by
+                # data that look like a transaction boundary, or
+                # there's a broken previous pointer for the serial
+                # scan to complain about.
+                logger.info("%s parallel index scan stopped at %s",
+                            name, pos)
+                break
+
+            if first_tid <= ltid:
+                logger.warning("%s time-stamp reduction at %s", name, tpos)
+            for rpos in reductions:
+                logger.warning("%s time-stamp reduction at %s", name, rpos)
+
+            index.update(positions)
+            if changes is not None:
+                changes.update(positions)
+            if tid_index is not None:
+                for transaction in transactions:
+                    tid_index.add(*transaction)
+
+            pos = end
+            ltid = last_tid
+            if progress is not None:
+                progress(pos, file_size)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return pos, ltid
+
+
+def _read_index_chunk(args):
+    """Scan the transactions starting in a chunk of a file
+
+    The scan starts at the first transaction boundary in the chunk,
+    or at the start of the chunk if it's known to be a boundary, and
+    stops at the first transaction starting after the chunk, or before
+    any transaction that read_index would complain about, so it can
+    deal with it.
+
+    Returns None if no transaction starts in the chunk.  Otherwise,
+    returns the position of the first transaction scanned, the
+    position after the last one, their ids, a list of the positions of
+    time-stamp reductions, an fsIndex of the positions of the last
+    data records of the objects written in the chunk, an fsIndex of
+    the previous record positions of their first data records in the
+    chunk, and, if transactions is true, a list of the id, status,
+    position and end of each transaction scanned, for a
+    TransactionIndex, or else None.
+    """
+    name, pos, end, stop, boundary, transactions = args
+    with open(name, 'rb') as file:
+        if not boundary:
+            pos = _find_transaction(file, pos, end)
+            if pos is None:
+                return None
+
+        read = file.read
+        seek = file.seek
+        seek(0, 2)
+        file_size = file.tell()
+        fmt = TempFormatter(file)
+
+        start = pos
+        first_tid = ltid = None
+        reductions = []
+        positions = fsIndex()
+        prevs = fsIndex()
+        transactions = [] if transactions else None
+        while pos < end:
+            seek(pos)
+            h = read(TRANS_HDR_LEN)
+            if len(h) != TRANS_HDR_LEN:
+                break
+            tid, tl, status, ul, dl, el = unpack(TRANS_HDR, h)
+            tend = pos + tl
+            if (tid >= stop or status not in _transaction_statuses or
+                    tend + 8 > file_size or
+                    tl < TRANS_HDR_LEN + ul + dl + el):
+                break
+            seek(tend)
+            if u64(read(8)) != tl:
+                break
+
+            if status != b'u':
+                tpositions = {}
+                tprevs = {}
+                dpos = pos + TRANS_HDR_LEN + ul + dl + el
+                while dpos < tend:
+                    try:
+                        h = fmt._read_data_header(dpos)
+                    except CorruptedError:
+                        break
+                    dlen = h.recordlen()
+                    if (dpos + dlen > tend or h.tloc != pos or
+                            positions.get(h.oid, h.prev) != h.prev):
+                        break
+                    if h.oid not in tpositions:
+                        tprevs[h.oid] = h.prev
+                    tpositions[h.oid] = dpos
+                    dpos += dlen
+                if dpos != tend:
+                    break
+                for oid, prev in tprevs.items():
+                    if oid not in positions:
+                        prevs[oid] = prev
+                positions.update(tpositions)
+
+            if first_tid is None:
+                first_tid = tid
+            elif tid <= ltid:
+                reductions.append(pos)
+            ltid = tid
+            if transactions is not None:
+                transactions.append((tid, as_text(status), pos, tend + 8))
+            pos = tend + 8
+
+    if first_tid is None:
+        # We didn't get past the first transaction.
+        return start, start, None, None, (), None, None, None
+
+    return (start, pos, first_tid, ltid, reductions, positions, prevs,
+            transactions)
+
+
+def _find_transaction(file, pos, end):
+    """Return the position of the first transaction starting in [pos, end)
+
+    Transaction boundaries are recognized by the redundant length
+    before them, which must match the length in the header of the
+    previous transaction, and by the transaction's own redundant
+    length.  Returns None if there's no boundary in the range.
+    """
+    read = file.read
+    seek = file.seek
+    seek(0, 2)
+    file_size = file.tell()
+    block = 1 << 16
+    while pos < end:
+        seek(pos - 8)
+        buf = read(block + 8)
+        for i in range(min(block, end - pos, len(buf) - 8)):
+            tpos = pos + i
+            # Only a small fraction of positions have a plausible
+            # length in front of them.
+            l = u64(buf[i:i+8])
+            if l < TRANS_HDR_LEN or l > tpos - 12:
+                continue
+            if _transaction_length(file, tpos - 8 - l) != l:
+                continue
+            tl = _transaction_length(file, tpos)
+            if tl is None or tpos + tl + 8 > file_size:
+                continue
+            seek(tpos + tl)
+            if u64(read(8)) == tl:
+                return tpos
+        pos += block
+    return None
+
+
+_transaction_statuses = b' ', b'u', b'p'
+
+def _transaction_length(file, pos):
+    # Return the length of a plausible transaction header at pos, or None
+    file.seek(pos)
+    h = file.read(TRANS_HDR_LEN)
+    if len(h) != TRANS_HDR_LEN:
+        return None
+    tid, tl, status, ul, dl, el = unpack(TRANS_HDR, h)
+    if (status not in _transaction_statuses or
+            tl < TRANS_HDR_LEN + ul + dl + el):
+        return None
+    return tl
+
+
 def _truncate(file, name, pos):
     file.seek(0, 2)
     file_size = file.tell()
@@ -2149,12 +3143,15 @@ class FilePool(object):
     closed = False
     writing = False
     writers = 0
+    finishing = False
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, wait_seconds=None):
         self.name = file_name
         self._files = []
         self._out = []
         self._cond = utils.Condition()
+        # An optional histogram of the time spent waiting for a file.
+        self._wait_seconds = wait_seconds
 
     @contextlib.contextmanager
     def write_lock(self):
@@ -2175,11 +3172,39 @@ class FilePool(object):
                     self.writers -= 1
                 self._cond.notifyAll()
 
+    @contextlib.contextmanager
+    def finish_lock(self):
+        """Hold off new readers while committed data are made visible
+
+        Unlike the write lock, this doesn't wait for outstanding
+        readers, because the data being made visible were written
+        beyond anything they read.
+        """
+        with self._cond:
+            self.finishing = True
+
+        try:
+            yield None
+        finally:
+            with self._cond:
+                self.finishing = False
+                self._cond.notifyAll()
+
+    @property
+    def blocked(self):
+        """Whether new readers have to wait
+        """
+        return self.writers or self.finishing
+
     @contextlib.contextmanager
     def get(self):
         with self._cond:
-            while self.writers:
-                self._cond.wait()
+            waited = 0.0
+            if self.blocked:
+                start = default_timer()
+                while self.blocked:
+                    self._cond.wait()
+                waited = default_timer() - start
             assert not self.writing
             if self.closed:
                 raise ValueError('closed')
@@ -2190,6 +3215,9 @@ class FilePool(object):
                 f = open(self.name, 'rb')
             self._out.append(f)
 
+        if self._wait_seconds is not None:
+            self._wait_seconds.observe(waited)
+
         try:
             yield f
         finally:
@@ -2208,7 +3236,9 @@ class FilePool(object):
     def flush(self):
         """Empty read buffers.
 
-        This is required if they contain data of rolled back transactions.
+        This is required if they contain data of rolled back
+        transactions.  It isn't needed when transactions are
+        finished, as committed data aren't changed.
         """
         # Unfortunately, Python 3.x has no API to flush read buffers, and
         # the API is ineffective in Python 2 on Mac OS X.
@@ -2222,3 +3252,677 @@ class FilePool(object):
                 self._out.pop().close()
             self.empty()
             self.writing = self.writers = 0
+
+
+class GroupCommit(object):
+    """Sync data written to a file for batches of transactions
+
+    Committers note the end of the data they've written and then wait
+    for the data to be synced.  The first committer to wait syncs the
+    data written by all of the committers so far, while the others
+    wait for it.
+    """
+
+    batches = transactions = max_batch = 0
+    sync_time = max_sync_time = 0.0
+
+    def __init__(self, file, pos, delay=0, size=100, sync_seconds=None):
+        self.delay = delay
+        self.size = size
+        # An optional histogram of the time spent syncing.
+        self._sync_seconds = sync_seconds
+        self._cond = utils.Condition()
+        self._syncing = False
+        self.reset(file, pos)
+
+    def reset(self, file, pos):
+        """Start syncing a new file, which has been synced up to pos
+        """
+        with self._cond:
+            self._file = file
+            self._written = self._synced = pos
+            self._pending = 0
+            self._cond.notifyAll()
+
+    def written(self, pos):
+        """Note that a transaction's data have been written up to pos
+        """
+        with self._cond:
+            self._written = pos
+            self._pending += 1
+            self._cond.notifyAll()
+
+    def sync(self, pos):
+        """Return once the data written up to pos have been synced
+        """
+        while True:
+            with self._cond:
+                while self._syncing and self._synced < pos:
+                    self._cond.wait()
+                if self._synced >= pos:
+                    return
+                self._syncing = True
+
+                if self.delay:
+                    deadline = time.time() + self.delay
+                    while self._pending < self.size:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            break
+                        self._cond.wait(timeout)
+
+                end = self._written
+                batch = self._pending
+                self._pending = 0
+                file = self._file
+
+            synced = False
+            start = time.time()
+            try:
+                if fsync is not None:
+                    fsync(file.fileno())
+                synced = True
+            finally:
+                elapsed = time.time() - start
+                with self._cond:
+                    self._syncing = False
+                    if synced:
+                        self._synced = max(self._synced, end)
+                        self.batches += 1
+                        self.transactions += batch
+                        self.max_batch = max(self.max_batch, batch)
+                        self.sync_time += elapsed
+                        self.max_sync_time = max(self.max_sync_time, elapsed)
+                        if self._sync_seconds is not None:
+                            self._sync_seconds.observe(elapsed)
+                    else:
+                        # Let someone else try.
+                        self._pending += batch
+                    self._cond.notifyAll()
+
+    def statistics(self):
+        """Return a dictionary of statistics
+
+        Times are in seconds.
+        """
+        with self._cond:
+            batches = self.batches
+            return dict(
+                batches=batches,
+                transactions=self.transactions,
+                mean_batch=(float(self.transactions) / batches
+                            if batches else 0.0),
+                max_batch=self.max_batch,
+                mean_sync_time=self.sync_time / batches if batches else 0.0,
+                max_sync_time=self.max_sync_time,
+                )
+
+
+INDEX_DELTA_MAGIC = b'FSID'
+INDEX_DELTA_HDR = '>4sQQQ'
+INDEX_DELTA_HDR_LEN = 28
+
+def read_index_deltas(name, index, pos, unmerged=None):
+    """Update an index with the changes saved by an IndexCheckpointer
+
+    The index is valid for the data in the named file before pos.
+    Saved changes are applied for as long as there are some that start
+    where the index, as updated, ends.  Returns the position the
+    updated index is valid for.
+
+    If unmerged is a list, the saved changes that weren't applied, but
+    that start after the returned position, are appended to it as they
+    were saved, so they can be kept.  Changes saved after a checkpoint
+    that wasn't completely written can't be read and are lost.
+    """
+    try:
+        f = open(name + '.index_delta', 'rb')
+    except (IOError, OSError):
+        return pos
+
+    deltas = {}
+    with f:
+        while 1:
+            h = f.read(INDEX_DELTA_HDR_LEN)
+            if len(h) != INDEX_DELTA_HDR_LEN:
+                break
+            magic, start, end, n = unpack(INDEX_DELTA_HDR, h)
+            if magic != INDEX_DELTA_MAGIC:
+                break
+            data = f.read(n * 16 + 4)
+            if (len(data) != n * 16 + 4 or
+                    unpack('>I', data[-4:])[0] !=
+                    zlib.crc32(h + data[:-4]) & 0xffffffff):
+                # A checkpoint that wasn't completely written
+                break
+            if end > pos:
+                deltas[start] = end, h, data
+
+    while pos in deltas:
+        end, h, data = deltas.pop(pos)
+        for i in range(0, len(data) - 4, 16):
+            index[data[i:i+8]] = u64(data[i+8:i+16])
+        pos = end
+
+    if unmerged is not None:
+        unmerged.extend(h + data
+                        for start, (end, h, data) in sorted(deltas.items())
+                        if start > pos)
+    return pos
+
+def remove_index_deltas(name):
+    try:
+        os.remove(name + '.index_delta')
+    except OSError:
+        pass
+
+
+class IndexCheckpointer(object):
+    """Save changes to a FileStorage index in the background
+
+    Index changes are accumulated as transactions are finished.  Each
+    time the data file has grown by the checkpoint interval, they're
+    appended to the storage's ``.index_delta`` file by a daemon thread.
+    When the delta file grows larger than the ``.index`` file, or if
+    there's a delta file when the storage is opened, the changes are
+    merged into the ``.index`` file.
+    """
+
+    checkpoints = merges = 0
+    closed = False
+
+    def __init__(self, name, index_class, pos, interval):
+        self.name = name
+        self.index_class = index_class
+        self.interval = interval
+        self.pos = pos # The end of the data covered by saved changes
+        self.changes = {}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="%s index checkpoints" % name)
+        self._thread.daemon = True
+        self._thread.start()
+        if os.path.exists(name + '.index_delta'):
+            # Changes saved after an incomplete checkpoint wouldn't
+            # be used.
+            self._queue.put((self._merge, ()))
+
+    def update(self, changes, pos):
+        """Note changes made by transactions ending at pos
+
+        This must be called by one thread at a time.
+        """
+        self.changes.update(changes)
+        if pos - self.pos >= self.interval and not self.closed:
+            self._queue.put((self._save, (self.pos, pos, self.changes)))
+            self.changes = {}
+            self.pos = pos
+
+    def flush(self):
+        """Wait until queued changes have been saved
+        """
+        if not self.closed:
+            self._queue.join()
+
+    def reset(self, pos):
+        """Forget saved and accumulated changes
+
+        This is called when an index valid for pos has been saved, or
+        when the data file has been replaced by a packed one.
+        """
+        self.flush()
+        remove_index_deltas(self.name)
+        self.changes = {}
+        self.pos = pos
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    break
+                func, args = task
+                func(*args)
+            except Exception:
+                logger.exception("Couldn't save index changes for %s",
+                                 self.name)
+            finally:
+                self._queue.task_done()
+
+    def _save(self, start, end, changes):
+        data = b''.join(oid + p64(changes[oid]) for oid in sorted(changes))
+        h = pack(INDEX_DELTA_HDR, INDEX_DELTA_MAGIC, start, end, len(changes))
+        with open(self.name + '.index_delta', 'ab') as f:
+            f.write(h)
+            f.write(data)
+            f.write(pack('>I', zlib.crc32(h + data) & 0xffffffff))
+            f.flush()
+            if fsync is not None:
+                fsync(f.fileno())
+        self.checkpoints += 1
+
+        index_name = self.name + '.index'
+        if (not os.path.exists(index_name) or
+                os.path.getsize(self.name + '.index_delta') >
+                os.path.getsize(index_name)):
+            self._merge()
+
+    def _merge(self):
+        # Merge the saved changes into the saved index.  This works
+        # with the saved files only, so it doesn't get in the way of
+        # the storage.
+        index_name = self.name + '.index'
+        if not os.path.exists(index_name):
+            # The changes are useless without an index to apply them to.
+            remove_index_deltas(self.name)
+            return
+        info = self.index_class.load(index_name)
+        index = info['index']
+        unmerged = []
+        pos = read_index_deltas(self.name, index, info['pos'], unmerged)
+        tmp_name = index_name + '.index_tmp'
+        index.save(pos, tmp_name)
+        del index, info
+        try:
+            os.remove(index_name)
+        except OSError:
+            pass
+        os.rename(tmp_name, index_name)
+        if unmerged:
+            # Keep the changes that may still be merged later.
+            delta_name = self.name + '.index_delta'
+            with open(delta_name + '_tmp', 'wb') as f:
+                f.writelines(unmerged)
+                f.flush()
+                if fsync is not None:
+                    fsync(f.fileno())
+            try:
+                os.remove(delta_name)
+            except OSError:
+                pass
+            os.rename(delta_name + '_tmp', delta_name)
+        else:
+            remove_index_deltas(self.name)
+        self.merges += 1
+
+
+TID_INDEX_MAGIC = b'FSTI'
+TID_INDEX_HDR = '>4sIQQQ'
+TID_INDEX_HDR_LEN = 32
+
+class TransactionIndex(object):
+    """A sparse index of transaction ids to file positions
+
+    An entry is kept for one in every interval transactions, so a
+    transaction can be found by bisecting the entries and reading at
+    most interval transaction headers.  The index covers the
+    transactions before ``pos``.  ``packed`` is the position of the
+    last transaction written by a pack, if any.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.tids = []
+        self.positions = []
+        self.pos = 4
+        self.packed = 0
+        self.count = 0
+
+    def empty(self):
+        """Return a new, empty index with the same interval
+        """
+        return self.__class__(self.interval)
+
+    def add(self, tid, status, pos, end):
+        """Add the transaction at pos, which ends at end
+
+        Transactions must be added in order.  Transactions that don't
+        start where the index ends are ignored.
+        """
+        if pos != self.pos:
+            return
+        if self.count % self.interval == 0:
+            self.tids.append(tid)
+            self.positions.append(pos)
+        if status == 'p':
+            self.packed = pos
+        self.count += 1
+        self.pos = end
+
+    def find(self, tid):
+        """Return the position of an indexed transaction not after tid
+
+        If tid is before all indexed transactions, the position of the
+        first transaction is returned.
+        """
+        i = bisect.bisect_right(self.tids, tid)
+        return self.positions[i - 1] if i else 4
+
+    def save(self, name):
+        tmp_name = name + '_tmp'
+        data = pack(TID_INDEX_HDR, TID_INDEX_MAGIC, self.interval,
+                    self.count, self.pos, self.packed) + b''.join(
+                        tid + p64(pos)
+                        for tid, pos in zip(self.tids, self.positions))
+        with open(tmp_name, 'wb') as f:
+            f.write(data)
+            f.write(pack('>I', zlib.crc32(data) & 0xffffffff))
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+        os.rename(tmp_name, name)
+
+    @classmethod
+    def load(cls, name):
+        """Load a saved index, returning None if it can't be read
+        """
+        try:
+            with open(name, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if len(data) < TID_INDEX_HDR_LEN:
+            return None
+        magic, interval, count, pos, packed = unpack(
+            TID_INDEX_HDR, data[:TID_INDEX_HDR_LEN])
+        n = (count + interval - 1) // interval if interval else -1
+        if (magic != TID_INDEX_MAGIC or
+                len(data) != TID_INDEX_HDR_LEN + n * 16 + 4 or
+                unpack('>I', data[-4:])[0] !=
+                zlib.crc32(data[:-4]) & 0xffffffff):
+            return None
+        self = cls(interval)
+        self.count = count
+        self.pos = pos
+        self.packed = packed
+        for i in range(TID_INDEX_HDR_LEN, len(data) - 4, 16):
+            self.tids.append(data[i:i+8])
+            self.positions.append(u64(data[i+8:i+16]))
+        return self
+
+
+class RevisionIndex(object):
+    """The revisions of objects with long revision chains
+
+    For each indexed object, the transaction ids and positions of its
+    data records are kept, oldest first, along with the position of
+    the current record when they were read.  Objects are indexed when
+    more than ``threshold`` records are read to find a revision.  The
+    total number of revisions kept is bounded by ``size``; the least
+    recently used objects are forgotten first.  Only the newest
+    ``size`` revisions of objects with more are kept, and older
+    revisions are found by following the chain from the oldest kept.
+
+    Revisions read before the index was last cleared, because the
+    file was packed, aren't added.  Readers note the index's
+    generation before they read and pass it to ``set``.
+    """
+
+    threshold = 10
+    hits = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.revisions = 0
+        self.generation = 0
+        self._lock = utils.Lock()
+        # {oid -> (current pos, tids, positions)}
+        self._entries = collections.OrderedDict()
+
+    def get(self, oid):
+        with self._lock:
+            entry = self._entries.get(oid)
+            if entry is not None:
+                self._entries[oid] = self._entries.pop(oid)
+                self.hits += 1
+            return entry
+
+    def set(self, oid, pos, tids, positions, generation):
+        if len(tids) > self.size:
+            tids = tids[-self.size:]
+            positions = positions[-self.size:]
+        with self._lock:
+            if generation != self.generation:
+                return
+            entries = self._entries
+            old = entries.pop(oid, None)
+            if old is not None:
+                self.revisions -= len(old[1])
+            entries[oid] = pos, tids, positions
+            self.revisions += len(tids)
+            while self.revisions > self.size:
+                self.revisions -= len(entries.popitem(False)[1][1])
+
+    def discard(self, oid):
+        with self._lock:
+            old = self._entries.pop(oid, None)
+            if old is not None:
+                self.revisions -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.revisions = 0
+
+    def statistics(self):
+        with self._lock:
+            return dict(
+                objects=len(self._entries),
+                revisions=self.revisions,
+                size=self.size,
+                hits=self.hits,
+                )
+
+
+class MappedFile(object):
+    """Read-only memory map of a data file
+
+    Records are read through cheap, single-threaded readers created
+    for each load, so loads don't need to check file objects out of
+    a pool.  The map is replaced by a larger one when a reader needs
+    data beyond its end, as happens after transactions are committed.
+    Replaced maps are left for readers still using them, and are
+    closed when the file is.
+    """
+
+    closed = False
+
+    def __init__(self, file_name, index):
+        self.name = file_name
+        self.index = index
+        self._file = None
+        self._view = memoryview(b'')
+        self._maps = []
+        self._lock = utils.Lock()
+
+    def view(self, size):
+        """Return a view of the file that's at least size bytes, if possible
+        """
+        view = self._view
+        if len(view) < size:
+            with self._lock:
+                view = self._view
+                if len(view) < size:
+                    if self.closed:
+                        raise ValueError('closed')
+                    if self._file is None:
+                        self._file = open(self.name, 'rb')
+                    fileno = self._file.fileno()
+                    length = os.fstat(fileno).st_size
+                    if length > len(view):
+                        m = mmap.mmap(fileno, length, access=mmap.ACCESS_READ)
+                        self._maps.append(m)
+                        view = self._view = memoryview(m)
+        return view
+
+    def reader(self):
+        return MappedFileReader(self)
+
+    def close(self):
+        """Close the file and its maps
+
+        Maps that are still being read from can't be closed, and are
+        released when their readers are done with them.
+        """
+        with self._lock:
+            self.closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._view = memoryview(b'')
+            maps, self._maps = self._maps, []
+            for m in maps:
+                try:
+                    m.close()
+                except BufferError:
+                    pass # Exported to a reader.
+
+
+class MappedFileReader(object):
+    """File-like reader of a MappedFile
+
+    Reads return copies of the mapped data, so they don't keep the
+    map from being released.
+    """
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+        self._pos = 0
+
+    def seek(self, pos, whence=0):
+        assert whence == 0
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size):
+        pos = self._pos
+        end = pos + size
+        data = self._mapped.view(end)[pos:end].tobytes()
+        self._pos = pos + len(data)
+        return data
+
+
+class Prefetcher(object):
+    """Read records ahead of time for FileStorage.prefetch
+
+    Requested records are read by a small number of daemon threads
+    and kept until they are loaded, or until the cache is full, in
+    which case the oldest records are discarded.  A record is removed
+    when it's loaded, as it's then cached by the connection that
+    loaded it.
+
+    Records are kept along with the range of transaction ids they're
+    valid for, so they can be used by loadBefore calls for any
+    transaction id in the range.  Current records are invalidated
+    when new revisions are committed.
+    """
+
+    hits = misses = 0
+    _closed = False
+
+    def __init__(self, storage, size=1000, threads=2):
+        self._storage = storage
+        self._size = size
+        self._lock = utils.Lock()
+        self._records = collections.OrderedDict() # {oid -> record}
+        self._queue = queue.Queue()
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(
+                target=self._run,
+                name="%s prefetch %s" % (storage.getName(), i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def prefetch(self, oids, tid):
+        self._queue.put((list(oids), tid))
+
+    def get(self, oid, tid):
+        """Return a prefetched loadBefore result, or None
+        """
+        with self._lock:
+            r = self._get(oid, tid)
+            if r is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                del self._records[oid]
+            return r
+
+    def _get(self, oid, tid):
+        r = self._records.get(oid)
+        if r is not None:
+            data, start, end = r
+            if start < tid and (end is None or tid <= end):
+                return r
+
+    def invalidate(self, oids, tid):
+        """Note that new revisions of the given objects were committed
+        """
+        with self._lock:
+            records = self._records
+            for oid in oids:
+                r = records.get(oid)
+                if r is not None and r[2] is None:
+                    records[oid] = r[0], r[1], tid
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def close(self):
+        self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.clear()
+
+    def _run(self):
+        storage = self._storage
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            oids, tid = request
+            for oid in oids:
+                if self._closed:
+                    break
+                with self._lock:
+                    if self._get(oid, tid) is not None:
+                        continue
+                try:
+                    with storage._files.get() as _file:
+                        pos = storage._index_get(oid, 0)
+                        if not pos:
+                            continue
+                        r = storage._loadBefore_impl(oid, pos, tid, _file)
+                except Exception:
+                    # The storage may have been closed, or the data
+                    # may have been packed away.  Leave it to
+                    # loadBefore to report the problem, if any.
+                    logger.debug("Couldn't prefetch %r", oid, exc_info=True)
+                    continue
+                if r is not None:
+                    self._add(oid, r, pos)
+
+    def _add(self, oid, r, pos):
+        with self._lock:
+            if r[2] is None and self._storage._index_get(oid, 0) != pos:
+                # A new revision was committed while we were reading.
+                return
+            records = self._records
+            records[oid] = r
+            while len(records) > self._size:
+                records.popitem(False)
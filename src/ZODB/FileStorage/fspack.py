@@ -29,8 +29,13 @@ from ZODB.FileStorage.format import FileStorageFormatter, CorruptedDataError
 from ZODB.utils import p64, u64, z64
 
 import binascii
+import collections
+import itertools
 import logging
+import multiprocessing
 import os
+import pickle
+import time
 import ZODB.fsIndex
 import ZODB.POSException
 
@@ -144,9 +149,17 @@ class PackCopier(FileStorageFormatter):
         finally:
             self._file.seek(pos)
 
+def _references(args):
+    # Return the references in many records, in a pool process
+    referencesf, records = args
+    return [referencesf(data) if data else [] for data in records]
+
 class GC(FileStorageFormatter):
 
-    def __init__(self, file, eof, packtime, gc, referencesf):
+    # The number of records whose references are extracted at once
+    batch_size = 1000
+
+    def __init__(self, file, eof, packtime, gc, referencesf, processes=0):
         self._file = file
         self._name = file.name
         self.eof = eof
@@ -174,6 +187,10 @@ class GC(FileStorageFormatter):
         self.ltid = z64
 
         self.referencesf = referencesf
+        # Number of processes used to extract references
+        self.processes = processes
+        self.pool = None
+        self.timings = {}
 
     def isReachable(self, oid, pos):
         """Return 1 if revision of `oid` at `pos` is reachable."""
@@ -186,13 +203,25 @@ class GC(FileStorageFormatter):
         return pos in self.reach_ex.get(oid, [])
 
     def findReachable(self):
+        start = time.time()
         self.buildPackIndex()
+        self.timings['index'] = time.time() - start
         if self.gc:
-            self.findReachableAtPacktime([z64])
-            self.findReachableFromFuture()
+            start = time.time()
+            if self.processes > 1 and self._picklable(self.referencesf):
+                self.pool = multiprocessing.Pool(self.processes)
+            try:
+                self.findReachableAtPacktime([z64])
+                self.findReachableFromFuture()
+            finally:
+                if self.pool is not None:
+                    self.pool.terminate()
+                    self.pool.join()
+                    self.pool = None
             # These mappings are no longer needed and may consume a lot of
             # space.
             del self.oid2curpos
+            self.timings['reachable'] = time.time() - start
         else:
             self.reachable = self.oid2curpos
 
@@ -253,29 +282,48 @@ class GC(FileStorageFormatter):
                 "The database has already been packed to a later time"
                 " or no changes have been made since the last pack")
 
+    def _picklable(self, referencesf):
+        # The references function is passed to the pool processes.
+        try:
+            pickle.dumps(referencesf)
+        except Exception:
+            logger.warning(
+                "References are extracted by the packing thread, because"
+                " %r can't be passed to other processes", referencesf)
+            return False
+        return True
+
     def findReachableAtPacktime(self, roots):
         """Mark all objects reachable from the oids in roots as reachable."""
         reachable = self.reachable
         oid2curpos = self.oid2curpos
 
-        todo = list(roots)
+        # We find the objects reachable in one step from the objects
+        # found in the previous step, so the records can be read in
+        # file order.
+        todo = roots
         while todo:
-            oid = todo.pop()
-            if oid in reachable:
-                continue
-
-            try:
-                pos = oid2curpos[oid]
-            except KeyError:
-                if oid == z64 and len(oid2curpos) == 0:
-                    # special case, pack to before creation time
+            positions = []
+            for oid in todo:
+                if oid in reachable:
                     continue
-                raise
 
-            reachable[oid] = pos
-            for oid in self.findrefs(pos):
-                if oid not in reachable:
-                    todo.append(oid)
+                try:
+                    pos = oid2curpos[oid]
+                except KeyError:
+                    if oid == z64 and len(oid2curpos) == 0:
+                        # special case, pack to before creation time
+                        continue
+                    raise
+
+                reachable[oid] = pos
+                positions.append(pos)
+
+            positions.sort()
+            todo = [oid
+                    for refs in self.findrefsMany(positions)
+                    for oid in refs
+                    if oid not in reachable]
 
     def findReachableFromFuture(self):
         # In this pass, the roots are positions of object revisions.
@@ -315,20 +363,54 @@ class GC(FileStorageFormatter):
                           tlen, th.tlen)
             pos += 8
 
-        for pos in extra_roots:
-            refs = self.findrefs(pos)
-            self.findReachableAtPacktime(refs)
+        extra_roots.sort()
+        self.findReachableAtPacktime([
+            oid for refs in self.findrefsMany(extra_roots) for oid in refs])
 
     def findrefs(self, pos):
         """Return a list of oids referenced as of packtime."""
+        data = self._read_refs_data(pos)
+        if data:
+            return self.referencesf(data)
+        else:
+            return []
+
+    def _read_refs_data(self, pos):
         dh = self._read_data_header(pos)
         # Chase backpointers until we get to the record with the refs
         while dh.back:
             dh = self._read_data_header(dh.back)
         if dh.plen:
-            return self.referencesf(self._file.read(dh.plen))
-        else:
-            return []
+            return self._file.read(dh.plen)
+
+    def findrefsMany(self, positions):
+        """Return lists of oids referenced by the records at positions
+
+        Records are read, and their references are extracted, in
+        batches.  If there's a process pool, the references are
+        extracted by the pool while more records are read.
+        """
+        size = self.batch_size
+        batches = ([self._read_refs_data(pos) for pos in positions[i:i+size]]
+                   for i in range(0, len(positions), size))
+        pool = self.pool
+        if pool is None:
+            for records in batches:
+                for refs in _references((self.referencesf, records)):
+                    yield refs
+            return
+
+        # Limit the number of batches read ahead.
+        pending = collections.deque(
+            pool.apply_async(_references, ((self.referencesf, records),))
+            for records in itertools.islice(batches, self.processes * 2))
+        while pending:
+            result = pending.popleft().get()
+            for records in itertools.islice(batches, 1):
+                pending.append(pool.apply_async(
+                    _references, ((self.referencesf, records),)))
+            for refs in result:
+                yield refs
 
 class FileStoragePacker(FileStorageFormatter):
 
@@ -338,15 +420,31 @@ class FileStoragePacker(FileStorageFormatter):
     # lives before that offset (there may be a checkpoint transaction in
     # progress after it).
 
-    def __init__(self, storage, referencesf, stop, gc=True):
+    # Transactions committed while packing are copied without the
+    # commit lock until fewer than this many bytes of them are left.
+    catch_up_size = 1 << 20
+    # The maximum number of times we try to catch up, in case
+    # transactions are committed faster than we copy them.
+    catch_up_rounds = 10
+
+    def __init__(self, storage, referencesf, stop, gc=True,
+                 blob_records=None):
         self._storage = storage
         if storage.blob_dir:
             self.pack_blobs = True
+            self.is_blob_record = storage.is_blob_record
             self.blob_removed = open(
                 os.path.join(storage.blob_dir, '.removed'), 'wb')
         else:
             self.pack_blobs = False
             self.blob_removed = None
+        # If given, blob_records is a function to check whether record
+        # data are for blobs and a list to add the (oid, tid) pairs of
+        # removed blob records to.
+        self.blob_records = None
+        if blob_records is not None:
+            self.pack_blobs = True
+            self.is_blob_record, self.blob_records = blob_records
 
         path = storage._file.name
         self._name = path
@@ -360,7 +458,10 @@ class FileStoragePacker(FileStorageFormatter):
         self.locked = False
         self.file_end = storage.getSize()
 
-        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf)
+        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf,
+                     storage._pack_processes)
+        # {phase -> seconds}
+        self.timings = {}
 
         # The packer needs to acquire the parent's commit lock
         # during the copying stage, so the two sets of lock acquire
@@ -373,7 +474,7 @@ class FileStoragePacker(FileStorageFormatter):
         # tindex: oid -> pos, for current txn
         # oid2tid: not used by the packer
 
-        self.index = ZODB.fsIndex.fsIndex()
+        self.index = storage._newIndexes()[0]
         self.tindex = {}
         self.oid2tid = {}
         self.toid2tid = {}
@@ -381,6 +482,11 @@ class FileStoragePacker(FileStorageFormatter):
 
         self._tfile = None
 
+        # An index of the transactions written, if the storage keeps
+        # one.
+        tid_index = getattr(storage, '_tid_index', None)
+        self.tid_index = None if tid_index is None else tid_index.empty()
+
     def close(self):
         self._file.close()
         if self._tfile is not None:
@@ -403,6 +509,7 @@ class FileStoragePacker(FileStorageFormatter):
         # TODO:  Should add sanity checking to pack.
 
         self.gc.findReachable()
+        self.timings.update(self.gc.timings)
 
         def close_files_remove():
             # blank except: we might be in an IOError situation/handler
@@ -431,7 +538,9 @@ class FileStoragePacker(FileStorageFormatter):
 
             self._copier = PackCopier(self._tfile, self.index, self.tindex)
 
+            start = time.time()
             ipos, opos = self.copyToPacktime()
+            self.timings['copy'] = time.time() - start
         except (OSError, IOError):
             # most probably ran out of disk space or some other IO error
             close_files_remove()
@@ -442,8 +551,18 @@ class FileStoragePacker(FileStorageFormatter):
             # pack didn't free any data.  there's no point in continuing.
             close_files_remove()
             return None
+
+        try:
+            start = time.time()
+            ipos = self.copyCommitted(ipos)
+            self.timings['catch_up'] = time.time() - start
+        except (OSError, IOError):
+            close_files_remove()
+            raise
+
         self._commit_lock.acquire()
         self.locked = True
+        locked = time.time()
         try:
             with self._lock:
                 # Re-open the file in unbuffered mode.
@@ -476,6 +595,7 @@ class FileStoragePacker(FileStorageFormatter):
             if self.blob_removed is not None:
                 self.blob_removed.close()
 
+            self.timings['locked'] = time.time() - locked
             return pos
         except (OSError, IOError):
             # most probably ran out of disk space or some other IO error
@@ -505,7 +625,8 @@ class FileStoragePacker(FileStorageFormatter):
                 self._tfile.write(p64(tlen))
                 self._tfile.seek(new_pos - 8)
                 self._tfile.write(p64(tlen))
-
+                if self.tid_index is not None:
+                    self.tid_index.add(th.tid, 'p', new_tpos, new_pos)
 
             tlen = self._read_num(pos)
             if tlen != th.tlen:
@@ -532,29 +653,7 @@ class FileStoragePacker(FileStorageFormatter):
             h = self._read_data_header(pos)
             if not self.gc.isReachable(h.oid, pos):
                 if self.pack_blobs:
-                    # We need to find out if this is a blob, so get the data:
-                    if h.plen:
-                        data = self._file.read(h.plen)
-                    else:
-                        data = self.fetchDataViaBackpointer(h.oid, h.back)
-                    if data and self._storage.is_blob_record(data):
-                        # We need to remove the blob record. Maybe we
-                        # need to remove oid:
-
-                        # But first, we need to make sure the record
-                        # we're looking at isn't a dup of the current
-                        # record. There's a bug in ZEO blob support that causes
-                        # duplicate data records.
-                        rpos = self.gc.reachable.get(h.oid)
-                        is_dup = (rpos
-                                  and self._read_data_header(rpos).tid == h.tid)
-                        if not is_dup:
-                            if h.oid not in self.gc.reachable:
-                                self.blob_removed.write(
-                                    binascii.hexlify(h.oid)+b'\n')
-                            else:
-                                self.blob_removed.write(
-                                    binascii.hexlify(h.oid+h.tid)+b'\n')
+                    self.removeBlobRecord(h)
 
                 pos += h.recordlen()
                 continue
@@ -582,6 +681,58 @@ class FileStoragePacker(FileStorageFormatter):
 
         return new_tpos, pos
 
+    def removeBlobRecord(self, h):
+        """Note the removal of a data record, if it's for a blob
+
+        The data record's header, h, must have just been read.
+        """
+        # We need to find out if this is a blob, so get the data:
+        if h.plen:
+            data = self._file.read(h.plen)
+        else:
+            data = self.fetchDataViaBackpointer(h.oid, h.back)
+        if data and self.is_blob_record(data):
+            # We need to remove the blob record. Maybe we
+            # need to remove oid:
+
+            # But first, we need to make sure the record
+            # we're looking at isn't a dup of the current
+            # record. There's a bug in ZEO blob support that causes
+            # duplicate data records.
+            rpos = self.gc.reachable.get(h.oid)
+            is_dup = (rpos
+                      and self._read_data_header(rpos).tid == h.tid)
+            if not is_dup:
+                if self.blob_removed is not None:
+                    if h.oid not in self.gc.reachable:
+                        self.blob_removed.write(
+                            binascii.hexlify(h.oid)+b'\n')
+                    else:
+                        self.blob_removed.write(
+                            binascii.hexlify(h.oid+h.tid)+b'\n')
+                if self.blob_records is not None:
+                    self.blob_records.append((h.oid, h.tid))
+
+    def preview(self):
+        """Find the blob records that packing would remove, without packing
+
+        The records are noted as they would be by pack, but no
+        packed file is written.
+        """
+        self.gc.findReachable()
+        self.timings.update(self.gc.timings)
+        pos = self._metadata_size
+        while pos < self.gc.packpos:
+            th = self._read_txn_header(pos)
+            tend = pos + th.tlen
+            pos += th.headerlen()
+            while pos < tend:
+                h = self._read_data_header(pos)
+                if self.pack_blobs and not self.gc.isReachable(h.oid, pos):
+                    self.removeBlobRecord(h)
+                pos += h.recordlen()
+            pos += 8
+
     def fetchDataViaBackpointer(self, oid, back):
         """Return the data for oid via backpointer back
 
@@ -613,6 +764,26 @@ class FileStoragePacker(FileStorageFormatter):
             # This is a George Bailey event.
             self._tfile.write(z64)
 
+    def copyCommitted(self, ipos):
+        """Copy transactions committed since packing started
+
+        Transactions before the storage's current position are
+        complete, so they're copied without the commit lock, leaving
+        little to be copied with it.  Returns the input position of
+        the first transaction not copied.
+        """
+        # Read unbuffered, for the reason given in pack.
+        self._file.close()
+        self._file = open(self._path, "rb", 0)
+        for i in range(self.catch_up_rounds):
+            with self._lock:
+                end = self._storage._pos
+            if end - ipos < self.catch_up_size:
+                break
+            while ipos < end:
+                ipos = self.copyTransaction(ipos)
+        return ipos
+
     def copyRest(self, ipos):
         # After the pack time, all data records are copied.
         # Copy one txn at a time, using copy() for data.
@@ -636,6 +807,16 @@ class FileStoragePacker(FileStorageFormatter):
         # Release commit lock while writing to pack file
         self._commit_lock.release()
         self.locked = False
+        ipos = self.copyTransaction(ipos, th)
+        self._commit_lock.acquire()
+        self.locked = True
+        return ipos
+
+    def copyTransaction(self, ipos, th=None):
+        """Copy the transaction at ipos, returning the next input position
+        """
+        if th is None:
+            th = self._read_txn_header(ipos)
         pos = self._tfile.tell()
         self._copier.setTxnPos(pos)
         self._tfile.write(th.asString())
@@ -660,9 +841,9 @@ class FileStoragePacker(FileStorageFormatter):
         assert tlen == th.tlen
         self._tfile.write(p64(tlen))
         ipos += 8
+        if self.tid_index is not None:
+            self.tid_index.add(th.tid, th.status, pos, pos + tlen + 8)
 
         self.index.update(self.tindex)
         self.tindex.clear()
-        self._commit_lock.acquire()
-        self.locked = True
         return ipos
@@ -15,6 +15,8 @@
 """
 
 import binascii
+import errno
+import hashlib
 import logging
 import os
 import re
@@ -22,12 +24,16 @@ import shutil
 import stat
 import sys
 import tempfile
+import time
 import weakref
+from timeit import default_timer
 
 import zope.interface
 import persistent
+from persistent.TimeStamp import TimeStamp
 
 import ZODB.interfaces
+import ZODB.metrics
 from ZODB.interfaces import BlobError
 from ZODB import utils
 from ZODB.POSException import POSKeyError
@@ -49,6 +55,8 @@ BLOB_SUFFIX = ".blob"
 SAVEPOINT_SUFFIX = ".spb"
 
 LAYOUT_MARKER = '.layout'
+MANIFEST = '.manifest'
+CONTENT_DIR = '.content'
 LAYOUTS = {}
 
 valid_modes = 'r', 'w', 'r+', 'a', 'c'
@@ -193,7 +201,7 @@ class Blob(persistent.Persistent):
                     result = BlobFile(self._p_blob_uncommitted, mode, self)
                     if self._p_blob_committed:
                         with open(self._p_blob_committed, 'rb') as fp:
-                            utils.cp(fp, result)
+                            utils.fastcp(fp, result)
                         if mode == 'r+':
                             result.seek(0)
                 else:
@@ -212,6 +220,20 @@ class Blob(persistent.Persistent):
 
         return result
 
+    def pin(self):
+        """Return a PinnedBlobFile for the committed data
+        """
+        if (self._p_blob_uncommitted
+            or
+            not self._p_blob_committed
+            or
+            self._p_blob_committed.endswith(SAVEPOINT_SUFFIX)
+            ):
+            raise BlobError('Uncommitted changes')
+        storage = self._p_jar._storage
+        return PinnedBlobFile(storage.loadBlob(self._p_oid, self._p_serial),
+                              storage.temporaryDirectory())
+
     def committed(self):
         if (self._p_blob_uncommitted
             or
@@ -338,6 +360,83 @@ class BlobFile(file):
         self.blob.closed(self)
         super(BlobFile, self).close()
 
+class PinnedBlobFile(object):
+    """A committed blob file pinned for direct access
+
+    The committed file is linked (or, where links aren't supported,
+    copied) into the storage's temporary directory, so that `name`
+    stays valid, with the same data, until the pinned file is closed,
+    even if packing removes the committed file.  The file is open for
+    reading, and `fileno` can be passed to ``os.sendfile`` or
+    ``mmap``.  Ranges are read without using a file position, so
+    pinned files can be shared by threads.
+
+    """
+
+    _file = None
+
+    def __init__(self, filename, temp_dir):
+        fd, name = tempfile.mkstemp(suffix='.pin', dir=temp_dir)
+        os.close(fd)
+        os.remove(name)
+        try:
+            os.link(filename, name)
+        except (AttributeError, OSError) as v:
+            if getattr(v, 'errno', None) == errno.ENOENT:
+                raise POSKeyError("No blob file at %s" % filename)
+            # Links aren't supported.
+            shutil.copyfile(filename, name)
+        self.name = name
+        self._file = open(name, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._lock = utils.Lock()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def fileno(self):
+        if self._file is None:
+            raise ValueError("I/O operation on closed file")
+        return self._file.fileno()
+
+    def read(self, offset=0, size=-1):
+        """Read size bytes starting at offset, or to the end if size
+        is negative
+        """
+        fd = self.fileno()
+        if size < 0 or offset + size > self.size:
+            size = max(self.size - offset, 0)
+        pread = getattr(os, 'pread', None)
+        if pread is None:
+            with self._lock:
+                self._file.seek(offset)
+                return self._file.read(size)
+        chunks = []
+        while size > 0:
+            data = pread(fd, size, offset)
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            remove_committed(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
 _pid = str(os.getpid())
 
 def log(msg, level=logging.INFO, subsys=_pid, exc_info=False):
@@ -354,7 +453,7 @@ class FilesystemHelper(object):
 
     def __init__(self, base_dir, layout_name='automatic'):
         self.base_dir = os.path.abspath(base_dir) + os.path.sep
-        self.temp_dir = os.path.join(base_dir, 'tmp')
+        self.temp_dir = os.path.join(self.base_dir, 'tmp')
 
         if layout_name == 'automatic':
             layout_name = auto_layout_select(base_dir)
@@ -364,6 +463,10 @@ class FilesystemHelper(object):
                 'migrating to the `bushy` layout.', level=logging.WARN)
         self.layout_name = layout_name
         self.layout = LAYOUTS[layout_name]
+        if self.layout.content_addressed and not hasattr(os, 'link'):
+            raise ValueError(
+                "The `%s` blob directory layout requires hard links"
+                % layout_name)
 
     def create(self):
         if not os.path.exists(self.base_dir):
@@ -435,6 +538,34 @@ class FilesystemHelper(object):
         path = path[len(self.base_dir):]
         return self.layout.path_to_oid(path)
 
+    def createPaths(self, paths):
+        """Create directories, with any missing parent directories
+
+        Checks for existing directories are shared by the paths, so
+        paths of many objects are created with few system calls.
+        Return a list of the directories created.
+        """
+        existing = set()
+        created = []
+        for path in sorted(set(paths)):
+            missing = []
+            while path not in existing and not os.path.isdir(path):
+                missing.append(path)
+                path = os.path.dirname(path)
+            existing.add(path)
+            for path in reversed(missing):
+                try:
+                    os.mkdir(path)
+                except OSError:
+                    # We might have lost a race.  If so, the directory
+                    # must exist now
+                    if not os.path.isdir(path):
+                        raise
+                else:
+                    created.append(path)
+                existing.add(path)
+        return created
+
     def createPathForOID(self, oid):
         """Given an OID, creates a directory on the filesystem where
         the blob data relating to that OID is stored, if it doesn't exist.
@@ -473,6 +604,154 @@ class FilesystemHelper(object):
                                     dir=oidpath)
         return fd, name
 
+    def getContentFilename(self, digest):
+        """Given the hex digest of blob content, return the filename
+        where the content is stored by content-addressed layouts.
+        """
+        return os.path.join(self.base_dir, CONTENT_DIR, digest[:2], digest)
+
+    def storeContent(self, filename, target, move=True):
+        """Make target a committed blob file with the content of filename,
+        stored once in the content store.
+
+        Target becomes a hard link to the stored content, which is
+        added from filename if it isn't stored yet.  If move is true,
+        filename is consumed, otherwise it's left in place.  The name
+        of the content file is returned.
+        """
+        content = self.getContentFilename(_content_digest(filename))
+        try:
+            os.link(content, target)
+        except OSError as v:
+            if v.errno == errno.ENOENT:
+                # The content isn't stored, or was collected by a
+                # concurrent pack.
+                self._addContent(filename, content, target, move)
+                return content
+            if v.errno != errno.EMLINK:
+                raise
+            # The content has too many links, so store a separate
+            # copy for this file.
+            if move:
+                rename_or_copy_blob(filename, target)
+            else:
+                with open(content, 'rb') as sf:
+                    with open(target, 'wb') as df:
+                        utils.fastcp(sf, df)
+                set_not_writable(target)
+            return content
+        if move:
+            remove_committed(filename)
+        return content
+
+    def _addContent(self, filename, content, target, move):
+        # Add content to the store from filename.  Target is made
+        # first, and the content is linked to it, so stored content
+        # always has a link and isn't collected by a concurrent pack,
+        # and a partially written file is never linked to.
+        if move:
+            rename_or_copy_blob(filename, target)
+        else:
+            with open(filename, 'rb') as sf:
+                with open(target, 'wb') as df:
+                    utils.fastcp(sf, df)
+            set_not_writable(target)
+        dirname = os.path.dirname(content)
+        while True:
+            if not os.path.exists(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # We might have lost a race.
+                    assert os.path.exists(dirname)
+            try:
+                os.link(target, content)
+            except OSError as v:
+                if v.errno == errno.ENOENT and not os.path.exists(dirname):
+                    # Removed by a concurrent collection.
+                    continue
+                # If the content was added concurrently, target keeps
+                # its own copy.
+                if v.errno != errno.EEXIST:
+                    raise
+            break
+
+    def getLinkedContent(self, filename):
+        """Return the name of the stored content a committed blob file
+        links to, or None if the file has no other links.
+
+        This is used to find the content that may no longer be linked
+        to once the file is removed, so it must be called before the
+        file is removed.
+        """
+        if os.stat(filename).st_nlink < 2:
+            return None
+        return self.getContentFilename(_content_digest(filename))
+
+    def collectContent(self, filenames=None):
+        """Remove stored content that no committed blob file links to
+
+        The number of links to a content file counts its references.
+        Content files are moved out of the store before they're
+        removed, and put back if they were linked to concurrently, so
+        collection needn't be serialized with commits.  If filenames
+        is given, only those content files are checked, rather than
+        every file in the store.
+        Return the number of content files removed and their size.
+        """
+        files = size = 0
+        content_dir = os.path.join(self.base_dir, CONTENT_DIR)
+        if filenames is None:
+            if not os.path.isdir(content_dir):
+                return files, size
+            filenames = [os.path.join(content_dir, name, digest)
+                         for name in sorted(os.listdir(content_dir))
+                         for digest in os.listdir(
+                             os.path.join(content_dir, name))]
+        else:
+            filenames = sorted(set(filenames))
+        for filename in filenames:
+            removed = self._collectContentFile(filename)
+            if removed is not None:
+                files += 1
+                size += removed
+        for path in sorted(set(os.path.dirname(filename)
+                               for filename in filenames)):
+            try:
+                if not os.listdir(path):
+                    os.rmdir(path)
+            except OSError:
+                pass # Already gone, or reused by a new file.
+        return files, size
+
+    def _collectContentFile(self, filename):
+        # Remove a content file if nothing links to it, returning
+        # its size, or None if it's kept.
+        try:
+            if os.stat(filename).st_nlink > 1:
+                return None
+            fd, collected = tempfile.mkstemp(
+                suffix='.tmp', dir=self.temp_dir)
+            os.close(fd)
+            os.remove(collected)
+            os.rename(filename, collected)
+        except OSError:
+            return None # Removed by a concurrent collection.
+        st = os.stat(collected)
+        if st.st_nlink > 1:
+            # Linked to since we checked.
+            try:
+                os.link(collected, filename)
+            except OSError as v:
+                # Unless added again since we moved it
+                if v.errno != errno.EEXIST:
+                    raise
+            removed = None
+        else:
+            removed = st.st_size
+        remove_committed(collected)
+        return removed
+
     def splitBlobFilename(self, filename):
         """Returns the oid and tid for a given blob filename.
 
@@ -489,11 +768,16 @@ class FilesystemHelper(object):
         serial = utils.repr_to_oid(serial)
         return oid, serial
 
+    # A BlobManifest of the blob files, if one is maintained.
+    manifest = None
+
     def getOIDsForSerial(self, search_serial):
         """Return all oids related to a particular tid that exist in
         blob data.
 
         """
+        if self.manifest is not None:
+            return self.manifest.oidsForSerial(search_serial)
         oids = []
         for oid, oidpath in self.listOIDs():
             for filename in os.listdir(oidpath):
@@ -507,10 +791,21 @@ class FilesystemHelper(object):
         """Iterates over all paths under the base directory that contain blob
         files.
         """
+        if self.manifest is not None:
+            for oid in self.manifest.oids():
+                yield oid, self.getPathForOID(oid)
+        else:
+            for item in self.walkOIDs():
+                yield item
+
+    def walkOIDs(self):
+        """Like listOIDs, but always walks the base directory
+        """
         for path, dirs, files in os.walk(self.base_dir):
             # Make sure we traverse in a stable order. This is mainly to make
-            # testing predictable.
-            dirs.sort()
+            # testing predictable.  Hidden directories, like the content
+            # store, don't hold objects' blob files.
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
             files.sort()
             try:
                 oid = self.getOIDForPath(path)
@@ -519,8 +814,367 @@ class FilesystemHelper(object):
             yield oid, path
 
 
+def _content_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1 << 16)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _manifest_line(oid, tid=None, size=None):
+    fields = [binascii.hexlify(oid).decode('ascii')]
+    if tid is not None:
+        fields.append(binascii.hexlify(tid).decode('ascii'))
+    fields.append('-' if size is None else str(size))
+    return (' '.join(fields) + '\n').encode('ascii')
+
+
+def _manifest_tid_line(tid):
+    return b'tid ' + binascii.hexlify(tid) + b'\n'
+
+
+class BlobManifest(object):
+    """An index of the committed blob files of a blob directory
+
+    The index is kept in an append-only file in the blob directory,
+    with a line for each blob file added, giving its oid, tid and size,
+    or removed.  Paths aren't recorded, as they're computed from oids
+    and tids by the directory layout.  The file is read when the
+    manifest is first queried.
+
+    The file also records the last transaction whose blob files are
+    recorded in it, after the files of each transaction, and when the
+    storage is closed.  If, when the storage is opened, the file
+    doesn't end with a transaction at least as recent as the
+    storage's last transaction, because the process was stopped
+    between committing a transaction and recording it, or the blob
+    directory was used by a version without manifests, the manifest
+    is out of date.
+
+    If the file doesn't exist, can't be read, or is out of date, the
+    manifest is rebuilt by walking the blob directory.
+
+    Storages using the same blob directory in a process share its
+    manifest, which they get with ``open``.  When the file is
+    compacted, it's read again first if it was appended to by another
+    process since it was read.
+    """
+
+    # Rewrite the file when it has this many more lines than entries.
+    compact_threshold = 10000
+
+    # {path -> manifest} of manifests in use
+    _open = weakref.WeakValueDictionary()
+    _open_lock = utils.Lock()
+    _open_path = None
+    _users = 0
+
+    @classmethod
+    def open(cls, fshelper, tid=None):
+        """Return the manifest of a blob directory, for a storage whose
+        last transaction is tid
+
+        Each call should be matched by a call to ``close``.
+        """
+        path = os.path.realpath(os.path.join(fshelper.base_dir, MANIFEST))
+        with cls._open_lock:
+            manifest = cls._open.get(path)
+            if manifest is None:
+                manifest = cls(fshelper, tid)
+                manifest._open_path = path
+                cls._open[path] = manifest
+            manifest._users += 1
+            return manifest
+
+    def __init__(self, fshelper, tid=None):
+        self.fshelper = fshelper
+        self.path = os.path.join(fshelper.base_dir, MANIFEST)
+        self._lock = utils.Lock()
+        self._oids = None # {oid -> {tid -> size}}, once read
+        self._tids = None # {tid -> {oid}}
+        self._entries = self._lines = 0
+        # The size of the file as of when we last read, wrote or
+        # appended to it, once read.
+        self._size = None
+        # The last transaction known to be recorded, and the
+        # transaction recorded at the end of the file, if any.
+        self._last_tid = self._file_tid = tid or utils.z64
+        self._complete = True
+        if not os.path.exists(self.path):
+            base_dir = fshelper.base_dir
+            temp_dir = os.path.basename(fshelper.temp_dir)
+            if not [name for name in os.listdir(base_dir)
+                    if not name.startswith('.') and name != temp_dir]:
+                # A new blob directory.
+                with open(self.path, 'wb') as f:
+                    f.write(_manifest_tid_line(self._last_tid))
+        elif tid is not None:
+            self._file_tid = self._read_tid()
+            if self._file_tid is not None and self._file_tid < tid:
+                logger.info("Rebuilding out-of-date blob manifest %s",
+                            self.path)
+                self._complete = False
+        # Until the file exists and is up to date, changes aren't
+        # written, as the manifest will be rebuilt from the blob
+        # directory.
+        self._complete = self._complete and os.path.exists(self.path)
+
+    def _read_tid(self):
+        # Return the transaction recorded at the end of the file, z64
+        # if it doesn't end with one, or None if its end can't be read,
+        # in which case it's rebuilt when it's read.
+        with open(self.path, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(f.tell() - 64, 0))
+            lines = f.read().split(b'\n')
+        if len(lines) < 2:
+            return utils.z64
+        if lines[-1]:
+            return None
+        fields = lines[-2].split()
+        if len(fields) != 2 or fields[0] != b'tid':
+            return utils.z64
+        try:
+            tid = binascii.unhexlify(fields[1])
+        except (TypeError, binascii.Error):
+            return None
+        return tid if len(tid) == 8 else None
+
+    def _append(self, lines):
+        # Return whether the lines were written.
+        if not self._complete or not lines:
+            return False
+        data = b''.join(lines)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self._lines += len(lines)
+        if self._size is not None:
+            self._size += len(data)
+        return True
+
+    def _add(self, oid, tid, size):
+        tids = self._oids.setdefault(oid, {})
+        if tid not in tids:
+            self._entries += 1
+        tids[tid] = size
+        self._tids.setdefault(tid, set()).add(oid)
+
+    def _remove(self, oid, tid):
+        tids = self._oids.get(oid)
+        if tids is not None and tids.pop(tid, None) is not None:
+            self._entries -= 1
+            if not tids:
+                del self._oids[oid]
+            oids = self._tids[tid]
+            oids.discard(oid)
+            if not oids:
+                del self._tids[tid]
+
+    def _load(self):
+        # Read the file, or rebuild it, if we haven't yet.
+        if self._oids is not None:
+            return
+        if self._complete:
+            self._oids = {}
+            self._tids = {}
+            self._entries = self._lines = 0
+            try:
+                with open(self.path, 'rb') as f:
+                    for line in f:
+                        self._read(line)
+                        self._lines += 1
+                    self._size = f.tell()
+                return
+            except (ValueError, TypeError, binascii.Error):
+                logger.warning("Rebuilding corrupted blob manifest %s",
+                               self.path)
+        self._rebuild()
+
+    def _read(self, line):
+        if not line.endswith(b'\n'):
+            raise ValueError(line)
+        fields = line.split()
+        if fields[0] == b'tid':
+            if len(fields) != 2 or len(binascii.unhexlify(fields[1])) != 8:
+                raise ValueError(line)
+            return
+        oid = binascii.unhexlify(fields[0])
+        if len(fields) == 2 and fields[1] == b'-':
+            tids = self._oids.pop(oid, ())
+            self._entries -= len(tids)
+            for tid in tids:
+                oids = self._tids[tid]
+                oids.discard(oid)
+                if not oids:
+                    del self._tids[tid]
+        elif len(fields) != 3:
+            raise ValueError(line)
+        elif fields[2] == b'-':
+            self._remove(oid, binascii.unhexlify(fields[1]))
+        else:
+            self._add(oid, binascii.unhexlify(fields[1]), int(fields[2]))
+
+    def _rebuild(self):
+        self._oids = {}
+        self._tids = {}
+        self._entries = 0
+        fshelper = self.fshelper
+        for oid, path in fshelper.walkOIDs():
+            for name in os.listdir(path):
+                if name.endswith(BLOB_SUFFIX):
+                    tid = utils.repr_to_oid(name[:-len(BLOB_SUFFIX)])
+                    size = os.stat(os.path.join(path, name)).st_size
+                    self._add(oid, tid, size)
+        self._write()
+
+    def _write(self):
+        # Replace the file with one with the current entries.
+        lines = [_manifest_line(oid, tid, size)
+                 for oid, tids in sorted(self._oids.items())
+                 for tid, size in sorted(tids.items())]
+        lines.append(_manifest_tid_line(self._last_tid))
+        data = b''.join(lines)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+        self._lines = len(lines)
+        self._size = len(data)
+        self._file_tid = self._last_tid
+        self._complete = True
+
+    def add(self, revisions, tid):
+        """Record the blob files added by a transaction
+
+        The files are given as (oid, tid, size) tuples.  The lines
+        for the files are followed by one recording the transaction.
+        Return whether the file was written to, which it isn't while
+        the manifest is to be rebuilt.
+        """
+        with self._lock:
+            lines = []
+            for oid, serial, size in revisions:
+                if self._oids is not None:
+                    self._add(oid, serial, size)
+                lines.append(_manifest_line(oid, serial, size))
+            lines.append(_manifest_tid_line(tid))
+            self._last_tid = max(self._last_tid, tid)
+            self._file_tid = tid
+            return self._append(lines)
+
+    def remove(self, revisions):
+        """Record blob files removed, given (oid, tid) tuples
+        """
+        with self._lock:
+            lines = []
+            for oid, tid in revisions:
+                if self._oids is not None:
+                    self._remove(oid, tid)
+                lines.append(_manifest_line(oid, tid))
+            self._append(lines)
+            self._file_tid = None
+            self._maybe_compact()
+
+    def removeOIDs(self, oids):
+        """Record all of the blob files of the given objects removed
+        """
+        with self._lock:
+            lines = []
+            for oid in oids:
+                if self._oids is not None:
+                    for tid in list(self._oids.get(oid, ())):
+                        self._remove(oid, tid)
+                lines.append(_manifest_line(oid))
+            self._append(lines)
+            self._file_tid = None
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if (self._oids is not None and
+            self._lines - self._entries > self.compact_threshold):
+            self._compact()
+
+    def _compact(self):
+        # Rewrite the file, reading it again first if it was appended
+        # to since we read it, so the lines added aren't lost.
+        if self._size != os.path.getsize(self.path):
+            self._oids = None
+            self._load()
+        self._write()
+
+    def close(self, tid):
+        """Record that the blob files of transactions up to tid are
+        recorded, when a storage using the manifest is closed
+        """
+        with self._lock:
+            self._last_tid = max(self._last_tid, tid)
+            if self._file_tid != self._last_tid:
+                self._append([_manifest_tid_line(self._last_tid)])
+                self._file_tid = self._last_tid
+        with self._open_lock:
+            self._users -= 1
+            if (self._users <= 0 and
+                    self._open.get(self._open_path) is self):
+                del self._open[self._open_path]
+
+    def rebuild(self):
+        """Rebuild the manifest by walking the blob directory
+        """
+        with self._lock:
+            self._rebuild()
+
+    def compact(self):
+        """Rewrite the file without the lines of removed blob files
+        """
+        with self._lock:
+            self._load()
+            if self._lines > self._entries:
+                self._compact()
+
+    def oids(self):
+        """Return a sorted list of the oids of objects with blob files
+        """
+        with self._lock:
+            self._load()
+            return sorted(self._oids)
+
+    def tids(self, oid):
+        """Return a sorted list of the tids of an object's blob files
+        """
+        with self._lock:
+            self._load()
+            return sorted(self._oids.get(oid, ()))
+
+    def oidsForSerial(self, tid):
+        """Return a sorted list of the oids of a transaction's blob files
+        """
+        with self._lock:
+            self._load()
+            return sorted(self._tids.get(tid, ()))
+
+    def items(self):
+        """Return a sorted list of (oid, tid, size) of all blob files
+        """
+        with self._lock:
+            self._load()
+            return [(oid, tid, size)
+                    for oid, tids in sorted(self._oids.items())
+                    for tid, size in sorted(tids.items())]
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return self._entries
+
+
 class NoBlobsFileSystemHelper(object):
 
+    manifest = None
+
     @property
     def temp_dir(self):
         raise TypeError("Blobs are not supported")
@@ -573,6 +1227,9 @@ class BushyLayout(object):
     blob_path_pattern = re.compile(
         r'(0x[0-9a-f]{1,2}\%s){7,7}0x[0-9a-f]{1,2}$' % os.path.sep)
 
+    # Whether blob files are links to content stored once by hash.
+    content_addressed = False
+
     def oid_to_path(self, oid):
         # Create the bushy directory structure with the least significant byte
         # first
@@ -632,32 +1289,183 @@ class LawnLayout(BushyLayout):
 
 LAYOUTS['lawn'] = LawnLayout()
 
+class ContentLayout(BushyLayout):
+    """A bushy directory layout that stores blob content once.
+
+    Blob files have the same names as in the bushy layout, but are
+    hard links to files in a content store, named by the SHA-256 hash
+    of their content, so identical blobs share their disk space.  The
+    number of links to a content file counts its references, and
+    content files no longer referenced are removed when packing.
+
+    """
+
+    content_addressed = True
+
+LAYOUTS['content'] = ContentLayout()
+
 class BlobStorageMixin(object):
     """A mix-in to help storages support blobs."""
 
-    def _blob_init(self, blob_dir, layout='automatic'):
+    def _blob_init(self, blob_dir, layout='automatic', fsync=True):
         # XXX Log warning if storage is ClientStorage
         self.fshelper = FilesystemHelper(blob_dir, layout)
         self.fshelper.create()
+        self.fshelper.manifest = BlobManifest.open(
+            self.fshelper, self.lastTransaction())
         self.dirty_oids = []
+        # The number of dirty_oids recorded in the manifest.
+        self._blob_recorded = 0
+        # (oid, serial, filename) of blob files stored by the current
+        # transaction, to be put in place when it's voted.
+        self._blob_staged = []
+        self._blob_fsync = fsync and os.name == 'posix'
+
+        metrics = self.__dict__.get('metrics')
+        if metrics is None:
+            metrics = self.metrics = ZODB.metrics.Registry()
+        self._blob_store_seconds = metrics.histogram(
+            'zodb_blob_store_seconds',
+            "Time spent putting transactions' blob files in place")
+        self._blob_directories_seconds = metrics.histogram(
+            'zodb_blob_store_directories_seconds',
+            "Time spent creating transactions' blob directories")
+        self._blob_files_seconds = metrics.histogram(
+            'zodb_blob_store_files_seconds',
+            "Time spent moving transactions' blob files into place")
+        self._blob_sync_seconds = metrics.histogram(
+            'zodb_blob_store_sync_seconds',
+            "Time spent syncing transactions' blob files and directories")
+        self._blob_opens = metrics.counter(
+            'zodb_blob_opens_total', 'Committed blob files opened')
 
     def _blob_init_no_blobs(self):
         self.fshelper = NoBlobsFileSystemHelper()
         self.dirty_oids = []
+        self._blob_recorded = 0
+        self._blob_staged = []
+
+    _blob_closed = False
+
+    def _blob_close(self):
+        """Blob cleanup to be called from subclass close
+        """
+        # Storages can be closed more than once.
+        if self._blob_closed:
+            return
+        self._blob_closed = True
+        manifest = self.fshelper.manifest
+        if manifest is not None:
+            manifest.close(self.lastTransaction())
+
+    def _blob_tpc_vote(self):
+        """Put the transaction's blob files in place, to be called from
+        subclass tpc_vote
+
+        Files are moved into place in a batch: the directories for all
+        of the files are created first, sharing checks for existing
+        directories, then the files are moved and recorded in the blob
+        manifest, and then, unless disabled, the files, the
+        directories with new entries and the manifest are synced, so
+        the blob files and their manifest entries are durable before
+        the transaction is.  Recording the files costs a sync of the
+        manifest for each transaction with blob files.  The time
+        spent in each phase is recorded in metrics.
+        """
+        staged = self._blob_staged
+        if not staged and len(self.dirty_oids) == self._blob_recorded:
+            return
+        self._blob_staged = []
+        fshelper = self.fshelper
+        start = default_timer()
+
+        created = fshelper.createPaths(
+            fshelper.getPathForOID(oid) for oid, serial, name in staged)
+        directories_done = default_timer()
+
+        files = []
+        directories = set(os.path.dirname(path) for path in created)
+        try:
+            for oid, serial, filename in staged:
+                targetname = fshelper.getBlobFilename(oid, serial)
+                if fshelper.layout.content_addressed:
+                    content = fshelper.storeContent(filename, targetname)
+                    directories.add(os.path.dirname(content))
+                else:
+                    rename_or_copy_blob(filename, targetname)
+                files.append(targetname)
+                directories.add(os.path.dirname(targetname))
+        finally:
+            # Files not moved are removed when the transaction is
+            # aborted.
+            self._blob_staged = staged[len(files):]
+        manifest_path = self._blob_record()
+        files_done = default_timer()
+
+        if self._blob_fsync:
+            synced = files + sorted(directories)
+            if manifest_path is not None:
+                synced.append(manifest_path)
+            for path in synced:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        done = default_timer()
+
+        if self._blob_store_seconds is not None:
+            self._blob_store_seconds.observe(done - start)
+            self._blob_directories_seconds.observe(
+                directories_done - start)
+            self._blob_files_seconds.observe(files_done - directories_done)
+            self._blob_sync_seconds.observe(done - files_done)
+
+    def _blob_record(self):
+        # Record the transaction's blob files in the manifest before
+        # the transaction is committed, so they're recorded if it is.
+        # Return the manifest's path if it was written to.
+        dirty = self.dirty_oids[self._blob_recorded:]
+        manifest = self.fshelper.manifest
+        if not dirty or manifest is None:
+            return None
+        revisions = []
+        for oid, serial in dirty:
+            try:
+                size = os.stat(
+                    self.fshelper.getBlobFilename(oid, serial)).st_size
+            except OSError:
+                continue
+            revisions.append((oid, serial, size))
+        written = manifest.add(
+            revisions, max(serial for oid, serial in dirty))
+        self._blob_recorded = len(self.dirty_oids)
+        return manifest.path if written else None
 
     def _blob_tpc_abort(self):
         """Blob cleanup to be called from subclass tpc_abort
         """
+        while self._blob_staged:
+            oid, serial, filename = self._blob_staged.pop()
+            if os.path.exists(filename):
+                os.remove(filename)
+        recorded = self.dirty_oids[:self._blob_recorded]
+        self._blob_recorded = 0
         while self.dirty_oids:
             oid, serial = self.dirty_oids.pop()
             clean = self.fshelper.getBlobFilename(oid, serial)
             if os.path.exists(clean):
                 remove_committed(clean)
+        if recorded and self.fshelper.manifest is not None:
+            self.fshelper.manifest.remove(recorded)
 
     def _blob_tpc_finish(self):
         """Blob cleanup to be called from subclass tpc_finish
         """
+        # For subclasses not calling _blob_tpc_vote
+        self._blob_tpc_vote()
         self.dirty_oids = []
+        self._blob_recorded = 0
 
     def registerDB(self, db):
         self.__untransform_record_data = db.untransform_record_data
@@ -686,8 +1494,13 @@ class BlobStorageMixin(object):
             raise POSKeyError("No blob file at %s" % filename, oid, serial)
         return filename
 
+    _blob_store_seconds = _blob_opens = None
+    _blob_staged = ()
+
     def openCommittedBlobFile(self, oid, serial, blob=None):
         blob_filename = self.loadBlob(oid, serial)
+        if self._blob_opens is not None:
+            self._blob_opens.inc()
         if blob is None:
             return open(blob_filename, 'rb')
         else:
@@ -703,10 +1516,19 @@ class BlobStorageMixin(object):
         return self._tid
 
     def _blob_storeblob(self, oid, serial, blobfilename):
+        temp_dir = self.fshelper.temp_dir
+        blobfilename = os.path.abspath(blobfilename)
+        if os.path.dirname(blobfilename) != temp_dir:
+            # We own the file now, so move it where its previous owner
+            # won't remove it, like the directories of savepoints.
+            fd, staged = tempfile.mkstemp(suffix='.tmp', dir=temp_dir)
+            os.close(fd)
+            os.remove(staged)
+            rename_or_copy_blob(blobfilename, staged, chmod=False)
+            blobfilename = staged
         with self._lock:
-            self.fshelper.getPathForOID(oid, create=True)
-            targetname = self.fshelper.getBlobFilename(oid, serial)
-            rename_or_copy_blob(blobfilename, targetname)
+            # The file is put in place by _blob_tpc_vote.
+            self._blob_staged.append((oid, serial, blobfilename))
 
             # if oid already in there, something is really hosed.
             # The underlying storage should have complained anyway
@@ -729,11 +1551,20 @@ class BlobStorage(BlobStorageMixin):
     """
 
 
-    def __init__(self, base_directory, storage, layout='automatic'):
+    def __init__(self, base_directory, storage, layout='automatic',
+                 pack_threads=4, fsync=True):
         assert not ZODB.interfaces.IBlobStorage.providedBy(storage)
         self.__storage = storage
+        # The number of threads removing blob files when packing.
+        self.pack_threads = pack_threads
+
+        # Our own metrics, which include those of the wrapped storage.
+        self.metrics = ZODB.metrics.Registry()
+        storage_metrics = getattr(storage, 'metrics', None)
+        if isinstance(storage_metrics, ZODB.metrics.Registry):
+            self.metrics.include(storage_metrics)
 
-        self._blob_init(base_directory, layout)
+        self._blob_init(base_directory, layout, fsync)
         try:
             supportsUndo = storage.supportsUndo
         except AttributeError:
@@ -762,6 +1593,11 @@ class BlobStorage(BlobStorageMixin):
         return '<BlobStorage proxy for %r at %s>' % (normal_storage,
                                                      hex(id(self)))
 
+    def tpc_vote(self, *arg, **kw):
+        # Blob files are put in place before the base storage votes.
+        self._blob_tpc_vote()
+        return self.__storage.tpc_vote(*arg, **kw)
+
     def tpc_finish(self, *arg, **kw):
         # We need to override the base storage's tpc_finish instead of
         # providing a _finish method because methods found on the proxied
@@ -777,12 +1613,49 @@ class BlobStorage(BlobStorageMixin):
         self.__storage.tpc_abort(*arg, **kw)
         self._blob_tpc_abort()
 
+    def close(self):
+        self._blob_close()
+        self.__storage.close()
+
+    def _blobRevisions(self, stop=None):
+        # Return the (oid, tid) pairs of the blob records committed up
+        # to stop, according to the wrapped storage.  This is used for
+        # storages that can't report the records removed by packing.
+        revisions = set()
+        it = self.__storage.iterator(None, stop)
+        try:
+            for txn in it:
+                for record in txn:
+                    if self.is_blob_record(record.data):
+                        revisions.add((record.oid, record.tid))
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+        return revisions
+
+    def _currentBlobRevisions(self):
+        # Return the (oid, tid) pairs of current blob records.
+        current = {}
+        it = self.__storage.iterator()
+        try:
+            for txn in it:
+                for record in txn:
+                    current[record.oid] = (
+                        record.tid, self.is_blob_record(record.data))
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+        return set((oid, tid) for oid, (tid, blob) in current.items()
+                   if blob)
+
     def _packUndoing(self, packtime, referencesf):
         # Walk over all existing revisions of all blob files and check
         # if they are still needed by attempting to load the revision
         # of that object from the database.  This is maybe the slowest
         # possible way to do this, but it's safe.
-        for oid, oid_path in self.fshelper.listOIDs():
+        for oid, oid_path in self.fshelper.walkOIDs():
             files = os.listdir(oid_path)
             for filename in files:
                 filepath = os.path.join(oid_path, filename)
@@ -790,57 +1663,199 @@ class BlobStorage(BlobStorageMixin):
                 try:
                     self.loadSerial(oid, serial)
                 except POSKeyError:
-                    remove_committed(filepath)
-
-            if not os.listdir(oid_path):
-                shutil.rmtree(oid_path)
+                    yield filepath
 
     def _packNonUndoing(self, packtime, referencesf):
-        for oid, oid_path in self.fshelper.listOIDs():
+        for oid, oid_path in self.fshelper.walkOIDs():
             exists = True
             try:
                 utils.load_current(self, oid)
             except (POSKeyError, KeyError):
                 exists = False
 
+            files = sorted(os.listdir(oid_path))
             if exists:
-                files = os.listdir(oid_path)
-                files.sort()
-                latest = files[-1] # depends on ever-increasing tids
-                files.remove(latest)
-                for f in files:
-                    remove_committed(os.path.join(oid_path, f))
-            else:
-                remove_committed_dir(oid_path)
-                continue
+                files.pop() # depends on ever-increasing tids
+            for f in files:
+                yield os.path.join(oid_path, f)
+
+    def _removeBlobFiles(self, paths, dry_run):
+        # Remove blob files, using up to pack_threads threads, and
+        # then the object directories left empty.  Return statistics
+        # and, for content-addressed layouts, the content the removed
+        # files linked to.
+        stats = dict(files=0, bytes=0, directories=0, errors=0)
+        contents = set()
+        content_addressed = (self.fshelper.layout.content_addressed
+                             and not dry_run)
+
+        def remove(path):
+            try:
+                size = os.stat(path).st_size
+                if content_addressed:
+                    content = self.fshelper.getLinkedContent(path)
+                    if content is not None:
+                        contents.add(content)
+                if not dry_run:
+                    remove_committed(path)
+            except OSError:
+                logger.exception("Couldn't remove blob file %s", path)
+                return None
+            return size
 
-            if not os.listdir(oid_path):
-                shutil.rmtree(oid_path)
+        if self.pack_threads > 1 and len(paths) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.pack_threads, len(paths)))
+            try:
+                sizes = pool.map(remove, paths, 64)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            sizes = [remove(path) for path in paths]
 
-    def pack(self, packtime, referencesf):
-        """Remove all unused OID/TID combinations."""
+        for size in sizes:
+            if size is None:
+                stats['errors'] += 1
+            else:
+                stats['files'] += 1
+                stats['bytes'] += size
+
+        if not dry_run:
+            for oid_path in set(os.path.dirname(path) for path in paths):
+                try:
+                    if not os.listdir(oid_path):
+                        os.rmdir(oid_path)
+                        stats['directories'] += 1
+                except OSError:
+                    pass # Already gone, or reused by a new revision.
+
+        return stats, contents
+
+    def pack(self, packtime, referencesf, dry_run=False, walk=False):
+        """Remove all unused OID/TID combinations.
+
+        Blob files are removed for the blob records removed by packing
+        the wrapped storage, as reported by the storage's packer, if
+        it provides ``IBlobRecordPacking``, or else found by iterating
+        over the storage's records before and after packing it.  If
+        the storage doesn't support either, or if walk is true, the
+        blob directory is walked instead, checking every file against
+        the storage, which also finds files left by interrupted packs,
+        and the blob manifest is rebuilt.  With a content-addressed
+        layout, the stored content the removed files linked to is then
+        removed if nothing else links to it, or, when walking, any
+        stored content nothing links to.
+
+        If dry_run is true, neither the storage nor the blob files are
+        changed, and the files that packing would remove are counted
+        and listed in ``blobPackStatistics()``.  Dry runs are only
+        supported for storages providing ``IBlobRecordPacking``.
+        """
         with self._lock:
             if self._blobs_pack_is_in_progress:
                 raise BlobStorageError('Already packing')
             self._blobs_pack_is_in_progress = True
 
         try:
-            # Pack the underlying storage, which will allow us to determine
-            # which serials are current.
+            start = time.time()
             unproxied = self.__storage
-            result = unproxied.pack(packtime, referencesf)
-
-            # Perform a pack on the blob data.
-            if self.__supportsUndo:
-                self._packUndoing(packtime, referencesf)
+            reporting = ZODB.interfaces.IBlobRecordPacking.providedBy(
+                unproxied)
+            if dry_run and (walk or not reporting):
+                raise BlobStorageError(
+                    "Can't tell which blob files packing %r would remove"
+                    % unproxied)
+            if reporting and not walk:
+                result = None
+                removed = set(unproxied.packBlobRecords(
+                    packtime, referencesf, self.is_blob_record, dry_run))
+                mode = 'references'
+            elif walk or not hasattr(unproxied, 'iterator'):
+                # Pack the underlying storage, which will allow us to
+                # determine which serials are current.
+                result = unproxied.pack(packtime, referencesf)
+
+                # Perform a pack on the blob data.
+                if self.__supportsUndo:
+                    paths = self._packUndoing(packtime, referencesf)
+                else:
+                    paths = self._packNonUndoing(packtime, referencesf)
+                mode = 'walk'
+            else:
+                if self.__supportsUndo:
+                    # Only records committed before the pack time are
+                    # removed.
+                    stop = TimeStamp(
+                        *time.gmtime(packtime)[:5] + (packtime % 60, )
+                        ).raw()
+                    before = self._blobRevisions(stop)
+                    result = unproxied.pack(packtime, referencesf)
+                    removed = before - self._blobRevisions(stop)
+                else:
+                    # Only current records are kept.
+                    before = self._blobRevisions()
+                    result = unproxied.pack(packtime, referencesf)
+                    removed = before - self._currentBlobRevisions()
+                mode = 'iteration'
+
+            if mode == 'walk':
+                paths = list(paths)
             else:
-                self._packNonUndoing(packtime, referencesf)
+                getBlobFilename = self.fshelper.getBlobFilename
+                paths = [getBlobFilename(oid, tid)
+                         for oid, tid in sorted(removed)]
+            stats, contents = self._removeBlobFiles(paths, dry_run)
+            manifest = self.fshelper.manifest
+            if manifest is not None and not dry_run:
+                if mode == 'walk':
+                    # Also repairs the manifest.
+                    manifest.rebuild()
+                else:
+                    manifest.remove(sorted(removed))
+                    manifest.compact()
+            if self.fshelper.layout.content_addressed and not dry_run:
+                # Walking also repairs content left by interrupted packs.
+                stats['content_files'], stats['content_bytes'] = (
+                    self.fshelper.collectContent(
+                        None if mode == 'walk' else contents))
+            else:
+                stats['content_files'] = stats['content_bytes'] = 0
+            stats.update(mode=mode, dry_run=dry_run,
+                         seconds=time.time() - start)
+            if dry_run:
+                stats['paths'] = paths
+            self._blob_pack_statistics = stats
+            logger.info(
+                "%s blob files %s (%s bytes) in %.3fs by %s",
+                stats['files'],
+                'would be removed' if dry_run else 'removed',
+                stats['bytes'], stats['seconds'], mode)
         finally:
             with self._lock:
                 self._blobs_pack_is_in_progress = False
 
         return result
 
+    _blob_pack_statistics = None
+
+    def blobPackStatistics(self):
+        """Return statistics of the last pack's blob removal, or None
+
+        The dictionary has the numbers of blob files removed
+        ('files'), of their bytes ('bytes'), of object directories
+        removed ('directories') and of files that couldn't be removed
+        ('errors'), of content files removed by content-addressed
+        layouts ('content_files') and of their bytes ('content_bytes'),
+        how the files were found ('mode', 'references' if they were
+        reported by the storage, 'iteration' or 'walk'),
+        whether it was a dry run ('dry_run'), and the seconds the pack
+        took ('seconds').  For dry runs, 'paths' lists the
+        files that would have been removed.
+        """
+        if self._blob_pack_statistics is not None:
+            return dict(self._blob_pack_statistics)
+
     def undo(self, serial_id, transaction):
         undo_serial, keys = self.__storage.undo(serial_id, transaction)
         # serial_id is the transaction id of the txn that we wish to undo.
@@ -879,9 +1894,13 @@ class BlobStorage(BlobStorageMixin):
                     data, serial_before, serial_after = load_result
                     orig_fn = self.fshelper.getBlobFilename(oid, serial_before)
                     new_fn = self.fshelper.getBlobFilename(oid, undo_serial)
-                with open(orig_fn, "rb") as orig:
-                    with open(new_fn, "wb") as new:
-                        utils.cp(orig, new)
+                if self.fshelper.layout.content_addressed:
+                    # Share the content.
+                    os.link(orig_fn, new_fn)
+                else:
+                    with open(orig_fn, "rb") as orig:
+                        with open(new_fn, "wb") as new:
+                            utils.fastcp(orig, new)
                 self.dirty_oids.append((oid, undo_serial))
 
         return undo_serial, keys
@@ -894,7 +1913,8 @@ class BlobStorage(BlobStorageMixin):
         """
         base_dir = self.fshelper.base_dir
         s = self.__storage.new_instance()
-        res = BlobStorage(base_dir, s)
+        res = BlobStorage(base_dir, s, pack_threads=self.pack_threads,
+                          fsync=self._blob_fsync)
         return res
 
 copied = logging.getLogger('ZODB.blob.copied').debug
@@ -912,7 +1932,7 @@ def rename_or_copy_blob(f1, f2, chmod=True):
         copied("Copied blob file %r to %r.", f1, f2)
         with open(f1, 'rb') as file1:
             with open(f2, 'wb') as file2:
-                utils.cp(file1, file2)
+                utils.fastcp(file1, file2)
         remove_committed(f1)
 
     if chmod:
@@ -980,7 +2000,7 @@ def copyTransactionsFromTo(source, destination):
                 os.close(fd)
                 with open(blobfilename, 'rb') as sf:
                     with open(name, 'wb') as df:
-                        utils.cp(sf, df)
+                        utils.fastcp(sf, df)
                 destination.restoreBlob(record.oid, record.tid, record.data,
                                  name, record.data_txn, trans)
             else:
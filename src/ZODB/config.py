@@ -141,6 +141,9 @@ class ZODBDatabase(BaseConfig):
         _option('pool_timeout')
         _option('allow_implicit_cross_references', 'xrefs')
         _option('large_record_size')
+        _option('shared_cache_size_bytes')
+        _option('store_batch_size')
+        _option('savepoint_memory_size')
 
         try:
             return ZODB.DB(
@@ -199,7 +202,13 @@ class FileStorage(BaseConfig):
                 options['packer'] = getattr(m, name)
 
         for name in ('blob_dir', 'create', 'read_only', 'quota', 'pack_gc',
-                     'pack_keep_old'):
+                     'pack_keep_old', 'prefetch_cache_size',
+                     'prefetch_threads', 'mmap_reads', 'group_commit',
+                     'group_commit_delay', 'group_commit_size',
+                     'array_index', 'index_rebuild_processes',
+                     'index_checkpoint_interval', 'pack_processes',
+                     'tid_cache_size', 'tid_index_interval',
+                     'revision_index_size', 'blob_layout', 'blob_fsync'):
             v = getattr(config, name, self)
             if v is not self:
                 options[name] = v
@@ -211,7 +220,10 @@ class BlobStorage(BaseConfig):
     def open(self):
         from ZODB.blob import BlobStorage
         base = self.config.base.open()
-        return BlobStorage(self.config.blob_dir, base)
+        return BlobStorage(self.config.blob_dir, base,
+                           layout=self.config.layout,
+                           pack_threads=self.config.pack_threads,
+                           fsync=self.config.fsync)
 
 
 class ZEOClient(BaseConfig):
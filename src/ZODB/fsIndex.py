@@ -38,7 +38,10 @@
 # high-order bytes when saving. On loading data, we add the leading
 # bytes back before using u64 to convert the data back to (long)
 # integers.
+import bisect
+import mmap
 import struct
+import sys
 
 from BTrees.fsBTree import fsBucket
 from BTrees.OOBTree import OOBTree
@@ -48,6 +51,8 @@ from ZODB._compat import INT_TYPES
 from ZODB._compat import Pickler
 from ZODB._compat import Unpickler
 from ZODB._compat import _protocol
+from ZODB.utils import p64
+from ZODB.utils import u64
 
 
 # convert between numbers and six-byte strings
@@ -120,6 +125,12 @@ class fsIndex(object):
     @classmethod
     def load(class_, fname):
         with open(fname, 'rb') as f:
+            if f.read(len(ARRAY_INDEX_MAGIC)) == ARRAY_INDEX_MAGIC:
+                # Saved by fsArrayIndex
+                info = fsArrayIndex.load(fname)
+                info['index'] = class_(info['index'])
+                return info
+            f.seek(0)
             unpickler = Unpickler(f)
             pos = unpickler.load()
             if not isinstance(pos, INT_TYPES):
@@ -175,6 +186,17 @@ class fsIndex(object):
         return r
 
     def update(self, mapping):
+        if isinstance(mapping, fsIndex):
+            # Update whole buckets at a time.
+            data = self._data
+            for treekey, other in six.iteritems(mapping._data):
+                tree = data.get(treekey)
+                if tree is None:
+                    data[treekey] = fsBucket(other)
+                else:
+                    tree.update(other)
+            return
+
         for k, v in mapping.items():
             self[ensure_bytes(k)] = v
 
@@ -278,3 +300,305 @@ class fsIndex(object):
                 biggest_suffix = tree.maxKey()
 
         return biggest_prefix + biggest_suffix
+
+
+# fsArrayIndex stores most of its data in two arrays, which can be
+# saved to and loaded from a binary file without any conversion:
+#
+#   - a sorted array of oids, as little-endian 8-byte integers, so
+#     that on most machines, the array can be searched by the bisect
+#     module without copying, and
+#
+#   - an array of the corresponding file positions, as big-endian
+#     6-byte integers, like fsIndex's values.
+#
+# Changes are kept in an fsIndex overlay and merged into the arrays
+# when the overlay gets large and when the index is saved.  Merging
+# copies the arrays, but the Python-level work is proportional to the
+# size of the overlay.
+#
+# The binary file has a 24-byte header, consisting of a magic number,
+# a format version, 2 bytes of padding, the file position saved with
+# the index and the number of oids, followed by the arrays.
+
+ARRAY_INDEX_MAGIC = b'FSAI'
+ARRAY_INDEX_VERSION = 1
+ARRAY_INDEX_HEADER = '>4sHxxQQ'
+ARRAY_INDEX_HEADER_LEN = struct.calcsize(ARRAY_INDEX_HEADER)
+
+
+class _KeyArray(object):
+    """Sequence of integers stored in a buffer of little-endian 8-byte keys
+
+    This is used where a memoryview can't be cast to an array of
+    native 8-byte integers.
+    """
+
+    def __init__(self, buf):
+        self._buf = buf
+
+    def __len__(self):
+        return len(self._buf) // 8
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return struct.unpack_from('<Q', self._buf, i * 8)[0]
+
+
+def _key_array(buf):
+    if (not six.PY2 and sys.byteorder == 'little'
+            and struct.calcsize('Q') == 8):
+        return memoryview(buf).cast('B').cast('Q')
+    return _KeyArray(buf)
+
+
+class fsArrayIndex(object):
+    """An oid to file-position mapping stored in sorted arrays
+
+    This provides the same API as fsIndex, but uses much less memory
+    and can be saved and loaded much faster, because the arrays are
+    saved as is and, where possible, memory mapped when loaded.
+    """
+
+    # The minimum size of the overlay that causes it to be merged
+    # into the arrays.  The overlay is also merged when it grows
+    # beyond an eighth of the size of the arrays.
+    merge_size = 100000
+
+    def __init__(self, data=None):
+        self._set_arrays(b'', b'')
+        self._overlay = fsIndex()
+        self._deleted = set()
+        self._len = 0
+        if data:
+            self.update(data)
+
+    def _set_arrays(self, keys, values):
+        # The arrays are set with a single assignment, so that
+        # readers see consistent arrays.
+        self._arrays = keys, _key_array(keys), values
+
+    def _array_find(self, key):
+        # Return the array index of a key, or -1
+        _, keys, _ = self._arrays
+        n = u64(key)
+        i = bisect.bisect_left(keys, n)
+        if i < len(keys) and keys[i] == n:
+            return i
+        return -1
+
+    def _array_get(self, key, default=None):
+        _, keys, values = self._arrays
+        n = u64(key)
+        i = bisect.bisect_left(keys, n)
+        if i < len(keys) and keys[i] == n and key not in self._deleted:
+            return str2num(values[i * 6:i * 6 + 6])
+        return default
+
+    def __getitem__(self, key):
+        v = self.get(key, self)
+        if v is self:
+            raise KeyError(key)
+        return v
+
+    def get(self, key, default=None):
+        assert isinstance(key, bytes)
+        v = self._overlay.get(key, self)
+        if v is self:
+            return self._array_get(key, default)
+        return v
+
+    def __setitem__(self, key, value):
+        assert isinstance(key, bytes)
+        if key not in self:
+            self._len += 1
+        self._deleted.discard(key)
+        self._overlay[key] = value
+        if len(self._overlay) > max(self.merge_size,
+                                    len(self._arrays[1]) // 8):
+            self._merge()
+
+    def __delitem__(self, key):
+        assert isinstance(key, bytes)
+        if key not in self:
+            raise KeyError(key)
+        if key in self._overlay:
+            del self._overlay[key]
+        if self._array_find(key) >= 0:
+            self._deleted.add(key)
+        self._len -= 1
+
+    def __len__(self):
+        return self._len
+
+    def update(self, mapping):
+        for k, v in mapping.items():
+            self[ensure_bytes(k)] = v
+
+    def has_key(self, key):
+        return key in self
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def clear(self):
+        self._set_arrays(b'', b'')
+        self._overlay.clear()
+        self._deleted.clear()
+        self._len = 0
+
+    def _merge(self):
+        raw, keys, values = self._arrays
+        new_keys = []
+        new_values = []
+        start = 0
+        for oid, pos in self._overlay.iteritems():
+            n = u64(oid)
+            i = bisect.bisect_left(keys, n, start)
+            new_keys.append(raw[start * 8:i * 8])
+            new_values.append(values[start * 6:i * 6])
+            new_keys.append(struct.pack('<Q', n))
+            new_values.append(num2str(pos))
+            if i < len(keys) and keys[i] == n:
+                i += 1
+            start = i
+        new_keys.append(raw[start * 8:])
+        new_values.append(values[start * 6:])
+        raw = b''.join(new_keys)
+        values = b''.join(new_values)
+
+        if self._deleted:
+            # Deletions are rare, so we don't bother to be clever.
+            keys = _key_array(raw)
+            for oid in sorted(self._deleted):
+                n = u64(oid)
+                i = bisect.bisect_left(keys, n)
+                raw = raw[:i * 8] + raw[i * 8 + 8:]
+                values = values[:i * 6] + values[i * 6 + 6:]
+                keys = _key_array(raw)
+
+        self._set_arrays(raw, values)
+        self._overlay.clear()
+        self._deleted.clear()
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        _, keys, values = self._arrays
+        deleted = self._deleted
+        overlay = self._overlay.iteritems()
+        pending = next(overlay, None)
+        for i in six.moves.range(len(keys)):
+            key = p64(keys[i])
+            while pending is not None and pending[0] < key:
+                yield pending
+                pending = next(overlay, None)
+            if pending is not None and pending[0] == key:
+                yield pending
+                pending = next(overlay, None)
+            elif key not in deleted:
+                yield key, str2num(values[i * 6:i * 6 + 6])
+        while pending is not None:
+            yield pending
+            pending = next(overlay, None)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def minKey(self, key=None):
+        _, keys, _ = self._arrays
+        i = 0 if key is None else bisect.bisect_left(keys, u64(key))
+        while i < len(keys) and p64(keys[i]) in self._deleted:
+            i += 1
+        try:
+            result = self._overlay.minKey(key)
+        except ValueError:
+            result = None
+        if i < len(keys):
+            array_key = p64(keys[i])
+            if result is None or array_key < result:
+                result = array_key
+        if result is None:
+            raise ValueError('empty tree')
+        return result
+
+    def maxKey(self, key=None):
+        _, keys, _ = self._arrays
+        i = (len(keys) if key is None
+             else bisect.bisect_right(keys, u64(key))) - 1
+        while i >= 0 and p64(keys[i]) in self._deleted:
+            i -= 1
+        try:
+            result = self._overlay.maxKey(key)
+        except ValueError:
+            result = None
+        if i >= 0:
+            array_key = p64(keys[i])
+            if result is None or array_key > result:
+                result = array_key
+        if result is None:
+            raise ValueError('empty tree')
+        return result
+
+    def save(self, pos, fname):
+        if self._overlay or self._deleted:
+            self._merge()
+        raw, keys, values = self._arrays
+        with open(fname, 'wb') as f:
+            f.write(struct.pack(ARRAY_INDEX_HEADER, ARRAY_INDEX_MAGIC,
+                                ARRAY_INDEX_VERSION, pos, len(keys)))
+            f.write(raw)
+            f.write(values)
+
+    @classmethod
+    def load(class_, fname):
+        """Load an index saved by fsArrayIndex.save
+
+        Indexes saved by fsIndex are loaded too, and converted.
+        """
+        with open(fname, 'rb') as f:
+            header = f.read(ARRAY_INDEX_HEADER_LEN)
+            if header[:4] != ARRAY_INDEX_MAGIC:
+                info = fsIndex.load(fname)
+                index = info.get('index')
+                if index is not None and not isinstance(index, class_):
+                    info['index'] = class_(index)
+                return info
+
+            magic, version, pos, n = struct.unpack(
+                ARRAY_INDEX_HEADER, header)
+            if version != ARRAY_INDEX_VERSION:
+                raise ValueError("Unsupported index format version", version)
+            size = ARRAY_INDEX_HEADER_LEN + n * 14
+            if six.PY2:
+                data = header + f.read()
+            elif sys.platform == 'win32':
+                # Windows won't let a mapped index be replaced.
+                data = memoryview(header + f.read())
+            else:
+                data = memoryview(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            if len(data) != size:
+                raise ValueError("Truncated index file", fname)
+
+        index = class_()
+        keys_end = ARRAY_INDEX_HEADER_LEN + n * 8
+        index._set_arrays(data[ARRAY_INDEX_HEADER_LEN:keys_end],
+                          data[keys_end:])
+        index._len = n
+        return dict(pos=pos, index=index)
@@ -107,7 +107,7 @@ class IConnection(Interface):
             invalidate
 
         Other Methods: exchange, getDebugInfo, setDebugInfo,
-            getTransferCounts
+            getTransferCounts, getSavepointCounts, getActivityCounts
     """
 
     def add(ob):
@@ -263,6 +263,30 @@ class IConnection(Interface):
         If clear is True, reset the counters.
         """
 
+    def getSavepointCounts(clear=False):
+        """Returns savepoint storage counts.
+
+        A tuple of the number of records and bytes written to
+        savepoint storage, and the number of times savepoint storage
+        was spilled from memory to a temporary file, is returned.
+
+        If clear is True, reset the counters.
+        """
+
+    def getActivityCounts(clear=False):
+        """Returns counts of activity other than objects transferred.
+
+        A dictionary is returned with the number of bytes loaded
+        ('load_bytes') and stored ('store_bytes'), the number of
+        transactions committed ('commits') and the seconds spent
+        committing them ('commit_time'), the number of conflict errors
+        ('conflicts'), the number of objects found in ('cache_hits')
+        and missing from ('cache_misses') the cache when requested by
+        oid, and the seconds spent waiting to be opened ('pool_wait').
+
+        If clear is True, reset the counters.
+        """
+
     def readCurrent(obj):
         """Make sure an object being read is current
 
@@ -367,6 +391,13 @@ class IDatabase(IStorageDB):
         this attribute.
         """)
 
+    metrics = Attribute(
+        """A ZODB.metrics.Registry of the database's metrics
+
+        It includes the metrics of the database's connections and of
+        its storage, if the storage has a ``metrics`` registry.
+        """)
+
 
     def open(transaction_manager=None, serial=''):
         """Return an IConnection object for use by application code.
@@ -881,6 +912,64 @@ class IPrefetchStorage(IStorage):
         """
 
 
+class IMultiLoadStorage(IStorage):
+
+    def loadMany(oids):
+        """Load current data for many object ids
+
+        A dictionary is returned that maps each of the given object
+        ids to a data record and serial, as returned by ``load``.
+        Storages can use this to load many records more efficiently
+        than loading them one by one.
+
+        If one of the object ids isn't in the storage, then
+        POSKeyError is raised.
+
+        The oids argument is an iterable that should be iterated no
+        more than once.
+        """
+
+    def loadBeforeMany(oids, tid):
+        """Load the object data written before a transaction id for many oids
+
+        A dictionary is returned that maps each of the given object
+        ids to the value that ``loadBefore(oid, tid)`` would return.
+        Storages can use this to load many records more efficiently
+        than loading them one by one.
+
+        If one of the object ids isn't in the storage, then
+        POSKeyError is raised.
+
+        The oids argument is an iterable that should be iterated no
+        more than once.
+        """
+
+
+class IMultiOidStorage(IStorage):
+
+    def new_oids(count):
+        """Allocate many new object ids
+
+        A list of count object ids is returned, each of which is
+        reserved as it would be by ``new_oid``.  Storages can use this
+        to allocate many object ids more efficiently than allocating
+        them one by one.
+        """
+
+
+class IMultiStoreStorage(IStorage):
+
+    def storeMany(records, transaction):
+        """Store many object records
+
+        The records argument is an iterable of (oid, serial, data)
+        tuples, which is iterated no more than once.  Each record is
+        stored as it would be by ``store(oid, serial, data, '',
+        transaction)``.  Storages can use this to store many records
+        more efficiently than storing them one by one.
+        """
+
+
 class IMultiCommitStorage(IStorage):
     """A multi-commit storage can commit multiple transactions at once.
 
@@ -1243,6 +1332,21 @@ class IMVCCPrefetchStorage(IMVCCStorage):
         more than once.
         """
 
+class IMVCCMultiLoadStorage(IMVCCStorage):
+
+    def loadMany(oids):
+        """Load current data for many object ids
+
+        A dictionary is returned that maps each of the given object
+        ids to a data record and serial, as returned by ``load``.
+
+        A POSKeyError is raised if there is no record for one of the
+        object ids.
+
+        The oids argument is an iterable that should be iterated no
+        more than once.
+        """
+
 class IMVCCAfterCompletionStorage(IMVCCStorage):
 
     def afterCompletion():
@@ -1288,6 +1392,26 @@ class IExternalGC(IStorage):
        commit.
        """
 
+class IBlobRecordPacking(IStorage):
+    """Storages that can report the blob records removed by packing
+
+    Blob storages wrapping them remove the files of the removed
+    records, rather than checking the files of every blob record.
+    """
+
+    def packBlobRecords(pack_time, referencesf, is_blob_record,
+                        dry_run=False):
+        """Pack the storage, returning the blob records removed
+
+        The storage is packed as it would be by ``pack(pack_time,
+        referencesf)``, and a list of the (oid, tid) pairs of the
+        removed records that ``is_blob_record`` returns true for, when
+        called with their data, is returned.
+
+        If dry_run is true, the storage isn't changed, and the records
+        that would have been removed are returned.
+        """
+
 class ReadVerifyingStorage(IStorage):
 
     def checkCurrentSerialInTransaction(oid, serial, transaction):
@@ -1332,6 +1456,20 @@ class IBlob(Interface):
         A BlobError will be raised if the blob has any uncommitted data.
         """
 
+    def pin():
+        """Return a pinned file for committed data.
+
+        The returned object has a `name`, the name of a file with the
+        committed data that stays valid until the object is closed,
+        even if the committed file is removed by packing, a `size`, a
+        `fileno` method returning a file descriptor open for reading,
+        for use with ``os.sendfile`` or ``mmap``, a `read(offset=0,
+        size=-1)` method reading a range of the data, and a `close`
+        method.  It can be used as a context manager.
+
+        A BlobError will be raised if the blob has any uncommitted data.
+        """
+
     def consumeFile(filename):
         """Consume a file.
 
@@ -0,0 +1,177 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Counters and histograms of database and storage operations
+
+Databases, connections and storages register metrics in registries,
+which can be rendered in the Prometheus text exposition format::
+
+  print(db.metrics.exposition())
+
+A database's registry includes the registry of its storage, if the
+storage has one, so the database's exposition covers both.
+
+Metrics are updated without locking, to keep them cheap enough to
+leave enabled, so updates may occasionally be lost when made at the
+same time by different threads.
+"""
+import bisect
+from collections import OrderedDict
+
+# Upper bounds, in seconds, of the buckets of latency histograms.
+LATENCY_BUCKETS = (
+    .00001, .000025, .00005, .0001, .00025, .0005,
+    .001, .0025, .005, .01, .025, .05,
+    .1, .25, .5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+
+def _format(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+class Counter(object):
+    """A count of events, or a total amount, that only increases
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, (), self.value
+
+
+class Histogram(object):
+    """Observed values counted in buckets by upper bound
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # The last count is for values above the largest bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        name = self.name + '_bucket'
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'), ),
+                                self.counts):
+            total += count
+            yield name, (('le', _format(float(bound))), ), total
+        yield self.name + '_sum', (), self.sum
+        yield self.name + '_count', (), self.count
+
+
+class Registry(object):
+    """A collection of metrics with common labels
+
+    Metrics are created on first use, so objects of the same kind
+    sharing a registry share their metrics.
+    """
+
+    def __init__(self, **labels):
+        self.labels = tuple(sorted(labels.items()))
+        self._metrics = OrderedDict()
+        self._included = []
+
+    def _metric(self, factory, name, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = factory(name, *args)
+        elif not isinstance(metric, factory):
+            raise ValueError("%s is already registered as a %s"
+                             % (name, metric.type))
+        return metric
+
+    def counter(self, name, help=''):
+        """Return the counter with the given name, creating it if necessary
+        """
+        return self._metric(Counter, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        """Return the histogram with the given name, creating it if necessary
+        """
+        return self._metric(Histogram, name, help, buckets)
+
+    def include(self, registry):
+        """Include the metrics of another registry in this one's
+
+        The other registry's labels are added to this one's.
+        """
+        if registry is not self and registry not in self._included:
+            self._included.append(registry)
+
+    def collect(self, labels=(), _seen=None):
+        """Return an iterator of metrics and their labels
+        """
+        if _seen is None:
+            _seen = set()
+        if id(self) in _seen:
+            return
+        _seen.add(id(self))
+        labels = labels + self.labels
+        for metric in list(self._metrics.values()):
+            yield metric, labels
+        for registry in self._included:
+            for item in registry.collect(labels, _seen):
+                yield item
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text format
+        """
+        metrics = OrderedDict()
+        for metric, labels in self.collect():
+            metrics.setdefault(metric.name, []).append((metric, labels))
+        lines = []
+        for name, collected in metrics.items():
+            metric = collected[0][0]
+            if metric.help:
+                lines.append('# HELP %s %s' % (
+                    name,
+                    metric.help.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for metric, labels in collected:
+                for sample, extra, value in metric.samples():
+                    lines.append('%s%s %s' % (
+                        sample, _labels(labels + extra), _format(value)))
+        return ''.join(line + '\n' for line in lines)
@@ -91,6 +91,7 @@ class MVCCAdapter(Base):
     def pack(self, pack_time, referencesf):
         return self._storage.pack(pack_time, referencesf)
 
+@zope.interface.implementer(interfaces.IMVCCMultiLoadStorage)
 class MVCCAdapterInstance(Base):
 
     _copy_methods = Base._copy_methods + (
@@ -145,6 +146,18 @@ class MVCCAdapterInstance(Base):
             raise POSException.ReadConflictError(repr(oid))
         return r[:2]
 
+    def loadMany(self, oids):
+        assert self._start is not None
+        result = {}
+        for oid, r in _loadBeforeMany(self._storage, oids, self._start):
+            if r is None:
+                raise POSException.ReadConflictError(repr(oid))
+            result[oid] = r[:2]
+        return result
+
+    def new_oids(self, count):
+        return _new_oids(self._storage, count)
+
     def prefetch(self, oids):
         try:
             self._storage.prefetch(oids, self._start)
@@ -165,6 +178,11 @@ class MVCCAdapterInstance(Base):
         self._storage.store(oid, serial, data, version, transaction)
         self._modified.add(oid)
 
+    def storeMany(self, records, transaction):
+        records = list(records)
+        _storeMany(self._storage, records, transaction)
+        self._modified.update(record[0] for record in records)
+
     def storeBlob(self, oid, serial, data, blobfilename, version, transaction):
         self._storage.storeBlob(
             oid, serial, data, blobfilename, '', transaction)
@@ -180,9 +198,50 @@ class MVCCAdapterInstance(Base):
 
         return self._storage.tpc_finish(transaction, invalidate_finish)
 
+def _loadBeforeMany(storage, oids, tid):
+    """Return (oid, loadBefore result) pairs for the given oids
+
+    Use the storage's loadBeforeMany method if it has one.
+    """
+    try:
+        loadBeforeMany = storage.loadBeforeMany
+    except AttributeError:
+        loadBefore = storage.loadBefore
+        return [(oid, loadBefore(oid, tid)) for oid in oids]
+    else:
+        return loadBeforeMany(oids, tid).items()
+
+def _new_oids(storage, count):
+    """Return a list of count new oids
+
+    Use the storage's new_oids method if it has one.
+    """
+    try:
+        new_oids = storage.new_oids
+    except AttributeError:
+        new_oid = storage.new_oid
+        return [new_oid() for i in range(count)]
+    else:
+        return new_oids(count)
+
+def _storeMany(storage, records, transaction):
+    """Store many (oid, serial, data) records
+
+    Use the storage's storeMany method if it has one.
+    """
+    try:
+        storeMany = storage.storeMany
+    except AttributeError:
+        store = storage.store
+        for oid, serial, data in records:
+            store(oid, serial, data, '', transaction)
+    else:
+        storeMany(records, transaction)
+
 def read_only_writer(self, *a, **kw):
     raise POSException.ReadOnlyError
 
+@zope.interface.implementer(interfaces.IMVCCMultiLoadStorage)
 class HistoricalStorageAdapter(Base):
     """Adapt a storage to a historical storage
     """
@@ -226,6 +285,14 @@ class HistoricalStorageAdapter(Base):
             raise POSException.POSKeyError(oid)
         return r[:2]
 
+    def loadMany(self, oids):
+        result = {}
+        for oid, r in _loadBeforeMany(self._storage, oids, self._before):
+            if r is None:
+                raise POSException.POSKeyError(oid)
+            result[oid] = r[:2]
+        return result
+
 
 class UndoAdapterInstance(Base):
 
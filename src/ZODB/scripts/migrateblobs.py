@@ -49,7 +49,10 @@ def migrate(source, dest, layout):
         for file in files:
             source_file = os.path.join(path, file)
             dest_file = os.path.join(dest_path, file)
-            link_or_copy(source_file, dest_file)
+            if dest_fsh.layout.content_addressed:
+                dest_fsh.storeContent(source_file, dest_file, move=False)
+            else:
+                link_or_copy(source_file, dest_file)
         print("\tOID: %s - %s files " % (oid_repr(oid), len(files)))
 
 
@@ -62,9 +65,9 @@ def main(source=None, dest=None, layout="bushy"):
     parser = optparse.OptionParser(usage=usage, description=description)
     parser.add_option("-l", "--layout",
                       default=layout, type='choice',
-                      choices=['bushy', 'lawn'],
+                      choices=['bushy', 'lawn', 'content'],
                       help="Define the layout to use for the new directory "
-                      "(bushy or lawn). Default: %default")
+                      "(bushy, lawn or content). Default: %default")
     options, args = parser.parse_args()
 
     if not len(args) == 2:
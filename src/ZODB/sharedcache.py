@@ -0,0 +1,336 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A record cache shared by all of the connections to a database
+
+Each connection has its own object cache, so objects used by many
+connections are loaded from the storage, and unpickled, by each of
+them.  The cache provided here sits below the connections and keeps
+the records they load, so that a record is read from the storage only
+once.
+
+Records are kept along with the range of transaction ids they're
+valid for, as returned by ``loadBefore``, so a cached record can be
+used by connections viewing the database as of different
+transactions.
+"""
+import collections
+
+import zope.interface
+
+import ZODB.interfaces
+import ZODB.utils
+from ZODB.mvccadapter import _storeMany
+
+class SharedCache(object):
+    """A byte-size-bounded LRU cache of object records
+
+    Records are stored by oid and the id of the transaction that wrote
+    them.  The end transaction id of a record is None if the record is
+    current.
+    """
+
+    hits = misses = evictions = 0
+
+    # If more than this many oids have been invalidated since the last
+    # time, the invalidation history is forgotten.
+    _max_invalidated = 10000
+
+    def __init__(self, size_bytes):
+        self.size_bytes = size_bytes
+        self.total_bytes = 0
+        self._lock = ZODB.utils.Lock()
+        self._records = {} # {oid -> {start_tid -> [data, end_tid]}}
+        self._lru = collections.OrderedDict() # {(oid, start_tid) -> size}
+
+        # To avoid caching current records that were invalidated
+        # while they were being loaded, we keep track of when objects
+        # were invalidated.  Loaders note the generation before they
+        # load and pass it to store.
+        self.generation = 0
+        self._invalidated = {} # {oid -> generation}
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._lru)
+
+    def get(self, oid, tid):
+        """Return a record valid before tid as a loadBefore result, or None
+        """
+        with self._lock:
+            revisions = self._records.get(oid)
+            if revisions:
+                for start, (data, end) in revisions.items():
+                    if start < tid and (end is None or tid <= end):
+                        lru = self._lru
+                        key = oid, start
+                        lru[key] = lru.pop(key)
+                        self.hits += 1
+                        return data, start, end
+            self.misses += 1
+
+    def store(self, oid, data, start, end, generation):
+        """Add a loadBefore result to the cache
+
+        The generation is the value of the cache's generation
+        attribute before the record was loaded.
+        """
+        size = len(data)
+        if size > self.size_bytes:
+            return
+
+        with self._lock:
+            if end is None and (generation < self._floor or
+                                self._invalidated.get(oid, -1) > generation):
+                # The record may no longer be current.
+                return
+
+            revisions = self._records.setdefault(oid, {})
+            if start in revisions:
+                return
+            revisions[start] = [data, end]
+            self._lru[oid, start] = size
+            self.total_bytes += size
+
+            while self.total_bytes > self.size_bytes:
+                (oid, start), size = self._lru.popitem(False)
+                revisions = self._records[oid]
+                del revisions[start]
+                if not revisions:
+                    del self._records[oid]
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def invalidate(self, oids, tid):
+        """Note that new revisions of objects were committed in tid
+
+        Current records written before tid stop being current.
+        """
+        with self._lock:
+            self.generation += 1
+            generation = self.generation
+            invalidated = self._invalidated
+            if len(invalidated) > self._max_invalidated:
+                invalidated.clear()
+                self._floor = generation
+
+            records = self._records
+            for oid in oids:
+                invalidated[oid] = generation
+                revisions = records.get(oid)
+                if revisions:
+                    for start, record in revisions.items():
+                        if record[1] is None and start < tid:
+                            record[1] = tid
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._floor = self.generation
+            self._invalidated.clear()
+            self._records.clear()
+            self._lru.clear()
+            self.total_bytes = 0
+
+    def statistics(self):
+        """Return a dictionary of cache statistics
+        """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            records=len(self._lru),
+            bytes=self.total_bytes,
+            size_bytes=self.size_bytes,
+            )
+
+
+@zope.interface.implementer(ZODB.interfaces.IStorageWrapper)
+class SharedCacheStorage(object):
+    """Storage wrapper that caches loaded records in a SharedCache
+
+    The wrapper can be used with any storage.  It's used by databases
+    configured with a shared cache size.
+    """
+
+    copied_methods = (
+            'getName', 'getSize', 'history', 'isReadOnly',
+            'lastTransaction', 'new_oid', 'sortKey',
+            'tpc_begin', 'tpc_vote',
+            'loadBlob', 'openCommittedBlobFile', 'temporaryDirectory',
+            'supportsUndo', 'undoLog', 'undoInfo', 'loadSerial',
+            'iterator', 'record_iternext',
+            )
+
+    def __init__(self, base, size_bytes):
+        self.base = base
+        self.shared_cache = SharedCache(size_bytes)
+        self._modified = {} # {transaction -> set of oids}
+        if hasattr(base, 'registerDB'):
+            base.registerDB(self)
+
+        for name in self.copied_methods:
+            v = getattr(base, name, None)
+            if v is not None:
+                setattr(self, name, v)
+
+        zope.interface.directlyProvides(self, zope.interface.providedBy(base))
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def __len__(self):
+        return len(self.base)
+
+    def close(self):
+        self.shared_cache.clear()
+        self.base.close()
+
+    load = ZODB.utils.load_current
+
+    def loadBefore(self, oid, tid):
+        cache = self.shared_cache
+        r = cache.get(oid, tid)
+        if r is None:
+            generation = cache.generation
+            r = self.base.loadBefore(oid, tid)
+            if r is not None:
+                cache.store(oid, r[0], r[1], r[2], generation)
+        return r
+
+    def loadBeforeMany(self, oids, tid):
+        cache = self.shared_cache
+        result = {}
+        missing = []
+        for oid in oids:
+            r = cache.get(oid, tid)
+            if r is None:
+                missing.append(oid)
+            else:
+                result[oid] = r
+        if missing:
+            generation = cache.generation
+            try:
+                loadBeforeMany = self.base.loadBeforeMany
+            except AttributeError:
+                loaded = [(oid, self.base.loadBefore(oid, tid))
+                          for oid in missing]
+            else:
+                loaded = loadBeforeMany(missing, tid).items()
+            for oid, r in loaded:
+                if r is not None:
+                    cache.store(oid, r[0], r[1], r[2], generation)
+                result[oid] = r
+        return result
+
+    def _modifying(self, transaction, oids):
+        try:
+            modified = self._modified[transaction]
+        except KeyError:
+            modified = self._modified[transaction] = set()
+        modified.update(oids)
+
+    def store(self, oid, serial, data, version, transaction):
+        self._modifying(transaction, (oid,))
+        return self.base.store(oid, serial, data, version, transaction)
+
+    def storeMany(self, records, transaction):
+        records = list(records)
+        self._modifying(transaction, [record[0] for record in records])
+        return _storeMany(self.base, records, transaction)
+
+    def restore(self, oid, serial, data, version, prev_txn, transaction):
+        self._modifying(transaction, (oid,))
+        return self.base.restore(
+            oid, serial, data, version, prev_txn, transaction)
+
+    def deleteObject(self, oid, oldserial, transaction):
+        self._modifying(transaction, (oid,))
+        return self.base.deleteObject(oid, oldserial, transaction)
+
+    def storeBlob(self, oid, oldserial, data, blobfilename, version,
+                  transaction):
+        self._modifying(transaction, (oid,))
+        return self.base.storeBlob(
+            oid, oldserial, data, blobfilename, version, transaction)
+
+    def restoreBlob(self, oid, serial, data, blobfilename, prev_txn,
+                    transaction):
+        self._modifying(transaction, (oid,))
+        return self.base.restoreBlob(
+            oid, serial, data, blobfilename, prev_txn, transaction)
+
+    def undo(self, transaction_id, transaction):
+        result = self.base.undo(transaction_id, transaction)
+        if result:
+            self._modifying(transaction, result[1])
+        return result
+
+    def tpc_abort(self, transaction):
+        self._modified.pop(transaction, None)
+        return self.base.tpc_abort(transaction)
+
+    def tpc_finish(self, transaction, func=lambda tid: None):
+        modified = self._modified.pop(transaction, ())
+        cache = self.shared_cache
+
+        # We invalidate before the new data are visible, so records
+        # loaded from here on aren't cached as current, and again
+        # after, to end records that were loaded in the meantime.
+        def invalidate_finish(tid):
+            cache.invalidate(modified, tid)
+            func(tid)
+
+        tid = self.base.tpc_finish(transaction, invalidate_finish)
+        cache.invalidate(modified, tid)
+        return tid
+
+    def pack(self, pack_time, referencesf, *args, **kw):
+        try:
+            return self.base.pack(pack_time, referencesf, *args, **kw)
+        finally:
+            self.shared_cache.clear()
+
+    def copyTransactionsFrom(self, other):
+        try:
+            return self.base.copyTransactionsFrom(other)
+        finally:
+            self.shared_cache.clear()
+
+    db = None
+
+    def registerDB(self, db):
+        self.db = db
+        self._db_transform = db.transform_record_data
+        self._db_untransform = db.untransform_record_data
+
+    _db_transform = _db_untransform = lambda self, data: data
+
+    def invalidateCache(self):
+        self.shared_cache.clear()
+        if self.db is not None:
+            self.db.invalidateCache()
+
+    def invalidate(self, transaction_id, oids, version=''):
+        self.shared_cache.invalidate(oids, transaction_id)
+        if self.db is not None:
+            self.db.invalidate(transaction_id, oids)
+
+    def references(self, record, oids=None):
+        return self.db.references(record, oids)
+
+    def transform_record_data(self, data):
+        return self._db_transform(data)
+
+    def untransform_record_data(self, data):
+        return self._db_untransform(data)
@@ -0,0 +1,449 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""FileStorage benchmarks
+
+usage: python -m ZODB.tests.fsbench [options] benchmark
+
+Benchmarks:
+
+    reads   Measure read throughput while a stream of transactions is
+            committed.
+
+    commits Measure the throughput of concurrent committers.
+
+    index   Measure the time needed to save and load fsIndex and
+            fsArrayIndex indexes of n objects.
+
+    rebuild Measure the time needed to rebuild the index of a file of
+            n objects, updated n times, serially and in parallel.
+
+    large   Measure the time needed to commit transactions that update
+            all n objects, with and without a cache of the objects'
+            current transaction ids.
+
+    history Measure the throughput of historical connections reading
+            objects with many revisions, with and without an index of
+            the objects' revisions.
+
+    import  Measure the time needed to export a tree of n objects and
+            to import it, through savepoint storage and deferred until
+            commit.
+
+Options:
+
+    -d dir      The directory to create data files in.  The default is a
+                temporary directory that's removed afterwards.
+
+    -n n        The number of objects in the database.  The default
+                is 10000.
+
+    -r n        The number of reader threads.  The default is 4.
+
+    -w n        The number of committer threads for the commits
+                benchmark.  The default is 8.
+
+    -s seconds  How long to run.  The default is 10.
+
+    -m          Read using a memory map of the data file.
+
+    -g          Use group commit.
+
+    -p n        The number of processes used to rebuild indexes.  The
+                default is 4.
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+from ZODB.Connection import TransactionMetaData
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.FileStorage.FileStorage import read_index
+from ZODB.fsIndex import fsArrayIndex, fsIndex
+from ZODB.tests.StorageTestBase import MinPO, zodb_pickle
+from ZODB.utils import maxtid, p64
+
+
+def populate(storage, nobjects, batch=1000):
+    """Store nobjects objects in transactions of at most batch objects
+    """
+    data = zodb_pickle(MinPO(0))
+    oids = []
+    while len(oids) < nobjects:
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        for i in range(min(batch, nobjects - len(oids))):
+            oid = storage.new_oid()
+            storage.store(oid, None, data, '', t)
+            oids.append(oid)
+        storage.tpc_vote(t)
+        storage.tpc_finish(t)
+    return oids
+
+
+def bench_reads(storage, oids, readers, seconds):
+    """Load random objects while a writer commits single-object transactions
+
+    Returns the number of loads and commits done.
+    """
+    stop = threading.Event()
+    loads = [0] * readers
+    commits = [0]
+
+    def read(i):
+        loadBefore = storage.loadBefore
+        choice = random.choice
+        n = 0
+        while not stop.is_set():
+            for j in range(100):
+                loadBefore(choice(oids), maxtid)
+            n += 100
+        loads[i] = n
+
+    def write():
+        data = zodb_pickle(MinPO(1))
+        while not stop.is_set():
+            oid = random.choice(oids)
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            storage.store(oid, storage.lastTid(oid), data, '', t)
+            storage.tpc_vote(t)
+            storage.tpc_finish(t)
+            commits[0] += 1
+
+    threads = [threading.Thread(target=read, args=(i,))
+               for i in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(loads), commits[0]
+
+
+def bench_commits(storage, oids, writers, seconds):
+    """Commit single-object transactions from many threads
+
+    Returns the number of commits done.
+    """
+    stop = threading.Event()
+    commits = [0] * writers
+
+    def write(i):
+        data = zodb_pickle(MinPO(1))
+        # Each writer updates its own objects, to avoid conflicts.
+        mine = oids[i::writers]
+        n = 0
+        while not stop.is_set():
+            oid = random.choice(mine)
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            storage.store(oid, storage.lastTid(oid), data, '', t)
+            storage.tpc_vote(t)
+            storage.tpc_finish(t)
+            n += 1
+        commits[i] = n
+
+    threads = [threading.Thread(target=write, args=(i,))
+               for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(commits)
+
+
+def bench_index(directory, nobjects):
+    """Save and load indexes of nobjects objects
+
+    Returns a dictionary mapping index class names to save and load
+    times, in seconds.
+    """
+    fname = os.path.join(directory, 'bench.index')
+    result = {}
+    for class_ in fsIndex, fsArrayIndex:
+        index = class_()
+        for i in range(nobjects):
+            index[p64(i)] = i * 100
+        start = time.time()
+        index.save(0, fname)
+        saved = time.time()
+        loaded = class_.load(fname)['index']
+        result[class_.__name__] = saved - start, time.time() - saved
+        del index, loaded
+        os.remove(fname)
+    return result
+
+
+def bench_rebuild(storage, oids, processes):
+    """Rebuild the index of a storage serially and in parallel
+
+    Returns the number of bytes scanned and the serial and parallel
+    rebuild times, in seconds.
+    """
+    # Update each object, so there are as many updates as new objects.
+    data = zodb_pickle(MinPO(1))
+    for i in range(0, len(oids), 100):
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        for oid in oids[i:i+100]:
+            storage.store(oid, storage.lastTid(oid), data, '', t)
+        storage.tpc_vote(t)
+        storage.tpc_finish(t)
+
+    name = storage.getName()
+    times = []
+    results = []
+    with open(name, 'rb') as f:
+        for p in 0, processes:
+            index = fsIndex()
+            start = time.time()
+            pos = read_index(f, name, index, {}, read_only=True,
+                             processes=p)[0]
+            times.append(time.time() - start)
+            results.append(dict(index.items()))
+    assert results[0] == results[1]
+    return pos, times[0], times[1]
+
+
+def bench_large(name, oids, options, rounds=5):
+    """Commit transactions updating all of the objects
+
+    Returns the mean commit times, in seconds, without and with a
+    transaction-id cache large enough for all of the objects.
+    """
+    data = zodb_pickle(MinPO(2))
+    result = []
+    for size in 0, len(oids):
+        storage = FileStorage(name, tid_cache_size=size, **options)
+        try:
+            serials = dict((oid, storage.lastTid(oid)) for oid in oids)
+            elapsed = 0.0
+            for i in range(rounds):
+                t = TransactionMetaData()
+                start = time.time()
+                storage.tpc_begin(t)
+                for oid in oids:
+                    storage.store(oid, serials[oid], data, '', t)
+                storage.tpc_vote(t)
+                tid = storage.tpc_finish(t)
+                elapsed += time.time() - start
+                serials = dict.fromkeys(oids, tid)
+        finally:
+            storage.close()
+        result.append(elapsed / rounds)
+    return result
+
+
+def bench_history(name, oids, options, revisions=500, objects=10,
+                  seconds=10.0):
+    """Read objects with many revisions using historical connections
+
+    The first objects are each updated revisions times.  Connections
+    are then opened as of random transactions and the updated objects
+    are read.  Returns the number of objects read per second without
+    and with a revision index.
+    """
+    hot = oids[:objects]
+    storage = FileStorage(name, **options)
+    try:
+        tids = []
+        for i in range(revisions):
+            data = zodb_pickle(MinPO(i))
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            for oid in hot:
+                storage.store(oid, storage.lastTid(oid), data, '', t)
+            storage.tpc_vote(t)
+            tids.append(storage.tpc_finish(t))
+    finally:
+        storage.close()
+
+    result = []
+    for size in 0, (revisions + 1) * objects:
+        db = DB(FileStorage(name, revision_index_size=size, **options))
+        try:
+            reads = 0
+            end = time.time() + seconds
+            while time.time() < end:
+                conn = db.open(at=random.choice(tids))
+                for oid in hot:
+                    conn.get(oid)._p_activate()
+                conn.close()
+                reads += objects
+        finally:
+            db.close()
+        result.append(reads / seconds)
+    return result
+
+
+def bench_import(directory, nobjects, options, fanout=100):
+    """Export a tree of nobjects objects and import it
+
+    Returns the size of the export, in bytes, and the times taken to
+    export it, import it normally and import it deferred, in seconds.
+    """
+    db = DB(FileStorage(os.path.join(directory, 'export.fs'), create=True,
+                        **options))
+    export_name = os.path.join(directory, 'bench.zexp')
+    try:
+        conn = db.open()
+        tree = level = [PersistentMapping()]
+        n = 1
+        while n < nobjects:
+            children = []
+            for parent in level:
+                for i in range(min(fanout, nobjects - n)):
+                    parent[i] = child = PersistentMapping(data='x' * 100)
+                    children.append(child)
+                    n += 1
+            level = children
+        conn.root()['tree'] = tree[0]
+        transaction.commit()
+
+        start = time.time()
+        conn.exportFile(tree[0]._p_oid, export_name).close()
+        times = [time.time() - start]
+        conn.close()
+    finally:
+        db.close()
+
+    for defer in False, True:
+        db = DB(FileStorage(
+            os.path.join(directory, 'import%s.fs' % len(times)),
+            create=True, **options))
+        try:
+            conn = db.open()
+            start = time.time()
+            conn.importFile(export_name, defer=defer)
+            transaction.commit()
+            times.append(time.time() - start)
+            conn.close()
+        finally:
+            db.close()
+
+    return [os.path.getsize(export_name)] + times
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    opts, args = getopt.getopt(args, 'd:n:r:w:s:p:mg')
+    directory = None
+    nobjects = 10000
+    readers = 4
+    writers = 8
+    processes = 4
+    seconds = 10.0
+    options = {}
+    for o, v in opts:
+        if o == '-d':
+            directory = v
+        elif o == '-n':
+            nobjects = int(v)
+        elif o == '-r':
+            readers = int(v)
+        elif o == '-w':
+            writers = int(v)
+        elif o == '-s':
+            seconds = float(v)
+        elif o == '-p':
+            processes = int(v)
+        elif o == '-m':
+            options['mmap_reads'] = True
+        elif o == '-g':
+            options['group_commit'] = True
+
+    if args not in (['reads'], ['commits'], ['index'], ['rebuild'],
+                    ['large'], ['history'], ['import']):
+        print(__doc__)
+        sys.exit(1)
+
+    tmp = None
+    if directory is None:
+        directory = tmp = tempfile.mkdtemp('fsbench')
+    try:
+        if args == ['index']:
+            for name, (save, load) in sorted(
+                    bench_index(directory, nobjects).items()):
+                print("%s: %.3f seconds to save, %.3f seconds to load" % (
+                    name, save, load))
+            return
+
+        if args == ['import']:
+            print("%d bytes: %.3f seconds to export, %.3f seconds to "
+                  "import, %.3f seconds to import deferred" % tuple(
+                      bench_import(directory, nobjects, options)))
+            return
+
+        storage = FileStorage(
+            os.path.join(directory, 'bench.fs'), create=True, **options)
+        try:
+            oids = populate(storage, nobjects)
+            if args == ['reads']:
+                loads, commits = bench_reads(storage, oids, readers, seconds)
+                print("%d loads/second, %d commits/second, %d readers" % (
+                    loads / seconds, commits / seconds, readers))
+            elif args == ['rebuild']:
+                size, serial, parallel = bench_rebuild(
+                    storage, oids, processes)
+                print("%d bytes: %.3f seconds serially, "
+                      "%.3f seconds with %d processes" % (
+                          size, serial, parallel, processes))
+            elif args == ['large']:
+                storage.close()
+                uncached, cached = bench_large(
+                    storage.getName(), oids, options)
+                print("%d objects: %.3f seconds/commit without cached "
+                      "transaction ids, %.3f seconds/commit with them" % (
+                          len(oids), uncached, cached))
+            elif args == ['history']:
+                storage.close()
+                unindexed, indexed = bench_history(
+                    storage.getName(), oids, options, seconds=seconds)
+                print("%d reads/second without a revision index, "
+                      "%d reads/second with one" % (unindexed, indexed))
+            else:
+                commits = bench_commits(storage, oids, writers, seconds)
+                print("%d commits/second, %d committers" % (
+                    commits / seconds, writers))
+                stats = storage.groupCommitStatistics()
+                if stats is not None:
+                    print("%(mean_batch).1f transactions/fsync, "
+                          "%(mean_sync_time).4f seconds/fsync" % stats)
+        finally:
+            storage.close()
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
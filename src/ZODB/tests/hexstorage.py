@@ -13,6 +13,7 @@
 ##############################################################################
 import ZODB.blob
 import ZODB.interfaces
+import ZODB.mvccadapter
 import ZODB.utils
 import zope.interface
 from binascii import hexlify, unhexlify
@@ -56,6 +57,19 @@ class HexStorage(object):
         else:
             return r
 
+    def loadBeforeMany(self, oids, tid):
+        result = self.base.loadBeforeMany(oids, tid)
+        for oid, r in result.items():
+            if r is not None:
+                data, serial, after = r
+                result[oid] = unhexlify(data[2:]), serial, after
+        return result
+
+    def loadMany(self, oids):
+        return dict((oid, (unhexlify(data[2:]), serial))
+                    for oid, (data, serial)
+                    in self.base.loadMany(oids).items())
+
     def loadSerial(self, oid, serial):
         return unhexlify(self.base.loadSerial(oid, serial)[2:])
 
@@ -75,6 +89,13 @@ class HexStorage(object):
         return self.base.store(
             oid, serial, b'.h'+hexlify(data), version, transaction)
 
+    def storeMany(self, records, transaction):
+        return ZODB.mvccadapter._storeMany(
+            self.base,
+            ((oid, serial, b'.h'+hexlify(data))
+             for oid, serial, data in records),
+            transaction)
+
     def restore(self, oid, serial, data, version, prev_txn, transaction):
         return self.base.restore(
             oid, serial, data and (b'.h'+hexlify(data)), version, prev_txn,
@@ -21,6 +21,10 @@ $Id$
 import unittest
 import time
 
+import transaction
+import ZODB
+import ZODB.ActivityMonitor
+from persistent.mapping import PersistentMapping
 from ZODB.ActivityMonitor import ActivityMonitor
 
 
@@ -40,17 +44,112 @@ class FakeConnection(object):
         return res
 
 
+class FakeActivityConnection(FakeConnection):
+
+    def __init__(self, **counts):
+        self.counts = counts
+
+    def getActivityCounts(self, clear=False):
+        res = self.counts
+        if clear:
+            self.counts = {}
+        return res
+
+
+class FakeTime(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
 class Tests(unittest.TestCase):
 
+    def setUp(self):
+        self.clock = FakeTime(100000.0)
+
+    def tearDown(self):
+        ZODB.ActivityMonitor.time = time
+
     def testAddLogEntries(self):
+        ZODB.ActivityMonitor.time = self.clock
         am = ActivityMonitor(history_length=3600)
         self.assertEqual(len(am.log), 0)
         c = FakeConnection()
         c._transferred(1, 2)
         am.closedConnection(c)
+        # Close the next connection in the next bucket.
+        self.clock.now += 10
         c._transferred(3, 7)
         am.closedConnection(c)
         self.assertEqual(len(am.log), 2)
+        self.assertEqual(am.log, [(100000.0, 1, 2), (100010.0, 3, 7)])
+
+    def testBuckets(self):
+        am = ActivityMonitor(history_length=100, buckets=10)
+        t0 = 100000.0
+        am.record(t0 + 5, 1, 0)
+        am.record(t0 + 50, 2, 0)
+        am.record(t0 + 55, 4, 0)
+        am.record(t0 + 95, 8, 0)
+        res = am.getActivityAnalysis(t0, t0 + 100, 10)
+        self.assertEqual([div['loads'] for div in res],
+                         [1, 0, 0, 0, 0, 6, 0, 0, 0, 8])
+        self.assertEqual([div['connections'] for div in res],
+                         [1, 0, 0, 0, 0, 2, 0, 0, 0, 1])
+        # A bucket is reused once its period has passed.
+        am.record(t0 + 105, 16, 0)
+        self.assertEqual(len(am._ring), 10)
+        res = am.getActivityAnalysis(t0, t0 + 110, 11)
+        self.assertEqual([div['loads'] for div in res],
+                         [0, 0, 0, 0, 0, 6, 0, 0, 0, 8, 16])
+
+    def testActivityCounts(self):
+        am = ActivityMonitor(history_length=3600)
+        c = FakeActivityConnection(load_bytes=100, commits=1,
+                                   commit_time=0.5, cache_misses=3)
+        am.closedConnection(c)
+        self.assertEqual(c.counts, {})
+        c = FakeActivityConnection(load_bytes=10, conflicts=1,
+                                   pool_wait=0.25)
+        am.closedConnection(c)
+        div = am.getActivityAnalysis(divisions=1)[0]
+        self.assertEqual(div['connections'], 2)
+        self.assertEqual(div['load_bytes'], 110)
+        self.assertEqual(div['store_bytes'], 0)
+        self.assertEqual(div['commits'], 1)
+        self.assertEqual(div['commit_time'], 0.5)
+        self.assertEqual(div['conflicts'], 1)
+        self.assertEqual(div['cache_hits'], 0)
+        self.assertEqual(div['cache_misses'], 3)
+        self.assertEqual(div['pool_wait'], 0.25)
+
+    def testDatabaseActivity(self):
+        db = ZODB.DB(None)
+        am = ActivityMonitor()
+        db.setActivityMonitor(am)
+        self.assertTrue(db.getActivityMonitor() is am)
+        with db.transaction() as conn:
+            conn.root.x = PersistentMapping()
+        conn = db.open()
+        conn.cacheMinimize()
+        conn.root.x._p_activate()
+        conn.get(conn.root.x._p_oid)
+        conn.close()
+        div = am.getActivityAnalysis(divisions=1)[0]
+        self.assertEqual(div['connections'], 2)
+        # Counts include those of the database's root creation, as
+        # the connection it used is reused.
+        self.assertTrue(div['commits'] >= 1)
+        self.assertTrue(div['stores'] >= 2)
+        self.assertTrue(div['store_bytes'] > 0)
+        self.assertTrue(div['load_bytes'] > 0)
+        self.assertTrue(div['cache_hits'] >= 1)
+        self.assertTrue(div['commit_time'] >= 0)
+        db.close()
+        transaction.abort()
 
     def testTrim(self):
         am = ActivityMonitor(history_length=0.1)
@@ -70,7 +169,8 @@ class Tests(unittest.TestCase):
         time.sleep(0.2)
         c._transferred(3, 7)
         am.closedConnection(c)
-        self.assertEqual(len(am.log), 2)
+        self.assertEqual(
+            am.getActivityAnalysis(divisions=1)[0]['connections'], 2)
         am.setHistoryLength(0.1)
         self.assertEqual(am.getHistoryLength(), 0.1)
         self.assertTrue(len(am.log) <= 1)
@@ -23,6 +23,7 @@ import unittest
 import transaction
 from transaction import Transaction
 
+import ZODB.metrics
 import ZODB.tests.util
 from ZODB.config import databaseFromString
 from ZODB.utils import p64, u64, z64
@@ -1373,12 +1374,105 @@ class TestConnection(unittest.TestCase):
 
         db.close()
 
+    def test_setstateMany(self):
+        db = ZODB.DB(None)
+        with db.transaction() as conn:
+            for i in range(5):
+                conn.root()[i] = conn.root().__class__(x=i)
+
+        loaded = []
+        loadBefore = db.storage.loadBefore
+        def loadBeforeMany(oids, tid):
+            oids = list(oids)
+            loaded.append(sorted(u64(oid) for oid in oids))
+            return dict((oid, loadBefore(oid, tid)) for oid in oids)
+        db.storage.loadBeforeMany = loadBeforeMany
+
+        conn = db.open()
+        conn.cacheMinimize()
+        conn.getTransferCounts(True)
+        obs = [conn.root()[i] for i in range(5)]
+        obs[0]._p_activate()
+        conn.setstateMany(obs)
+        self.assertEqual(loaded, [[2, 3, 4, 5]])
+        self.assertEqual([ob._p_changed for ob in obs], [False] * 5)
+        self.assertEqual([ob['x'] for ob in obs], list(range(5)))
+        self.assertEqual(conn.getTransferCounts(), (6, 0))
+
+        # Nothing is loaded if there are no ghosts.
+        conn.setstateMany(obs)
+        self.assertEqual(len(loaded), 1)
+        conn.close()
+        db.close()
+
+    def test_store_batch_size(self):
+        db = ZODB.DB(None, store_batch_size=2)
+        stored = []
+        storage = db.storage
+        def storeMany(records, transaction):
+            records = list(records)
+            stored.append(sorted(u64(record[0]) for record in records))
+            for oid, serial, data in records:
+                storage.store(oid, serial, data, '', transaction)
+        storage.storeMany = storeMany
+
+        with db.transaction() as conn:
+            for i in range(4):
+                conn.root()[i] = conn.root().__class__(x=i)
+        self.assertEqual([len(oids) for oids in stored], [2, 2, 1])
+        self.assertEqual(sorted(sum(stored, [])), list(range(5)))
+
+        conn = db.open()
+        self.assertEqual([conn.root()[i]['x'] for i in range(4)],
+                         list(range(4)))
+        conn.close()
+        db.close()
+
+    def test_savepoint_memory_size(self):
+        db = ZODB.DB(None, savepoint_memory_size=1000)
+        conn = db.open()
+        root = conn.root()
+        for i in range(3):
+            root[i] = root.__class__(x=i)
+        conn.savepoint()
+        tmpstore = conn._savepoint_storage
+        records, size, spills = conn.getSavepointCounts()
+        self.assertEqual((records, spills), (4, 0))
+        self.assertEqual(size, tmpstore.position)
+        self.assertEqual(tmpstore.memory_size, 1000)
+
+        # Savepoint data beyond the memory size are written to a file.
+        root[3] = root.__class__(x='x' * 1000)
+        sp = conn.savepoint()
+        self.assertEqual(conn.getSavepointCounts()[::2], (6, 1))
+        self.assertEqual(tmpstore.memory_size, 0)
+        root[3]['x'] = 'y'
+        sp.rollback()
+
+        conn.cacheMinimize()
+        self.assertEqual(
+            tmpstore.loadMany([root._p_oid, root[3]._p_oid]),
+            dict((oid, tmpstore.load(oid))
+                 for oid in (root._p_oid, root[3]._p_oid)))
+        self.assertEqual(root[3]['x'], 'x' * 1000)
+        transaction.commit()
+        self.assertEqual(conn.getSavepointCounts(True)[::2], (6, 1))
+        self.assertEqual(conn.getSavepointCounts(), (0, 0, 0))
+        conn.close()
+
+        conn = db.open()
+        self.assertEqual([conn.root()[i]['x'] for i in range(4)],
+                         [0, 1, 2, 'x' * 1000])
+        conn.close()
+        db.close()
+
 class StubDatabase(object):
 
     def __init__(self):
         self.storage = StubStorage()
         self._mvcc_storage = mvccadapter.MVCCAdapter(self.storage)
         self.new_oid = self.storage.new_oid
+        self.metrics = ZODB.metrics.Registry()
 
     classFactory = None
     database_name = 'stubdatabase'
@@ -1388,6 +1482,8 @@ class StubDatabase(object):
         pass
 
     large_record_size = 1<<30
+    store_batch_size = 0
+    savepoint_memory_size = 0
 
 def test_suite():
     s = unittest.makeSuite(ConnectionDotAdd)
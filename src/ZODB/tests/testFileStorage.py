@@ -13,20 +13,24 @@
 ##############################################################################
 import doctest
 import os
+import shutil
 if os.environ.get('USE_ZOPE_TESTING_DOCTEST'):
     from zope.testing import doctest
 import sys
+import threading
+import time
 import unittest
 import transaction
 import ZODB.FileStorage
+import ZODB.sharedcache
 import ZODB.tests.hexstorage
 import ZODB.tests.testblob
 import zope.testing.setupstack
 from ZODB import POSException
 from ZODB import DB
 from ZODB.Connection import TransactionMetaData
-from ZODB.fsIndex import fsIndex
-from ZODB.utils import U64, p64, z64, load_current
+from ZODB.fsIndex import fsArrayIndex, fsIndex
+from ZODB.utils import U64, p64, u64, z64, load_current
 
 from ZODB.tests import StorageTestBase, BasicStorage, TransactionalUndoStorage
 from ZODB.tests import PackableStorage, Synchronization, ConflictResolution
@@ -99,7 +103,7 @@ class FileStorageTests(
         return index
 
     def check_conversion_to_fsIndex(self, read_only=False):
-        from ZODB.fsIndex import fsIndex
+        from ZODB.fsIndex import fsArrayIndex, fsIndex
 
         # Create some data, and remember the index.
         for i in range(10):
@@ -142,7 +146,7 @@ class FileStorageTests(
         # converted the fsIndex class from using a dictionary as its
         # self._data attribute to using an OOBTree in its stead.
 
-        from ZODB.fsIndex import fsIndex
+        from ZODB.fsIndex import fsArrayIndex, fsIndex
         from BTrees.OOBTree import OOBTree
 
         # Create some data, and remember the index.
@@ -287,6 +291,434 @@ class FileStorageTests(
             else:
                 self.assertNotEqual(next_oid, None)
 
+    def checkLoadBeforeMany(self):
+        oids = [self._storage.new_oid() for i in range(3)]
+        revs = []
+        for oid in oids:
+            revs.append(self._dostore(oid, data=MinPO(1)))
+        revid = self._dostore(oids[1], revid=revs[1], data=MinPO(2))
+
+        result = self._storage.loadBeforeMany(reversed(oids), revid)
+        self.assertEqual(sorted(result), sorted(oids))
+        for oid in oids:
+            self.assertEqual(result[oid],
+                             self._storage.loadBefore(oid, revid))
+        self.assertEqual(result[oids[1]][1:], (revs[1], revid))
+        self.assertEqual(result[oids[0]][2], None)
+
+        result = self._storage.loadMany(oids)
+        self.assertEqual(result[oids[1]], (zodb_pickle(MinPO(2)), revid))
+        self.assertEqual(result[oids[2]], (zodb_pickle(MinPO(1)), revs[2]))
+
+        self.assertRaises(POSException.POSKeyError,
+                          self._storage.loadBeforeMany,
+                          [oids[0], p64(1000)], revid)
+
+    def checkPrefetch(self):
+        # Prefetching is disabled by default.
+        self._storage.prefetch([z64], z64)
+        self.assertEqual(self._storage._prefetcher, None)
+        self._storage.close()
+        self.open(prefetch_cache_size=10)
+
+        oids = [self._storage.new_oid() for i in range(3)]
+        revs = [self._dostore(oid, data=MinPO(1)) for oid in oids]
+        tid = p64(U64(revs[-1]) + 1)
+
+        self._storage.prefetch(oids, tid)
+        prefetcher = self._storage._prefetcher
+        for i in range(100):
+            if len(prefetcher._records) == len(oids):
+                break
+            time.sleep(.01)
+        self.assertEqual(len(prefetcher._records), len(oids))
+
+        for oid, rev in list(zip(oids, revs))[1:]:
+            self.assertEqual(self._storage.loadBefore(oid, tid),
+                             (zodb_pickle(MinPO(1)), rev, None))
+        self.assertEqual(prefetcher.hits, 2)
+
+        # Records are removed when they're loaded.
+        self.assertEqual(list(prefetcher._records), oids[:1])
+        self.assertEqual(self._storage.loadBefore(oids[1], tid),
+                         (zodb_pickle(MinPO(1)), revs[1], None))
+        self.assertEqual(prefetcher.hits, 2)
+
+        # Committing a new revision ends the validity of the record
+        revid = self._dostore(oids[0], revid=revs[0], data=MinPO(2))
+        self.assertEqual(self._storage.loadBefore(oids[0], tid),
+                         (zodb_pickle(MinPO(1)), revs[0], revid))
+        self.assertEqual(prefetcher.hits, 3)
+        self.assertEqual(load_current(self._storage, oids[0]),
+                         (zodb_pickle(MinPO(2)), revid))
+        self.assertEqual(prefetcher.hits, 3)
+
+        # Closing the storage stops the prefetch threads.
+        threads = prefetcher._threads
+        self._storage.close()
+        self.assertFalse([t for t in threads if t.is_alive()])
+
+    def checkPackWithProcesses(self):
+        from ZODB.serialize import referencesf
+        self._storage.close()
+        self.open(pack_processes=2)
+        self.assertEqual(self._storage.packStatistics(), None)
+        db = DB(self._storage)
+        conn = db.open()
+        root = conn.root()
+        for i in range(50):
+            root[i] = MinPO(MinPO(i))
+        transaction.commit()
+        garbage = [root.pop(i)._p_oid for i in range(0, 50, 2)]
+        garbage.extend(root[i].value._p_oid for i in range(1, 50, 4))
+        for i in range(1, 50, 4):
+            root[i].value = None
+        transaction.commit()
+        db.close()
+
+        StorageTestBase.snooze()
+        self.open(pack_processes=2)
+        self._storage.pack(time.time(), referencesf)
+        for oid in garbage:
+            self.assertRaises(KeyError, load_current, self._storage, oid)
+        db = DB(self._storage)
+        root = db.open().root()
+        self.assertEqual([root[i].value.value for i in range(3, 50, 4)],
+                         list(range(3, 50, 4)))
+        self.assertEqual(
+            sorted(self._storage.packStatistics()),
+            ['catch_up', 'copy', 'index', 'locked', 'reachable', 'swap'])
+        db.close()
+
+    def checkPackCopiesNewTransactionsWithoutCommitLock(self):
+        from ZODB.FileStorage.fspack import FileStoragePacker
+        from ZODB.serialize import referencesf
+        oid = z64
+        revid = self._dostore(oid, data=1)
+        revid = self._dostore(oid, revid, data=2)
+        StorageTestBase.snooze()
+        packtime = time.time()
+        StorageTestBase.snooze()
+        # The packer is used by the underlying storage of wrappers.
+        storage = getattr(self._storage, 'base', self._storage)
+        test = self
+        copied = []
+
+        class Packer(FileStoragePacker):
+            catch_up_size = 0
+
+            def copyToPacktime(self):
+                result = FileStoragePacker.copyToPacktime(self)
+                # Transactions are committed while we pack.
+                test._dostore(oid, revid, data=3)
+                return result
+
+            def copyCommitted(self, ipos):
+                ipos = FileStoragePacker.copyCommitted(self, ipos)
+                copied.append((ipos, storage._pos))
+                return ipos
+
+        def packer(storage, referencesf, stop, gc):
+            p = Packer(storage, referencesf, stop, gc)
+            try:
+                opos = p.pack()
+                return opos and (opos, p.index)
+            finally:
+                p.close()
+
+        storage.packer = packer
+        self._storage.pack(packtime, referencesf)
+        self.assertEqual(len(copied), 1)
+        self.assertEqual(copied[0][0], copied[0][1])
+        self.assertEqual(load_current(self._storage, oid)[0],
+                         zodb_pickle(MinPO(3)))
+
+    def checkReadersDontWaitForFsync(self):
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid, data=MinPO(1))
+
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        syncing = threading.Event()
+        synced = threading.Event()
+        def fsync(fileno):
+            syncing.set()
+            synced.wait(10)
+
+        thread = threading.Thread(
+            target=self._dostore, args=(oid, revid, MinPO(2)))
+        module.fsync, orig_fsync = fsync, module.fsync
+        try:
+            thread.start()
+            syncing.wait(10)
+            self.assertEqual(load_current(self._storage, oid),
+                             (zodb_pickle(MinPO(1)), revid))
+            self.assertTrue(thread.is_alive())
+        finally:
+            synced.set()
+            thread.join(10)
+            module.fsync = orig_fsync
+        self.assertEqual(load_current(self._storage, oid)[0],
+                         zodb_pickle(MinPO(2)))
+
+    def checkNewOids(self):
+        oid = self._storage.new_oid()
+        oids = self._storage.new_oids(3)
+        self.assertEqual(oids, [p64(U64(oid) + i) for i in (1, 2, 3)])
+        self.assertEqual(self._storage.new_oids(0), [])
+        self.assertEqual(self._storage.new_oid(), p64(U64(oid) + 4))
+
+    def checkNewOidsUsesNewOidOverride(self):
+        storage = getattr(self._storage, 'base', self._storage)
+        allocated = []
+
+        class Storage(storage.__class__):
+            def new_oid(self):
+                oid = super(Storage, self).new_oid()
+                allocated.append(oid)
+                return oid
+
+        storage.__class__ = Storage
+        oids = storage.new_oids(2)
+        self.assertEqual(oids, allocated)
+        self.assertEqual(len(oids), 2)
+
+    def checkStoreMany(self):
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid, data=MinPO(1))
+        oids = [oid] + [self._storage.new_oid() for i in range(3)]
+
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self._storage.storeMany(
+            [(oid, revid if oid == oids[0] else z64,
+              zodb_pickle(MinPO(u64(oid))))
+             for oid in oids],
+            t)
+        self._storage.tpc_vote(t)
+        tid = self._storage.tpc_finish(t)
+        for oid in oids:
+            self.assertEqual(load_current(self._storage, oid),
+                             (zodb_pickle(MinPO(u64(oid))), tid))
+
+        # Conflicts are detected.
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self.assertRaises(POSException.ConflictError,
+                          self._storage.storeMany,
+                          [(oids[1], tid, zodb_pickle(MinPO(5))),
+                           (oids[2], revid, zodb_pickle(MinPO(5)))],
+                          t)
+        self._storage.tpc_abort(t)
+
+    def checkStoreUsesCachedTids(self):
+        storage = getattr(self._storage, 'base', self._storage)
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid, data=MinPO(1))
+        pos = storage._lookup_pos(oid)
+        self.assertEqual(storage._tids[pos], revid)
+
+        # Conflicts are detected without reading the data file.
+        read_data_header = storage._read_data_header
+        storage._read_data_header = None
+        try:
+            self.assertRaises(POSException.ConflictError,
+                              self._dostore, oid, z64, MinPO(2))
+            revid = self._dostore(oid, revid, MinPO(2))
+        finally:
+            storage._read_data_header = read_data_header
+        self.assertEqual(load_current(self._storage, oid)[1], revid)
+
+        # Only as many transaction ids as asked for are kept.
+        self._storage.close()
+        self.open(tid_cache_size=1)
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(len(storage._tids), 0)
+        revid = self._dostore(oid, revid, MinPO(3))
+        self._dostore(data=MinPO(4))
+        self.assertEqual(len(storage._tids), 1)
+        self.assertRaises(POSException.ConflictError,
+                          self._dostore, oid, z64, MinPO(5))
+        self.assertEqual(list(storage._tids.values()), [revid])
+
+        self._storage.close()
+        self.open(tid_cache_size=0)
+        self._dostore(oid, revid, MinPO(5))
+        self.assertEqual(
+            len(getattr(self._storage, 'base', self._storage)._tids), 0)
+
+    def checkRevisionIndex(self):
+        from ZODB.serialize import referencesf
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage.revisionIndexStatistics(), None)
+        self._storage.close()
+        self.open(revision_index_size=1000)
+        storage = getattr(self._storage, 'base', self._storage)
+        oid = z64
+        tids = [self._dostore(oid, data=MinPO(0))]
+        for i in range(1, 30):
+            tids.append(self._dostore(oid, tids[-1], MinPO(i)))
+        self.assertEqual(storage.revisionIndexStatistics()['objects'], 0)
+
+        # Objects are indexed when many records are read to load them.
+        self.assertEqual(self._storage.loadBefore(oid, tids[1]),
+                         (zodb_pickle(MinPO(0)), tids[0], tids[1]))
+        stats = storage.revisionIndexStatistics()
+        self.assertEqual((stats['objects'], stats['revisions']), (1, 30))
+
+        def check_loads(first=0):
+            self.assertEqual(self._storage.loadBefore(oid, tids[0]), None)
+            for i in range(1, len(tids)):
+                self.assertEqual(
+                    self._storage.loadBefore(oid, tids[i]),
+                    (zodb_pickle(MinPO(first + i - 1)), tids[i - 1], tids[i]))
+                self.assertEqual(self._storage.loadSerial(oid, tids[i]),
+                                 zodb_pickle(MinPO(first + i)))
+            self.assertRaises(POSException.POSKeyError,
+                              self._storage.loadSerial, oid,
+                              p64(U64(tids[3]) + 1))
+
+        check_loads()
+        self.assertTrue(storage.revisionIndexStatistics()['hits'] > 0)
+
+        # Indexed revisions are found without following the chain.
+        read_data_header = storage._read_data_header
+        reads = []
+        def counting_read_data_header(*args):
+            reads.append(args)
+            return read_data_header(*args)
+        storage._read_data_header = counting_read_data_header
+        try:
+            self.assertEqual(storage.loadBefore(oid, tids[2])[1:],
+                             (tids[1], tids[2]))
+        finally:
+            del storage._read_data_header
+        self.assertEqual(len(reads), 1)
+
+        # New revisions are added when the object is next loaded.
+        for i in range(30, 32):
+            tids.append(self._dostore(oid, tids[-1], MinPO(i)))
+        check_loads()
+        self.assertEqual(storage.revisionIndexStatistics()['revisions'], 32)
+
+        # Packing clears the index.
+        self._storage.pack(time.time(), referencesf)
+        self.assertEqual(storage.revisionIndexStatistics()['objects'], 0)
+        self.assertEqual(load_current(self._storage, oid)[1], tids[-1])
+
+        # Only the newest revisions of objects with more revisions
+        # than the index can hold are indexed.
+        self._storage.close()
+        self.open(revision_index_size=10)
+        storage = getattr(self._storage, 'base', self._storage)
+        del tids[:-1]
+        for i in range(32, 50):
+            tids.append(self._dostore(oid, tids[-1], MinPO(i)))
+        check_loads(31)
+        stats = storage.revisionIndexStatistics()
+        self.assertEqual((stats['objects'], stats['revisions']), (1, 10))
+
+        # Older revisions are found from the oldest indexed revision,
+        # without indexing the object again.
+        read_data_header = storage._read_data_header
+        reads = []
+        storage._read_data_header = counting_read_data_header
+        try:
+            self.assertEqual(storage.loadBefore(oid, tids[1])[1:],
+                             (tids[0], tids[1]))
+        finally:
+            del storage._read_data_header
+        self.assertEqual(len(reads), 10)
+
+        tids.append(self._dostore(oid, tids[-1], MinPO(50)))
+        check_loads(31)
+        self.assertEqual(storage.revisionIndexStatistics()['revisions'], 10)
+
+        self._storage.close()
+        self.open(revision_index_size=0)
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage.revisionIndexStatistics(), None)
+        check_loads(31)
+
+    def checkTransactionIndex(self):
+        from ZODB.serialize import referencesf
+        self._storage.close()
+        self.open(tid_index_interval=3)
+        oid = z64
+        tids = [self._dostore(oid, data=MinPO(0))]
+        for i in range(1, 10):
+            tids.append(self._dostore(oid, tids[-1], MinPO(i)))
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage._tid_index.count, 10)
+        self.assertEqual(storage._tid_index.tids, tids[::3])
+
+        def check_iterator(start, expected):
+            it = self._storage.iterator(start)
+            self.assertEqual([t.tid for t in it], expected)
+            it.close()
+
+        for i in range(10):
+            check_iterator(tids[i], tids[i:])
+            check_iterator(p64(U64(tids[i]) - 1), tids[i:])
+        check_iterator(p64(U64(tids[-1]) + 1), [])
+
+        # The index is saved and reused.
+        self._storage.close()
+        self.open(tid_index_interval=3)
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage._tid_index.tids, tids[::3])
+        check_iterator(tids[4], tids[4:])
+
+        # Transactions are found by id when undoing.
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self._storage.undo(self._storage.undoInfo()[0]['id'], t)
+        self._storage.tpc_vote(t)
+        self._storage.tpc_finish(t)
+        self.assertEqual(load_current(self._storage, oid)[0],
+                         zodb_pickle(MinPO(8)))
+
+        # Damaged indexes are ignored.
+        self._storage.close()
+        with open('FileStorageTests.fs.tid_index', 'r+b') as f:
+            f.seek(32)
+            f.write(b'x' * 8)
+        self.open(tid_index_interval=3)
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage._tid_index.count, 0)
+
+        # Until the index covers the file, transactions are found by
+        # searching the file, which doesn't extend the index.
+        undo_tid = self._storage.lastTransaction()
+        check_iterator(tids[5], tids[5:] + [undo_tid])
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self._storage.undo(self._storage.undoInfo()[0]['id'], t)
+        self._storage.tpc_vote(t)
+        self._storage.tpc_finish(t)
+        self.assertEqual(load_current(self._storage, oid)[0],
+                         zodb_pickle(MinPO(9)))
+        self.assertEqual(storage._tid_index.count, 0)
+
+        # Packing indexes the packed file.
+        self._storage.pack(time.time(), referencesf)
+        storage = getattr(self._storage, 'base', self._storage)
+        it = self._storage.iterator()
+        packed = [t.tid for t in it]
+        it.close()
+        self.assertEqual(storage._tid_index.count, len(packed))
+        self.assertEqual(storage._tid_index.pos, storage._pos)
+        check_iterator(tids[0], packed)
+        check_iterator(packed[-1], packed[-1:])
+
+        # Rebuilding the object index rebuilds the transaction index.
+        self._storage.close()
+        os.remove('FileStorageTests.fs.index')
+        os.remove('FileStorageTests.fs.tid_index')
+        self.open(tid_index_interval=3)
+        storage = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(storage._tid_index.count, len(packed))
+        check_iterator(packed[-1], packed[-1:])
+
     def checkFlushAfterTruncate(self, fail=False):
         r0 = self._dostore(z64)
         storage = self._storage
@@ -325,6 +757,352 @@ class FileStorageHexTests(FileStorageTests):
             ZODB.FileStorage.FileStorage('FileStorageTests.fs',**kwargs))
 
 
+class FileStorageSharedCacheTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = ZODB.sharedcache.SharedCacheStorage(
+            ZODB.FileStorage.FileStorage('FileStorageTests.fs', **kwargs),
+            1<<20)
+
+    def checkPrefetch(self):
+        # Loads are satisfied by the shared cache before they reach
+        # the prefetcher, so its statistics aren't comparable.
+        pass
+
+
+class FileStorageMmapTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = ZODB.FileStorage.FileStorage(
+            'FileStorageTests.fs', mmap_reads=True, **kwargs)
+
+    def checkFlushNeededAfterTruncate(self):
+        # The map shares the system's buffers, so there are no read
+        # buffers to flush.
+        self._storage._files.flush = lambda: None
+        self.checkFlushAfterTruncate()
+
+    def checkMappedFileGrows(self):
+        storage = self._storage
+        oid = z64
+        revid = self._dostore(oid, data=MinPO(1))
+        self.assertEqual(load_current(storage, oid),
+                         (zodb_pickle(MinPO(1)), revid))
+        mapped = storage._mapped
+        size = len(mapped.view(0))
+        revid = self._dostore(oid, revid=revid, data=MinPO(2))
+        self.assertEqual(load_current(storage, oid),
+                         (zodb_pickle(MinPO(2)), revid))
+        self.assertTrue(len(mapped.view(0)) > size)
+
+        # Packing replaces the map along with the index, and closes
+        # the old maps, unless they're still being read from.
+        maps = list(mapped._maps)
+        self.assertEqual(len(maps), 2)
+        view = mapped.view(0)
+        from ZODB.serialize import referencesf
+        storage.pack(time.time(), referencesf)
+        self.assertFalse(storage._mapped is mapped)
+        self.assertEqual(load_current(storage, oid),
+                         (zodb_pickle(MinPO(2)), revid))
+        self.assertEqual([m.closed for m in maps], [True, False])
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        self.assertEqual(view[:4].tobytes(), module.packed_version)
+
+    def checkMappedReadsAfterFailedPackSwap(self):
+        from ZODB.serialize import referencesf
+        storage = self._storage
+        oid = z64
+        revid = self._dostore(oid, data=MinPO(1))
+        revid = self._dostore(oid, revid=revid, data=MinPO(2))
+
+        def rename(src, dst):
+            if dst.endswith('.old'):
+                raise OSError("Can't rename %s" % src)
+            return orig_rename(src, dst)
+
+        orig_rename = os.rename
+        os.rename = rename
+        try:
+            self.assertRaises(OSError, storage.pack, time.time(), referencesf)
+        finally:
+            os.rename = orig_rename
+
+        # The data file is still mapped, so data committed after the
+        # failed pack can be read.
+        self.assertFalse(storage._mapped.closed)
+        revid = self._dostore(oid, revid=revid, data=MinPO(3))
+        self.assertEqual(load_current(storage, oid),
+                         (zodb_pickle(MinPO(3)), revid))
+
+
+class FileStorageGroupCommitTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = ZODB.FileStorage.FileStorage(
+            'FileStorageTests.fs', group_commit=True, **kwargs)
+
+    def checkReadersDontWaitForFsync(self):
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid, data=MinPO(1))
+
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        syncing = threading.Event()
+        synced = threading.Event()
+        def fsync(fileno):
+            syncing.set()
+            synced.wait(10)
+
+        thread = threading.Thread(
+            target=self._dostore, args=(oid, revid, MinPO(2)))
+        module.fsync, orig_fsync = fsync, module.fsync
+        try:
+            thread.start()
+            syncing.wait(10)
+            # The new data are visible before they're synced, but
+            # the committer waits for them to be synced.
+            self.assertEqual(load_current(self._storage, oid)[0],
+                             zodb_pickle(MinPO(2)))
+            self.assertTrue(thread.is_alive())
+        finally:
+            synced.set()
+            thread.join(10)
+            module.fsync = orig_fsync
+
+    def checkGroupCommitBatches(self):
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        syncing = threading.Event()
+        synced = threading.Event()
+        fsyncs = []
+        def fsync(fileno):
+            fsyncs.append(fileno)
+            syncing.set()
+            synced.wait(10)
+
+        oids = [self._storage.new_oid() for i in range(5)]
+        threads = [threading.Thread(target=self._dostore, args=(oid,))
+                   for oid in oids]
+        module.fsync, orig_fsync = fsync, module.fsync
+        try:
+            threads[0].start()
+            syncing.wait(10)
+            # While the first transaction is synced, the others are
+            # committed and wait to be synced together.
+            for thread in threads[1:]:
+                thread.start()
+            for i in range(100):
+                if self._storage._group_commit._pending == 4:
+                    break
+                time.sleep(.01)
+        finally:
+            synced.set()
+            for thread in threads:
+                thread.join(10)
+            module.fsync = orig_fsync
+
+        self.assertEqual(len(fsyncs), 2)
+        stats = self._storage.groupCommitStatistics()
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(stats['transactions'], 5)
+        self.assertEqual(stats['max_batch'], 4)
+        self.assertTrue(stats['max_sync_time'] > 0)
+        for oid in oids:
+            load_current(self._storage, oid)
+
+    def checkFailedSyncClosesStorage(self):
+        import zope.testing.loggingsupport
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        def fsync(fileno):
+            raise OSError("sync failed")
+
+        oid = self._storage.new_oid()
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self._storage.store(oid, z64, zodb_pickle(MinPO(1)), '', t)
+        self._storage.tpc_vote(t)
+        handler = zope.testing.loggingsupport.InstalledHandler(
+            'ZODB.FileStorage')
+        module.fsync, orig_fsync = fsync, module.fsync
+        try:
+            # The transaction is committed, so finishing it doesn't
+            # fail, but the storage is closed.
+            tid = self._storage.tpc_finish(t)
+        finally:
+            module.fsync = orig_fsync
+            handler.uninstall()
+        self.assertEqual(
+            [(r.levelname, r.getMessage()) for r in handler.records
+             if r.levelname == 'CRITICAL'],
+            [('CRITICAL', "Failure syncing committed data. Closing.")])
+        self.assertTrue(self._storage._file.closed)
+
+        self.open()
+        self.assertEqual(load_current(self._storage, oid)[1], tid)
+
+
+class FileStorageArrayIndexTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = ZODB.FileStorage.FileStorage(
+            'FileStorageTests.fs', array_index=True, **kwargs)
+
+    def check_use_fsIndex(self):
+        self.assertEqual(self._storage._index.__class__, fsArrayIndex)
+
+    def check_conversion_to_fsIndex(self, read_only=False):
+        for i in range(10):
+            self._dostore()
+        oldindex_as_dict = dict(self._storage._index.items())
+        self._storage.close()
+
+        # Indexes saved as dicts are converted.
+        self.convert_index_to_dict()
+        self.open(read_only=read_only)
+        self.assertTrue(isinstance(self._storage._index, fsArrayIndex))
+        self.assertEqual(dict(self._storage._index.items()),
+                         oldindex_as_dict)
+        self._storage.close()
+
+        # Indexes saved by fsIndex are converted too.
+        fsIndex(oldindex_as_dict).save(
+            self._storage._pos, 'FileStorageTests.fs.index')
+        self.open(read_only=read_only)
+        self.assertTrue(isinstance(self._storage._index, fsArrayIndex))
+        self.assertEqual(self._storage._used_index, 1)
+        self.assertEqual(dict(self._storage._index.items()),
+                         oldindex_as_dict)
+        self._storage.close()
+
+        # The binary index can still be read by fsIndex.
+        with open('FileStorageTests.fs.index', 'rb') as f:
+            self.assertEqual(f.read(4) == b'FSAI', not read_only)
+        self.assertEqual(
+            dict(fsIndex.load('FileStorageTests.fs.index')['index']),
+            oldindex_as_dict)
+
+    def check_conversion_from_dict_to_btree_data_in_fsIndex(self):
+        # Not applicable to array indexes.
+        pass
+
+
+class FileStorageIndexCheckpointTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        self._storage = ZODB.FileStorage.FileStorage(
+            'FileStorageTests.fs', index_checkpoint_interval=1, **kwargs)
+
+    def copy_without_closing(self, name='FileStorageTests.fs'):
+        # Copy the storage's files as they'd be after a crash.
+        self._storage._checkpointer.flush()
+        for ext in '', '.index', '.index_delta':
+            if os.path.exists(name + ext):
+                shutil.copy(name + ext, 'Copy' + ext)
+            elif os.path.exists('Copy' + ext):
+                os.remove('Copy' + ext)
+
+    def checkIndexCheckpoints(self):
+        read_index_deltas = sys.modules[
+            'ZODB.FileStorage.FileStorage'].read_index_deltas
+        for i in range(10):
+            self._dostore()
+        self.copy_without_closing()
+        info = fsIndex.load('Copy.index')
+        index = info['index']
+        self.assertEqual(read_index_deltas('Copy', index, info['pos']),
+                         self._storage._pos)
+        self.assertEqual(dict(index.items()),
+                         dict(self._storage._index.items()))
+
+        # As the delta file grew larger than the index file, the
+        # changes were merged into the index file.
+        self.assertTrue(self._storage._checkpointer.merges > 0)
+        self.assertTrue(info['pos'] > 4)
+
+        copy = ZODB.FileStorage.FileStorage('Copy', read_only=True)
+        self.assertEqual(copy._used_index, 1)
+        self.assertEqual(dict(copy._index.items()),
+                         dict(self._storage._index.items()))
+        copy.close()
+
+        # Closing saves the full index.
+        self._storage.close()
+        self.assertFalse(os.path.exists('FileStorageTests.fs.index_delta'))
+        self.open()
+        self.assertEqual(self._storage._used_index, 1)
+
+    def checkIncompleteIndexCheckpointsAreIgnored(self):
+        for i in range(3):
+            self._dostore()
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid)
+        self.copy_without_closing()
+        with open('Copy.index_delta', 'r+b') as f:
+            f.seek(-1, 2)
+            f.write(b'x')
+        self._storage.close()
+        self._storage = ZODB.FileStorage.FileStorage(
+            'Copy', index_checkpoint_interval=1)
+        self.assertEqual(self._storage.getTid(oid), revid)
+
+        # The changes scanned when the copy was opened are saved with
+        # the next checkpoint, and the incomplete one is discarded.
+        self._dostore(oid, revid)
+        os.mkdir('crashed')
+        os.chdir('crashed')
+        self.copy_without_closing('../Copy')
+        copy = ZODB.FileStorage.FileStorage('Copy', read_only=True)
+        self.assertEqual(dict(copy._index.items()),
+                         dict(self._storage._index.items()))
+        self.assertEqual(copy._pos, self._storage._pos)
+        copy.close()
+        os.chdir('..')
+
+    def checkUnmergedIndexCheckpointsAreKept(self):
+        import struct, zlib
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        def delta(start, end, changes):
+            h = struct.pack(module.INDEX_DELTA_HDR, module.INDEX_DELTA_MAGIC,
+                            start, end, len(changes))
+            data = b''.join(p64(oid) + p64(pos)
+                            for oid, pos in sorted(changes.items()))
+            return h + data + struct.pack(
+                '>I', zlib.crc32(h + data) & 0xffffffff)
+        fsIndex({p64(1): 4}).save(10, 'Deltas.index')
+        # Out of order, overlapping, and after a gap.
+        saved = [delta(20, 30, {2: 20}), delta(5, 15, {9: 5}),
+                 delta(10, 20, {1: 10}), delta(40, 50, {3: 40})]
+        with open('Deltas.index_delta', 'wb') as f:
+            f.writelines(saved)
+
+        index = fsIndex()
+        unmerged = []
+        self.assertEqual(
+            module.read_index_deltas('Deltas', index, 10, unmerged), 30)
+        self.assertEqual(dict(index), {p64(1): 10, p64(2): 20})
+        self.assertEqual(unmerged, [saved[3]])
+
+        # Merging keeps the changes after the gap.
+        checkpointer = module.IndexCheckpointer('Deltas', fsIndex, 30, 10)
+        checkpointer.flush()
+        self.assertEqual(checkpointer.merges, 1)
+        info = fsIndex.load('Deltas.index')
+        self.assertEqual(info['pos'], 30)
+        self.assertEqual(dict(info['index']), {p64(1): 10, p64(2): 20})
+        with open('Deltas.index_delta', 'rb') as f:
+            self.assertEqual(f.read(), saved[3])
+
+        # And merges them once the gap is filled.
+        checkpointer.update({p64(4): 30}, 40)
+        checkpointer.flush()
+        checkpointer.close()
+        self.assertEqual(checkpointer.merges, 2)
+        info = fsIndex.load('Deltas.index')
+        self.assertEqual(info['pos'], 50)
+        self.assertEqual(dict(info['index']), {p64(1): 10, p64(2): 20,
+                                               p64(3): 40, p64(4): 30})
+        self.assertFalse(os.path.exists('Deltas.index_delta'))
+
+
 class FileStorageTestsWithBlobsEnabled(FileStorageTests):
 
     def open(self, **kwargs):
@@ -456,6 +1234,151 @@ class AnalyzeDotPyTest(StorageTestBase.StorageTestBase):
         self.assertAlmostEqual(cumpct, 100.0, 0,
                                "Failed to analyze some records")
 
+class ParallelReadIndexTest(StorageTestBase.StorageTestBase):
+
+    def setUp(self):
+        StorageTestBase.StorageTestBase.setUp(self)
+        self._storage = ZODB.FileStorage.FileStorage("Source.fs", create=True)
+        self.oids = [self._storage.new_oid() for i in range(20)]
+        revids = {}
+        for i in range(200):
+            oid = self.oids[i % 20]
+            revids[oid] = self._dostore(
+                oid, revids.get(oid), data=MinPO('x' * (i * 7 % 500)),
+                description='t' * (i % 30))
+
+    def read_index(self, name, **kw):
+        index = fsIndex()
+        with open(name, 'r+b') as f:
+            pos, maxoid, ltid = sys.modules[
+                'ZODB.FileStorage.FileStorage'].read_index(
+                    f, name, index, {}, **kw)
+        return pos, maxoid, ltid, dict(index.items())
+
+    def check_matches_serial_scan(self):
+        self._storage.close()
+        serial = self.read_index('Source.fs')
+        progress = []
+        self.assertEqual(
+            self.read_index('Source.fs', processes=2, chunk_size=1000,
+                            progress=lambda *a: progress.append(a)),
+            serial)
+        size = os.path.getsize('Source.fs')
+        self.assertEqual(progress[-1], (size, size))
+        self.assertEqual(sorted(progress), progress)
+        self.assertTrue(len(progress) > size // 1000 // 2)
+
+        # The scan can start part way through the file, and stop at a tid.
+        it = ZODB.FileStorage.FileIterator('Source.fs')
+        txns = [(txn._tpos, txn.tid) for txn in it]
+        it.close()
+        start = txns[50][0]
+        ltid = txns[49][1]
+        stop = txns[150][1]
+        self.assertEqual(
+            self.read_index('Source.fs', processes=2, chunk_size=1000,
+                            start=start, ltid=ltid, stop=stop),
+            self.read_index('Source.fs', start=start, ltid=ltid, stop=stop))
+
+    def check_truncated_file(self):
+        self._storage.close()
+        size = os.path.getsize('Source.fs')
+        with open('Source.fs', 'r+b') as f:
+            f.truncate(size - 10)
+        shutil.copy('Source.fs', 'Copy.fs')
+        self.assertEqual(
+            self.read_index('Copy.fs', processes=2, chunk_size=1000),
+            self.read_index('Source.fs'))
+        self.assertEqual(os.path.getsize('Copy.fs'),
+                         os.path.getsize('Source.fs'))
+
+    def check_fooled_by_data_that_look_like_transactions(self):
+        self._storage.close()
+        with open('Source.fs', 'rb') as f:
+            data = f.read()
+        self._storage = ZODB.FileStorage.FileStorage("Source.fs")
+        # Records that contain copies of transactions make false
+        # boundaries in the chunks they start in.
+        for i in range(3):
+            self._dostore(data=MinPO(data[4:]))
+        self._storage.close()
+        self.assertEqual(
+            self.read_index('Source.fs', processes=3, chunk_size=5000),
+            self.read_index('Source.fs'))
+
+    def check_transaction_index(self):
+        self._storage.close()
+        TransactionIndex = sys.modules[
+            'ZODB.FileStorage.FileStorage'].TransactionIndex
+        serial = TransactionIndex(3)
+        parallel = TransactionIndex(3)
+        self.read_index('Source.fs', tid_index=serial)
+        self.read_index('Source.fs', processes=2, chunk_size=1000,
+                        tid_index=parallel)
+        self.assertEqual(parallel.count, 200)
+        self.assertEqual(
+            (parallel.tids, parallel.positions, parallel.pos, parallel.count),
+            (serial.tids, serial.positions, serial.pos, serial.count))
+
+    def check_broken_previous_pointer_where_chunks_join(self):
+        import zope.testing.loggingsupport
+        self._storage.close()
+        # Find a record late in the file that's the first of its
+        # object in its chunk.
+        chunk_size = 1000
+        it = ZODB.FileStorage.FileIterator('Source.fs')
+        seen = {}
+        for txn in it:
+            chunk = (txn._tpos - 4) // chunk_size
+            for record in txn:
+                if (record.oid not in seen.get(chunk, ()) and
+                        txn._tpos > 20 * chunk_size):
+                    break
+                seen.setdefault(chunk, set()).add(record.oid)
+            else:
+                continue
+            break
+        it.close()
+        with open('Source.fs', 'r+b') as f:
+            f.seek(record.pos + 16)
+            f.write(p64(4))
+
+        def scan(**kw):
+            handler = zope.testing.loggingsupport.InstalledHandler(
+                'ZODB.FileStorage')
+            try:
+                result = self.read_index('Source.fs', **kw)
+            finally:
+                handler.uninstall()
+            return result, [r.getMessage() for r in handler.records
+                            if r.levelname == 'ERROR']
+
+        serial = scan()
+        self.assertEqual(
+            serial[1],
+            ["Source.fs incorrect previous pointer at %s" % record.pos])
+        self.assertEqual(
+            scan(processes=2, chunk_size=chunk_size), serial)
+
+    def check_index_rebuild_processes(self):
+        self._storage.close()
+        os.remove('Source.fs.index')
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        read_index = module.read_index
+        calls = []
+        def read_index_recording(*args, **kw):
+            calls.append(kw)
+            return read_index(*args, **kw)
+        module.read_index = read_index_recording
+        try:
+            self._storage = ZODB.FileStorage.FileStorage(
+                "Source.fs", index_rebuild_processes=4)
+        finally:
+            module.read_index = read_index
+        self.assertEqual(calls[0]['processes'], 4)
+        self.assertEqual(len(self._storage), 20)
+
+
 # Raise an exception if the tids in FileStorage fs aren't
 # strictly increasing.
 def checkIncreasingTids(fs):
@@ -708,9 +1631,11 @@ def test_suite():
         FileStorageTests, FileStorageHexTests,
         Corruption.FileStorageCorruptTests,
         FileStorageRecoveryTest, FileStorageHexRecoveryTest,
-        FileStorageNoRestoreRecoveryTest,
+        FileStorageNoRestoreRecoveryTest, FileStorageSharedCacheTests,
+        FileStorageMmapTests, FileStorageGroupCommitTests,
+        FileStorageArrayIndexTests, FileStorageIndexCheckpointTests,
         FileStorageTestsWithBlobsEnabled, FileStorageHexTestsWithBlobsEnabled,
-        AnalyzeDotPyTest,
+        AnalyzeDotPyTest, ParallelReadIndexTest,
         ]:
         suite.addTest(unittest.makeSuite(klass, "check"))
     suite.addTest(doctest.DocTestSuite(
@@ -15,6 +15,7 @@
 import doctest
 import random
 import re
+import tempfile
 import unittest
 from persistent import Persistent
 
@@ -128,6 +129,34 @@ class TestUtils(unittest.TestCase):
             self.assertEqual(get_pickle_metadata(pickle),
                             (__name__, ExampleClass.__name__))
 
+    def test_fastcp(self):
+        from ZODB.utils import fastcp
+        from ZODB._compat import BytesIO
+        data = bytes(bytearray(range(256))) * 100
+        for source, target in (
+            (tempfile.TemporaryFile(), tempfile.TemporaryFile()),
+            (BytesIO(), tempfile.TemporaryFile()),
+            (tempfile.TemporaryFile(), BytesIO()),
+            ):
+            source.write(data)
+            source.seek(0)
+            # Whole files
+            fastcp(source, target)
+            self.assertEqual(source.tell(), len(data))
+            self.assertEqual(target.tell(), len(data))
+            # Ranges, at the files' positions
+            source.seek(10)
+            target.write(b'x')
+            fastcp(source, target, 1000)
+            self.assertEqual(source.tell(), 1010)
+            self.assertEqual(target.tell(), len(data) + 1001)
+            target.write(b'y')
+            target.seek(0)
+            self.assertEqual(target.read(),
+                             data + b'x' + data[10:1010] + b'y')
+            source.close()
+            target.close()
+
 
 class ExampleClass(object):
     pass
@@ -122,6 +122,123 @@ class ZODBTests(ZODB.tests.util.TestCase):
     def checkExportImportAborted(self):
         self.checkExportImport(abort_it=True)
 
+    def checkExportImportDeferred(self):
+        import tempfile
+        self.populate()
+        conn = self._db.open()
+        try:
+            root = conn.root()
+            ob = root['test']
+            with tempfile.TemporaryFile() as f:
+                conn.exportFile(ob._p_oid, f)
+                f.seek(0)
+                conn.store_batch_size = 10
+                storeMany = self._storage.storeMany
+                batches = []
+                def store_many(records, transaction):
+                    records = list(records)
+                    batches.append(len(records))
+                    return storeMany(records, transaction)
+                self._storage.storeMany = store_many
+                try:
+                    transaction.begin()
+                    oid = conn.importFile(f, defer=True)
+                    # Nothing is imported until the transaction is
+                    # committed.
+                    self.assertEqual(conn._savepoint_storage, None)
+                    self.assertEqual(batches, [])
+                    transaction.commit()
+                finally:
+                    del self._storage.storeMany
+            self.assertEqual(batches, [10] * 10 + [1])
+
+            transaction.begin()
+            root['dup'] = conn.get(oid)
+            transaction.commit()
+        finally:
+            conn.close()
+        conn = self._db.open()
+        try:
+            self.verify(conn, False)
+        finally:
+            conn.close()
+
+    def checkExportImportDeferredAborted(self):
+        self.populate()
+        conn = self._db.open()
+        try:
+            ob = conn.root()['test']
+            conn.exportFile(ob._p_oid, 'test.zexp', compress=True).close()
+
+            # Aborting the transaction closes the file opened to
+            # import from.
+            transaction.begin()
+            conn.importFile('test.zexp', defer=True)
+            f = conn._import[2]
+            self.assertFalse(f.closed)
+            transaction.abort()
+            self.assertTrue(f.closed)
+            self.assertEqual(conn._import, None)
+
+            transaction.begin()
+            oid = conn.importFile('test.zexp', defer=True)
+            f = conn._import[2]
+            transaction.commit()
+            self.assertTrue(f.closed)
+
+            transaction.begin()
+            conn.root()['dup'] = conn.get(oid)
+            transaction.commit()
+        finally:
+            conn.close()
+        conn = self._db.open()
+        try:
+            self.verify(conn, False)
+        finally:
+            conn.close()
+
+    def checkExportImportCompressed(self):
+        import tempfile
+        import zlib
+        self.populate()
+        conn = self._db.open()
+        try:
+            root = conn.root()
+            ob = root['test']
+            with tempfile.TemporaryFile() as f:
+                conn.exportFile(ob._p_oid, f)
+                f.seek(0)
+                exported = f.read()
+
+            progress = []
+            with tempfile.TemporaryFile() as f:
+                conn.exportFile(ob._p_oid, f, compress=True, batch_size=7,
+                                progress=lambda *a: progress.append(a))
+                f.seek(0)
+                compressed = f.read()
+                self.assertEqual(compressed[:4], b'ZEXZ')
+                self.assertEqual(zlib.decompress(compressed[4:]),
+                                 exported[4:])
+                self.assertTrue(len(compressed) < len(exported))
+
+                f.seek(0)
+                transaction.begin()
+                root['dup'] = conn.importFile(f)
+                transaction.commit()
+
+            # The root is exported on its own, then its 100 subobjects
+            # in batches of 7.
+            self.assertEqual(len(progress), 16)
+            self.assertEqual([n for n, size in progress][:3], [1, 8, 15])
+            self.assertEqual(progress[-1][0], 101)
+        finally:
+            conn.close()
+        conn = self._db.open()
+        try:
+            self.verify(conn, False)
+        finally:
+            conn.close()
+
     def checkResetCache(self):
         # The cache size after a reset should be 0.  Note that
         # _resetCache is not a public API, but the resetCaches()
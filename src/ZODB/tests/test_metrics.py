@@ -0,0 +1,157 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+import unittest
+
+import ZODB
+import ZODB.FileStorage
+import ZODB.tests.util
+from ZODB.blob import Blob, BlobStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.metrics import Registry
+
+
+def samples(registry):
+    return dict(line.rsplit(' ', 1)
+                for line in registry.exposition().splitlines()
+                if not line.startswith('#'))
+
+
+class RegistryTests(unittest.TestCase):
+
+    def test_counter(self):
+        registry = Registry(db='main')
+        counter = registry.counter('things_total', 'Things')
+        self.assertTrue(registry.counter('things_total') is counter)
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(registry.exposition(),
+                         '# HELP things_total Things\n'
+                         '# TYPE things_total counter\n'
+                         'things_total{db="main"} 3\n')
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('t_seconds', buckets=(.1, 1))
+        for value in .05, .1, .5, 5:
+            histogram.observe(value)
+        self.assertEqual(registry.exposition(),
+                         '# TYPE t_seconds histogram\n'
+                         't_seconds_bucket{le="0.1"} 2\n'
+                         't_seconds_bucket{le="1.0"} 3\n'
+                         't_seconds_bucket{le="+Inf"} 4\n'
+                         't_seconds_sum 5.65\n'
+                         't_seconds_count 4\n')
+
+    def test_type_conflict(self):
+        registry = Registry()
+        registry.counter('x')
+        with self.assertRaises(ValueError):
+            registry.histogram('x')
+
+    def test_include(self):
+        registry = Registry(db='main')
+        storage = Registry(storage='Data.fs')
+        registry.include(storage)
+        registry.include(storage)
+        storage.include(registry)  # Cycles are ignored.
+        registry.counter('x_total').inc()
+        storage.counter('x_total').inc(2)
+        storage.counter('y_total', 'Say "y"\\n').inc(3)
+        self.assertEqual(registry.exposition(),
+                         '# TYPE x_total counter\n'
+                         'x_total{db="main"} 1\n'
+                         'x_total{db="main",storage="Data.fs"} 2\n'
+                         '# HELP y_total Say "y"\\\\n\n'
+                         '# TYPE y_total counter\n'
+                         'y_total{db="main",storage="Data.fs"} 3\n')
+
+
+class DatabaseMetricsTests(ZODB.tests.util.TestCase):
+
+    def test_filestorage(self):
+        storage = ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs')
+        db = ZODB.DB(storage, database_name='main')
+        self.assertTrue(db.metrics is not storage.metrics)
+        with db.transaction() as conn:
+            conn.root.x = 1
+            conn.root.b = Blob(b'data')
+        conn = db.open()
+        conn.cacheMinimize()
+        with conn.root.b.open() as f:
+            self.assertEqual(f.read(), b'data')
+        conn.close()
+
+        metrics = samples(db.metrics)
+        labels = '{database="main",storage="data.fs"}'
+        self.assertEqual(
+            metrics['zodb_pool_checkout_wait_seconds_count{database="main"}'],
+            '3')
+        self.assertEqual(
+            metrics['zodb_connection_tpc_finish_seconds_count'
+                    '{database="main"}'], '2')
+        self.assertEqual(
+            metrics['zodb_connection_tpc_vote_seconds_count'
+                    '{database="main"}'], '2')
+        self.assertEqual(
+            metrics['zodb_connection_store_seconds_count{database="main"}'],
+            '3')
+        self.assertTrue(
+            int(metrics['zodb_connection_load_seconds_count'
+                        '{database="main"}']) >= 2)
+        self.assertTrue(
+            int(metrics['zodb_connection_cache_evictions_total'
+                        '{database="main"}']) >= 0)
+        self.assertEqual(
+            metrics['zodb_filestorage_fsync_seconds_count' + labels], '2')
+        self.assertTrue(
+            int(metrics['zodb_filestorage_file_pool_wait_seconds_count'
+                        + labels]) >= 2)
+        self.assertEqual(metrics['zodb_blob_store_seconds_count' + labels],
+                         '1')
+        self.assertEqual(metrics['zodb_blob_opens_total' + labels], '1')
+        db.close()
+
+    def test_group_commit(self):
+        db = ZODB.DB('data.fs', group_commit=True)
+        with db.transaction() as conn:
+            conn.root.x = 1
+        self.assertEqual(
+            samples(db.metrics)[
+                'zodb_filestorage_fsync_seconds_count'
+                '{database="unnamed",storage="data.fs"}'], '2')
+        db.close()
+
+    def test_blobstorage(self):
+        storage = BlobStorage('blobs', MappingStorage())
+        db = ZODB.DB(storage)
+        with db.transaction() as conn:
+            conn.root.b = Blob(b'data')
+        self.assertEqual(
+            samples(db.metrics)[
+                'zodb_blob_store_seconds_count{database="unnamed"}'], '1')
+        db.close()
+
+    def test_shared_cache(self):
+        db = ZODB.DB('data.fs', shared_cache_size_bytes=1<<20)
+        self.assertTrue(
+            'zodb_filestorage_fsync_seconds_count'
+            '{database="unnamed",storage="data.fs"}' in samples(db.metrics))
+        db.close()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(RegistryTests),
+        unittest.makeSuite(DatabaseMetricsTests),
+        ))
@@ -58,3 +58,42 @@ class TestHistoricalStorageAdapter(unittest.TestCase):
         adapter.release()
 
         self.assertTrue(base.released)
+
+    def test_provides_IMVCCMultiLoadStorage(self):
+        from ZODB.interfaces import IMVCCMultiLoadStorage
+        adapter = mvccadapter.HistoricalStorageAdapter(object(), None)
+        self.assertTrue(IMVCCMultiLoadStorage.providedBy(adapter))
+
+
+class TestMVCCAdapterInstance(unittest.TestCase):
+
+    def test_provides_IMVCCMultiLoadStorage(self):
+        from ZODB.interfaces import IMVCCMultiLoadStorage
+        self.assertTrue(IMVCCMultiLoadStorage.implementedBy(
+            mvccadapter.MVCCAdapterInstance))
+
+    def test_loadMany(self):
+        from ZODB.POSException import ReadConflictError
+        from ZODB.utils import p64, z64
+
+        class Storage(object):
+
+            def loadBefore(self, oid, tid):
+                if oid == z64:
+                    return None
+                return b'data' + oid, p64(1), None
+
+            def lastTransaction(self):
+                return p64(1)
+
+        adapter = mvccadapter.MVCCAdapter(Storage())
+        instance = adapter.new_instance()
+        instance.poll_invalidations()
+        self.assertEqual(instance.loadMany([p64(1), p64(2)]),
+                         {p64(1): (b'data' + p64(1), p64(1)),
+                          p64(2): (b'data' + p64(2), p64(1))})
+
+        with self.assertRaises(ReadConflictError):
+            instance.loadMany([p64(1), z64])
+
+        instance.release()
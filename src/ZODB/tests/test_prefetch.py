@@ -1,7 +1,10 @@
+import time
 import unittest
 
 from ZODB.utils import z64, u64
 import ZODB
+import ZODB.FileStorage
+import ZODB.tests.util
 
 from .MVCCMappingStorage import MVCCMappingStorage
 
@@ -55,5 +58,35 @@ class PrefetchTests(unittest.TestCase):
         conn.close()
 
 
+class FileStoragePrefetchTests(ZODB.tests.util.TestCase):
+
+    def test_prefetch_filestorage(self):
+        db = ZODB.DB(ZODB.FileStorage.FileStorage(
+            'data.fs', prefetch_cache_size=10))
+        with db.transaction() as conn:
+            for i in range(10):
+                conn.root()[i] = conn.root().__class__()
+
+        conn = db.open()
+        conn.cacheMinimize()
+        conn.prefetch(conn.root()[i] for i in range(5))
+        prefetcher = db.storage._prefetcher
+        for i in range(100):
+            if len(prefetcher._records) == 5:
+                break
+            time.sleep(.01)
+        self.assertEqual(len(prefetcher._records), 5)
+
+        for i in range(5):
+            conn.root()[i]._p_activate()
+        self.assertEqual(prefetcher.hits, 5)
+
+        conn.close()
+        db.close()
+
+
 def test_suite():
-    return unittest.makeSuite(PrefetchTests)
+    return unittest.TestSuite((
+        unittest.makeSuite(PrefetchTests),
+        unittest.makeSuite(FileStoragePrefetchTests),
+        ))
@@ -0,0 +1,123 @@
+##############################################################################
+#
+# Copyright (c) 2017 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+import unittest
+
+import transaction
+
+import ZODB
+import ZODB.config
+import ZODB.tests.util
+from ZODB.sharedcache import SharedCache, SharedCacheStorage
+from ZODB.utils import p64, z64
+
+class SharedCacheTests(unittest.TestCase):
+
+    def test_validity_ranges(self):
+        cache = SharedCache(100)
+        cache.store(z64, b'old', p64(1), p64(5), cache.generation)
+        cache.store(z64, b'new', p64(5), None, cache.generation)
+
+        self.assertEqual(cache.get(z64, p64(1)), None)
+        self.assertEqual(cache.get(z64, p64(2)), (b'old', p64(1), p64(5)))
+        self.assertEqual(cache.get(z64, p64(5)), (b'old', p64(1), p64(5)))
+        self.assertEqual(cache.get(z64, p64(6)), (b'new', p64(5), None))
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+        cache.invalidate([z64], p64(9))
+        self.assertEqual(cache.get(z64, p64(9)), (b'new', p64(5), p64(9)))
+        self.assertEqual(cache.get(z64, p64(10)), None)
+
+    def test_lru_eviction(self):
+        cache = SharedCache(10)
+        for i in range(3):
+            cache.store(p64(i), b'xxxx', p64(1), None, cache.generation)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.total_bytes, 8)
+        self.assertEqual(cache.get(p64(0), p64(2)), None)
+
+        # Using a record makes it recently used
+        cache.get(p64(1), p64(2))
+        cache.store(p64(3), b'xxxx', p64(1), None, cache.generation)
+        self.assertEqual(cache.get(p64(2), p64(2)), None)
+        self.assertEqual(cache.get(p64(1), p64(2)), (b'xxxx', p64(1), None))
+
+        # Records larger than the cache aren't stored.
+        cache.store(p64(4), b'x' * 11, p64(1), None, cache.generation)
+        self.assertEqual(cache.get(p64(4), p64(2)), None)
+        self.assertEqual(cache.statistics()['records'], 2)
+
+    def test_records_invalidated_while_loading_arent_cached_as_current(self):
+        cache = SharedCache(100)
+        generation = cache.generation
+        cache.invalidate([z64], p64(3))
+        cache.store(z64, b'data', p64(1), None, generation)
+        self.assertEqual(len(cache), 0)
+
+        # Non-current records are immutable.
+        cache.store(z64, b'data', p64(1), p64(3), generation)
+        self.assertEqual(len(cache), 1)
+
+        # Other objects aren't affected.
+        cache.store(p64(1), b'data', p64(1), None, generation)
+        self.assertEqual(len(cache), 2)
+
+        generation = cache.generation
+        cache.clear()
+        cache.store(p64(1), b'data', p64(1), None, generation)
+        self.assertEqual(len(cache), 0)
+
+
+class SharedCacheStorageTests(ZODB.tests.util.TestCase):
+
+    def test_shared_between_connections(self):
+        db = ZODB.DB('data.fs', shared_cache_size_bytes=1<<20)
+        self.assertTrue(isinstance(db.storage, SharedCacheStorage))
+        with db.transaction() as conn:
+            conn.root.x = 1
+
+        tm1 = transaction.TransactionManager()
+        conn1 = db.open(tm1)
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(tm2)
+        self.assertEqual(conn1.root.x, 1)
+        stats = db.sharedCacheStatistics()
+        self.assertEqual(conn2.root.x, 1)
+        self.assertEqual(db.sharedCacheStatistics()['hits'],
+                         stats['hits'] + 1)
+
+        conn1.root.x = 2
+        tm1.commit()
+        tm2.begin()
+        self.assertEqual(conn2.root.x, 2)
+
+        # A historical connection sees the old record:
+        conn3 = db.open(before=conn1.root()._p_serial)
+        self.assertEqual(conn3.root.x, 1)
+        db.close()
+
+    def test_no_shared_cache_by_default(self):
+        db = ZODB.DB(None)
+        self.assertEqual(db.sharedCacheStatistics(), None)
+        db.close()
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+        <zodb>
+          shared-cache-size-bytes 1MB
+          <mappingstorage/>
+        </zodb>
+        """)
+        self.assertEqual(db.sharedCacheStatistics()['size_bytes'], 1<<20)
+        db.close()
@@ -24,6 +24,9 @@ if os.environ.get('USE_ZOPE_TESTING_DOCTEST'):
 else:
     import doctest
 
+import binascii
+import hashlib
+import logging
 import os
 import random
 import re
@@ -34,10 +37,14 @@ import transaction
 import unittest
 import ZConfig
 import ZODB.blob
+import ZODB.config
 import ZODB.interfaces
+import ZODB.MappingStorage
 import ZODB.tests.IteratorStorage
 import ZODB.tests.StorageTestBase
 import ZODB.tests.util
+import ZODB.utils
+import zope.testing.loggingsupport
 import zope.testing.renormalizing
 
 
@@ -97,6 +104,22 @@ class ZODBBlobConfigTest(ConfigTestBase):
             </zodb>
             """)
 
+    def test_pack_threads(self):
+        db = ZODB.config.databaseFromString(
+            """
+            <zodb>
+              <blobstorage>
+                blob-dir blobs
+                pack-threads 2
+                fsync false
+                <mappingstorage/>
+              </blobstorage>
+            </zodb>
+            """)
+        self.assertEqual(db.storage.pack_threads, 2)
+        self.assertFalse(db.storage._blob_fsync)
+        db.close()
+
     def test_blob_dir_needed(self):
         self.assertRaises(ZConfig.ConfigurationSyntaxError,
                           self._test,
@@ -164,6 +187,514 @@ class BushyLayoutTests(ZODB.tests.util.TestCase):
             non_ascii_oid )
 
 
+class BlobManifestTests(ZODB.tests.util.TestCase):
+
+    def commit(self, db, **blobs):
+        with db.transaction() as conn:
+            for name, data in sorted(blobs.items()):
+                if name not in conn.root():
+                    conn.root()[name] = Blob()
+                with conn.root()[name].open('w') as f:
+                    f.write(data)
+        return db.storage.lastTransaction()
+
+    def files(self, fshelper):
+        # The (oid, tid, size) of the files found by walking
+        return sorted(
+            (oid, tid, os.path.getsize(fshelper.getBlobFilename(oid, tid)))
+            for oid, path in fshelper.walkOIDs()
+            for oid, tid in [fshelper.splitBlobFilename(
+                os.path.join(path, name)) for name in os.listdir(path)]
+            )
+
+    def test_maintained_by_commits(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        fshelper = db.storage.fshelper
+        manifest = fshelper.manifest
+        self.assertTrue(os.path.exists(manifest.path))
+        tid1 = self.commit(db, a=b'a', b=b'bb')
+        tid2 = self.commit(db, b=b'bbb')
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(manifest.items(), self.files(fshelper))
+        oid_a, oid_b = manifest.oids()
+        self.assertEqual(manifest.tids(oid_b), [tid1, tid2])
+        self.assertEqual(fshelper.getOIDsForSerial(tid1), [oid_a, oid_b])
+        self.assertEqual(fshelper.getOIDsForSerial(tid2), [oid_b])
+        self.assertEqual(list(fshelper.listOIDs()),
+                         list(fshelper.walkOIDs()))
+        db.close()
+
+        # The manifest is read from its file.
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.assertEqual(db.storage.fshelper.manifest.items(),
+                         self.files(fshelper))
+        db.close()
+
+    def test_pack(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.commit(db, a=b'a', b=b'b')
+        self.commit(db, a=b'aa')
+        with db.transaction() as conn:
+            del conn.root()['b']
+        db.pack(new_time())
+        manifest = db.storage.fshelper.manifest
+        self.assertEqual(len(manifest), 1)
+        self.assertEqual(manifest.items(), self.files(db.storage.fshelper))
+        db.close()
+
+    def test_rebuilt_when_missing_or_corrupted(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.commit(db, a=b'a')
+        db.close()
+        os.remove(os.path.join('blobs', '.manifest'))
+
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        manifest = db.storage.fshelper.manifest
+        self.assertFalse(os.path.exists(manifest.path))
+        self.commit(db, a=b'aa', b=b'b')
+        self.assertEqual(len(manifest), 3)
+        self.assertTrue(os.path.exists(manifest.path))
+        self.commit(db, b=b'bb')
+        expected = self.files(db.storage.fshelper)
+        self.assertEqual(manifest.items(), expected)
+        db.close()
+
+        with open(manifest.path, 'ab') as f:
+            f.write(b'xx')
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        handler = zope.testing.loggingsupport.InstalledHandler('ZODB.blob')
+        try:
+            self.assertEqual(db.storage.fshelper.manifest.items(), expected)
+        finally:
+            handler.uninstall()
+        self.assertEqual([record.getMessage() for record in handler.records],
+                         ["Rebuilding corrupted blob manifest "
+                          + os.path.abspath(manifest.path)])
+        db.close()
+
+    def test_compact(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        manifest = db.storage.fshelper.manifest
+        manifest.compact_threshold = 2
+        for i in range(4):
+            self.commit(db, a=str(i).encode())
+        self.assertEqual(len(manifest), 4)
+        tids = manifest.tids(manifest.oids()[0])
+        manifest.remove([(manifest.oids()[0], tid) for tid in tids[:3]])
+        with open(manifest.path, 'rb') as f:
+            # The remaining file, and the last transaction
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(len(manifest), 1)
+        db.close()
+
+    def test_recorded_when_voted(self):
+        storage = FileStorage('data.fs', blob_dir='blobs')
+        manifest = storage.fshelper.manifest
+        oid = storage.new_oid()
+        t = transaction.Transaction()
+        storage.tpc_begin(t)
+        filename = os.path.join(storage.temporaryDirectory(), 'b')
+        with open(filename, 'wb') as f:
+            f.write(b'b')
+        storage.storeBlob(oid, ZODB.utils.z64, b'data', filename, '', t)
+        storage.tpc_vote(t)
+        self.assertEqual(manifest.items(), [(oid, storage._tid, 1)])
+        with open(manifest.path, 'rb') as f:
+            self.assertEqual(f.readlines()[-1],
+                             b'tid ' + binascii.hexlify(storage._tid) + b'\n')
+
+        # If the transaction is aborted, its files are removed from
+        # the manifest.
+        storage.tpc_abort(t)
+        self.assertEqual(manifest.items(), [])
+        storage.close()
+
+    def test_rebuilt_when_out_of_date(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.commit(db, a=b'a')
+        db.close()
+        path = os.path.join('blobs', '.manifest')
+        with open(path, 'rb') as f:
+            recorded = f.read()
+
+        # Transactions without blob files don't make the manifest out
+        # of date, as the last transaction is recorded on close.
+        handler = zope.testing.loggingsupport.InstalledHandler(
+            'ZODB.blob', level=logging.INFO)
+        try:
+            db = DB(FileStorage('data.fs', blob_dir='blobs'))
+            with db.transaction() as conn:
+                conn.root()['x'] = 1
+            db.close()
+            db = DB(FileStorage('data.fs', blob_dir='blobs'))
+            self.assertEqual(len(db.storage.fshelper.manifest), 1)
+            tid = self.commit(db, b=b'b')
+            db.close()
+            self.assertEqual(handler.records, [])
+
+            # Simulate a process stopped after the last transaction was
+            # committed, but before it was recorded.
+            with open(path, 'wb') as f:
+                f.write(recorded)
+            db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        finally:
+            handler.uninstall()
+        self.assertEqual([record.getMessage() for record in handler.records],
+                         ["Rebuilding out-of-date blob manifest "
+                          + os.path.abspath(path)])
+        fshelper = db.storage.fshelper
+        self.assertEqual(len(fshelper.getOIDsForSerial(tid)), 1)
+        self.assertEqual(fshelper.manifest.items(), self.files(fshelper))
+        db.close()
+
+    def test_shared_by_storages(self):
+        db = DB(ZODB.blob.BlobStorage(
+            'blobs', ZODB.MappingStorage.MappingStorage()))
+        manifest = db.storage.fshelper.manifest
+        other = ZODB.blob.BlobStorage(
+            'blobs', ZODB.MappingStorage.MappingStorage())
+        self.assertTrue(other.fshelper.manifest is manifest)
+        other.close()
+        self.commit(db, a=b'a')
+        self.assertEqual(len(manifest), 1)
+        db.close()
+
+        # Once closed, the manifest isn't shared with new storages.
+        db = DB(ZODB.blob.BlobStorage(
+            'blobs', ZODB.MappingStorage.MappingStorage()))
+        self.assertFalse(db.storage.fshelper.manifest is manifest)
+        db.close()
+
+    def test_compact_keeps_lines_appended_elsewhere(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        manifest = db.storage.fshelper.manifest
+        self.commit(db, a=b'a')
+        self.commit(db, a=b'aa')
+        oid = manifest.oids()[0]
+        # Another process records a blob file.
+        other_oid = ZODB.utils.p64(42)
+        with open(manifest.path, 'ab') as f:
+            f.write(ZODB.blob._manifest_line(
+                other_oid, db.storage.lastTransaction(), 3))
+        manifest.remove([(oid, manifest.tids(oid)[0])])
+        manifest.compact()
+        self.assertEqual([oid for oid, tid, size in manifest.items()],
+                         [oid, other_oid])
+        with open(manifest.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 3)
+        db.close()
+
+    def test_blobstorage_undo(self):
+        db = DB(ZODB.blob.BlobStorage('blobs', FileStorage('data.fs')))
+        self.commit(db, a=b'a')
+        self.commit(db, a=b'aa')
+        db.undo(db.undoLog(0, 1)[0]['id'])
+        transaction.commit()
+        with db.transaction() as conn:
+            with conn.root()['a'].open() as f:
+                self.assertEqual(f.read(), b'a')
+        manifest = db.storage.fshelper.manifest
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(manifest.items(), self.files(db.storage.fshelper))
+        db.close()
+
+
+class ContentLayoutTests(ZODB.tests.util.TestCase):
+
+    def commit(self, db, **blobs):
+        with db.transaction() as conn:
+            for name, data in sorted(blobs.items()):
+                if name not in conn.root():
+                    conn.root()[name] = Blob()
+                with conn.root()[name].open('w') as f:
+                    f.write(data)
+        return db.storage.lastTransaction()
+
+    def filename(self, db, name, tid=None):
+        with db.transaction() as conn:
+            blob = conn.root()[name]
+            blob._p_activate()
+            return db.storage.fshelper.getBlobFilename(
+                blob._p_oid, tid or blob._p_serial)
+
+    def content(self):
+        return sorted(
+            name for path, dirs, names in os.walk(
+                os.path.join('blobs', ZODB.blob.CONTENT_DIR))
+            for name in names)
+
+    def test_identical_content_is_stored_once(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs',
+                            blob_layout='content'))
+        tid1 = self.commit(db, a=b'same', b=b'same')
+        self.commit(db, a=b'same', c=b'other')
+        self.assertEqual(len(self.content()), 2)
+        a1 = os.stat(self.filename(db, 'a', tid1))
+        self.assertEqual(a1.st_nlink, 4)
+        self.assertEqual(a1.st_ino, os.stat(self.filename(db, 'a')).st_ino)
+        self.assertEqual(a1.st_ino, os.stat(self.filename(db, 'b')).st_ino)
+        with db.transaction() as conn:
+            with conn.root()['a'].open() as f:
+                self.assertEqual(f.read(), b'same')
+            with conn.root()['c'].open('a') as f:
+                f.write(b'!')
+        with db.transaction() as conn:
+            with conn.root()['c'].open() as f:
+                self.assertEqual(f.read(), b'other!')
+        self.assertEqual(len(self.content()), 3)
+        db.close()
+
+    def test_pack_removes_unreferenced_content(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs',
+                            blob_layout='content', pack_keep_old=False))
+        self.commit(db, a=b'a', b=b'b')
+        self.commit(db, a=b'b')
+        with db.transaction() as conn:
+            del conn.root()['b']
+        db.pack(new_time())
+        self.assertEqual(self.content(),
+                         [hashlib.sha256(b'b').hexdigest()])
+        self.assertEqual(
+            os.stat(self.filename(db, 'a')).st_nlink, 2)
+        db.close()
+
+    def test_pack_only_checks_removed_content(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs',
+                            blob_layout='content', pack_keep_old=False))
+        self.commit(db, a=b'a')
+        self.commit(db, a=b'b')
+        # Content nothing links to, but that no packed file linked to.
+        fsh = db.storage.fshelper
+        orphan = fsh.getContentFilename(hashlib.sha256(b'c').hexdigest())
+        os.makedirs(os.path.dirname(orphan))
+        with open(orphan, 'wb') as f:
+            f.write(b'c')
+        db.pack(new_time())
+        self.assertEqual(self.content(),
+                         sorted([hashlib.sha256(b'b').hexdigest(),
+                                 os.path.basename(orphan)]))
+        db.close()
+
+    def store_content(self, fsh, oid, data):
+        filename = os.path.join(fsh.temp_dir, 'new')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        fsh.getPathForOID(oid, create=True)
+        return fsh.storeContent(filename, fsh.getBlobFilename(oid, 1))
+
+    def test_content_stored_while_collected(self):
+        fsh = ZODB.blob.FilesystemHelper('blobs', 'content')
+        fsh.create()
+        # Content is collected just before links to stored content
+        # are made.
+        content_dir = os.path.join(fsh.base_dir, ZODB.blob.CONTENT_DIR)
+        link = os.link
+        def collecting_link(source, target):
+            if source.startswith(content_dir):
+                fsh.collectContent()
+            link(source, target)
+        os.link = collecting_link
+        try:
+            content = self.store_content(fsh, 1, b'data')
+            self.store_content(fsh, 2, b'data')
+        finally:
+            os.link = link
+        self.assertEqual(os.stat(content).st_nlink, 3)
+        for oid in 1, 2:
+            with open(fsh.getBlobFilename(oid, 1), 'rb') as f:
+                self.assertEqual(f.read(), b'data')
+
+    def test_content_linked_while_collected(self):
+        fsh = ZODB.blob.FilesystemHelper('blobs', 'content')
+        fsh.create()
+        content = self.store_content(fsh, 1, b'data')
+        ZODB.blob.remove_committed(fsh.getBlobFilename(1, 1))
+        # The content is stored again after it's found to be unused,
+        # but before it's moved out of the store.
+        rename = os.rename
+        def storing_rename(source, target):
+            if source == content:
+                self.store_content(fsh, 2, b'data')
+            rename(source, target)
+        os.rename = storing_rename
+        try:
+            self.assertEqual(fsh.collectContent(), (0, 0))
+        finally:
+            os.rename = rename
+        self.assertEqual(os.stat(content).st_nlink, 2)
+        self.assertEqual(os.stat(content).st_ino,
+                         os.stat(fsh.getBlobFilename(2, 1)).st_ino)
+        self.assertEqual(fsh.collectContent(), (0, 0))
+        ZODB.blob.remove_committed(fsh.getBlobFilename(2, 1))
+        self.assertEqual(fsh.collectContent(), (1, 4))
+        self.assertEqual(self.content(), [])
+
+    def test_blobstorage_pack_and_undo(self):
+        db = DB(ZODB.blob.BlobStorage('blobs', FileStorage('data.fs'),
+                                      layout='content'))
+        self.commit(db, a=b'a')
+        self.commit(db, a=b'aa')
+        db.undo(db.undoLog(0, 1)[0]['id'])
+        transaction.commit()
+        with db.transaction() as conn:
+            with conn.root()['a'].open() as f:
+                self.assertEqual(f.read(), b'a')
+        self.assertEqual(len(self.content()), 2)
+        db.pack(new_time())
+        stats = db.storage.blobPackStatistics()
+        self.assertEqual((stats['files'], stats['content_files'],
+                          stats['content_bytes']), (2, 1, 2))
+        self.assertEqual(self.content(), [hashlib.sha256(b'a').hexdigest()])
+        db.close()
+
+    def test_migrate(self):
+        from ZODB.scripts.migrateblobs import migrate
+        db = DB(FileStorage('data.fs', blob_dir='bushy'))
+        self.commit(db, a=b'same', b=b'same')
+        db.close()
+        with open(os.devnull, 'w') as out:
+            stdout, sys.stdout = sys.stdout, out
+            try:
+                migrate('bushy', 'blobs', 'content')
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(self.content(),
+                         [hashlib.sha256(b'same').hexdigest()])
+        os.rename('bushy', 'bushy-migrated')
+        db = DB(FileStorage('data.fs', blob_dir='blobs'))
+        self.assertEqual(db.storage.fshelper.layout_name, 'content')
+        with db.transaction() as conn:
+            with conn.root()['b'].open() as f:
+                self.assertEqual(f.read(), b'same')
+        db.close()
+
+
+class BlobCommitTests(ZODB.tests.util.TestCase):
+
+    def store(self, storage, *data):
+        # Store blobs in a new transaction, returning their oids.
+        t = transaction.Transaction()
+        storage.tpc_begin(t)
+        oids = []
+        for d in data:
+            oid = storage.new_oid()
+            filename = os.path.join(storage.temporaryDirectory(),
+                                    'b%d' % len(oids))
+            with open(filename, 'wb') as f:
+                f.write(d)
+            storage.storeBlob(oid, ZODB.utils.z64, b'data', filename, '', t)
+            oids.append(oid)
+        return t, oids
+
+    def test_blob_files_are_put_in_place_when_voted(self):
+        storage = FileStorage('data.fs', blob_dir='blobs')
+        synced = []
+        fsync = os.fsync
+        os.fsync = synced.append
+        try:
+            t, oids = self.store(storage, b'a', b'b')
+            filenames = [storage.fshelper.getBlobFilename(oid, storage._tid)
+                         for oid in oids]
+            self.assertEqual([os.path.exists(name) for name in filenames],
+                             [False, False])
+            storage.tpc_vote(t)
+        finally:
+            os.fsync = fsync
+        self.assertEqual([os.path.exists(name) for name in filenames],
+                         [True, True])
+        # The files, their directories, the 8 directories with the
+        # 9 directories created, and the manifest were synced.
+        self.assertEqual(len(synced), 2 + 2 + 8 + 1)
+        tid = storage.tpc_finish(t)
+        with storage.openCommittedBlobFile(oids[1], tid) as f:
+            self.assertEqual(f.read(), b'b')
+        self.assertEqual(len(storage.fshelper.manifest), 2)
+
+        metrics = storage.metrics.collect()
+        counts = dict((metric.name, metric.count)
+                      for metric, labels in metrics
+                      if metric.name.startswith('zodb_blob_store'))
+        self.assertEqual(counts, {
+            'zodb_blob_store_seconds': 1,
+            'zodb_blob_store_directories_seconds': 1,
+            'zodb_blob_store_files_seconds': 1,
+            'zodb_blob_store_sync_seconds': 1,
+            })
+        storage.close()
+
+    def test_abort_removes_staged_files(self):
+        storage = FileStorage('data.fs', blob_dir='blobs')
+        t, oids = self.store(storage, b'a')
+        storage.tpc_abort(t)
+        self.assertEqual(os.listdir(storage.temporaryDirectory()), [])
+        self.assertEqual(list(storage.fshelper.walkOIDs()), [])
+        storage.close()
+
+        storage = ZODB.blob.BlobStorage(
+            'blobs2', ZODB.MappingStorage.MappingStorage(), fsync=False)
+        t, oids = self.store(storage, b'a')
+        storage.tpc_vote(t)
+        filename = storage.fshelper.getBlobFilename(oids[0], storage._tid)
+        self.assertTrue(os.path.exists(filename))
+        storage.tpc_abort(t)
+        self.assertEqual(os.listdir(storage.temporaryDirectory()), [])
+        self.assertFalse(os.path.exists(filename))
+
+    def test_create_paths(self):
+        fshelper = ZODB.blob.FilesystemHelper('blobs')
+        fshelper.create()
+        paths = [fshelper.getPathForOID(oid) for oid in (1, 2, 1, 256)]
+        created = fshelper.createPaths(paths)
+        # 7 levels shared by oids 1 and 2, and their directories, and
+        # the 2 levels of oid 256 below the 6 it shares.
+        self.assertEqual(len(created), 7 + 2 + 2)
+        self.assertTrue(all(os.path.isdir(path) for path in paths))
+        self.assertEqual(fshelper.createPaths(paths), [])
+
+
+class PinnedBlobFileTests(ZODB.tests.util.TestCase):
+
+    def test_pinned_against_pack(self):
+        db = DB(FileStorage('data.fs', blob_dir='blobs', pack_keep_old=False))
+        with db.transaction() as conn:
+            conn.root.b = Blob(b'0123456789')
+        conn = db.open()
+        blob = conn.root.b
+        pinned = blob.pin()
+        committed = blob.committed()
+        self.assertEqual(pinned.size, 10)
+        self.assertEqual(pinned.read(), b'0123456789')
+        self.assertEqual(pinned.read(3, 4), b'3456')
+        self.assertEqual(pinned.read(8, 10), b'89')
+        self.assertEqual(pinned.read(20), b'')
+
+        with db.transaction() as conn2:
+            with conn2.root.b.open('w') as f:
+                f.write(b'new')
+        db.pack(new_time())
+        self.assertFalse(os.path.exists(committed))
+
+        self.assertEqual(pinned.read(3, 4), b'3456')
+        with open(pinned.name, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        os.lseek(pinned.fileno(), 8, 0)
+        self.assertEqual(os.read(pinned.fileno(), 2), b'89')
+        name = pinned.name
+        pinned.close()
+        self.assertTrue(pinned.closed)
+        self.assertFalse(os.path.exists(name))
+        self.assertRaises(ValueError, pinned.fileno)
+        conn.close()
+
+        with db.transaction() as conn:
+            with conn.root.b.pin() as pinned:
+                self.assertEqual(pinned.read(), b'new')
+            self.assertTrue(pinned.closed)
+            conn.root.b = Blob(b'uncommitted')
+            self.assertRaises(ZODB.interfaces.BlobError, conn.root.b.pin)
+        db.close()
+
+
 class BlobTestBase(ZODB.tests.StorageTestBase.StorageTestBase):
 
     def setUp(self):
@@ -800,6 +1331,10 @@ def test_suite():
     suite.addTest(unittest.makeSuite(ZODBBlobConfigTest))
     suite.addTest(unittest.makeSuite(BlobCloneTests))
     suite.addTest(unittest.makeSuite(BushyLayoutTests))
+    suite.addTest(unittest.makeSuite(BlobManifestTests))
+    suite.addTest(unittest.makeSuite(ContentLayoutTests))
+    suite.addTest(unittest.makeSuite(BlobCommitTests))
+    suite.addTest(unittest.makeSuite(PinnedBlobFileTests))
     suite.addTest(doctest.DocFileSuite(
         "blob_basic.txt",
         "blob_consume.txt",
@@ -830,6 +1365,13 @@ def test_suite():
         test_blob_storage_recovery=True,
         test_packing=True,
         ))
+    suite.addTest(storage_reusable_suite(
+        'BlobContentFileStorage',
+        lambda name, blob_dir:
+        FileStorage('%s.fs' % name, blob_dir=blob_dir, blob_layout='content'),
+        test_blob_storage_recovery=True,
+        test_packing=True,
+        ))
 
     return suite
 
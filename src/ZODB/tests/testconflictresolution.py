@@ -313,6 +313,62 @@ And load the pickle:
     """
 
 
+def conflict_resolution_caches_records():
+    """
+    Records that conflicts are resolved against are cached, so
+    repeated conflicts on an object don't load them again:
+
+    >>> db = ZODB.DB('t.fs') # FileStorage!
+    >>> storage = db.storage
+    >>> conn = db.open()
+    >>> conn.root.x = Resolveable()
+    >>> conn.root.x.v = 1
+    >>> transaction.commit()
+    >>> old = conn.root.x._p_serial
+    >>> conn.root.x.v = 2
+    >>> transaction.commit()
+    >>> committed = conn.root.x._p_serial
+    >>> conn.root.x.v = 1
+    >>> conn.root.x.w = 1
+    >>> transaction.commit()
+    >>> oid = conn.root.x._p_oid
+    >>> new = storage.loadSerial(oid, conn.root.x._p_serial)
+
+    >>> for i in range(3):
+    ...     p = storage.tryToResolveConflict(oid, committed, old, new)
+    >>> sorted(conn._reader.getState(p).items())
+    [('v', 2), ('w', 1)]
+
+    >>> stats = storage.conflictResolutionStatistics()
+    >>> stats['conflicts'], stats['resolved']
+    (3, 3)
+    >>> stats['cache_hits'], stats['cache_misses'], stats['cached']
+    (4, 2, 2)
+    >>> stats['resolve_time'] > 0
+    True
+
+    Unresolved conflicts are counted too:
+
+    >>> storage.tryToResolveConflict(oid, committed, old,
+    ...                              storage.loadSerial(oid, committed))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error (oid 0x01, ...
+
+    >>> stats = storage.conflictResolutionStatistics()
+    >>> stats['conflicts'], stats['resolved'], stats['cache_hits']
+    (4, 3, 6)
+
+    The cache is cleared when the storage is packed:
+
+    >>> db.pack()
+    >>> storage.conflictResolutionStatistics()['cached']
+    0
+
+    >>> db.close()
+    """
+
 class FailHard(persistent.Persistent):
 
     def _p_resolveConflict(self, old, committed, new):
@@ -13,9 +13,11 @@
 ##############################################################################
 import doctest
 import random
+import struct
 import unittest
 
-from ZODB.fsIndex import fsIndex
+from ZODB.fsIndex import fsArrayIndex, fsIndex
+from ZODB.fsIndex import ARRAY_INDEX_HEADER, ARRAY_INDEX_MAGIC
 from ZODB.utils import p64, z64
 from ZODB.tests.util import setUp, tearDown
 import six
@@ -194,6 +196,78 @@ class Test(unittest.TestCase):
         self.assertEqual(index.minKey(b), c)
         self.assertRaises(ValueError, index.minKey, d)
 
+class ArrayIndexTests(Test):
+
+    def setUp(self):
+        setUp(self)
+        self.index = fsArrayIndex()
+        # Merge often, so that data end up in the arrays.
+        self.index.merge_size = 50
+
+        for i in range(200):
+            self.index[p64(i * 1000)] = (i * 1000 + 1)
+
+    tearDown = tearDown
+
+    def test__del__(self):
+        index = self.index
+        del index[p64(1000)]
+        self.assertRaises(KeyError, index.__delitem__, p64(1000))
+        self.assertTrue(p64(1000) not in index)
+        self.assertEqual(len(index), 199)
+        index._merge()
+        self.assertTrue(p64(1000) not in index)
+        self.assertEqual(len(index), 199)
+        self.assertEqual(index.minKey(p64(1)), p64(2000))
+        self.assertEqual(index.maxKey(p64(1999)), z64)
+
+        for key in list(self.index):
+            del index[key]
+        self.assertTrue(not index)
+        self.assertRaises(ValueError, index.minKey)
+
+    def test_overlay_and_arrays(self):
+        index = self.index
+        self.assertTrue(len(index._arrays[1]) > 0)
+        self.assertTrue(len(index._overlay) > 0)
+
+        # Updates of keys in the arrays are seen.
+        index[p64(0)] = 42
+        self.assertEqual(index[p64(0)], 42)
+        self.assertEqual(len(index), 200)
+        self.assertEqual(index.items()[0], (p64(0), 42))
+        self.assertEqual(len(index.items()), 200)
+
+    def test_save_and_load(self):
+        index = self.index
+        index[p64(1 << 40)] = 1 << 47
+        index.save(42, 'index')
+        info = fsArrayIndex.load('index')
+        self.assertEqual(info['pos'], 42)
+        loaded = info['index']
+        self.assertEqual(loaded.items(), index.items())
+        self.assertEqual(len(loaded), 201)
+        self.assertEqual(loaded[p64(1 << 40)], 1 << 47)
+
+        # The loaded index can be changed.
+        loaded[p64(1)] = 2
+        self.assertEqual(loaded[p64(1)], 2)
+        self.assertEqual(loaded.minKey(p64(1)), p64(1))
+
+        # Indexes saved by fsIndex are converted.
+        fsIndex(dict(index.items())).save(43, 'old')
+        info = fsArrayIndex.load('old')
+        self.assertEqual(info['pos'], 43)
+        self.assertTrue(isinstance(info['index'], fsArrayIndex))
+        self.assertEqual(info['index'].items(), index.items())
+
+    def test_load_rejects_unknown_versions(self):
+        with open('index', 'wb') as f:
+            f.write(struct.pack(ARRAY_INDEX_HEADER, ARRAY_INDEX_MAGIC,
+                                99, 0, 0))
+        self.assertRaises(ValueError, fsArrayIndex.load, 'index')
+
+
 def fsIndex_save_and_load():
     """
 fsIndex objects now have save methods for saving them to disk in a new
@@ -235,5 +309,6 @@ If we save the data in the old format, we can still read it:
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Test))
+    suite.addTest(unittest.makeSuite(ArrayIndexTests))
     suite.addTest(doctest.DocTestSuite(setUp=setUp, tearDown=tearDown))
     return suite
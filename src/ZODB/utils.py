@@ -34,6 +34,7 @@ __all__ = ['z64',
            'u64',
            'U64',
            'cp',
+           'fastcp',
            'maxtid',
            'newTid',
            'oid_repr',
@@ -123,6 +124,84 @@ def cp(f1, f2, length=None):
         write(data)
         length -= len(data)
 
+# The Linux ioctl cloning a file, sharing its extents, on file systems
+# supporting reflinks.
+FICLONE = 0x40049409
+
+def _clone(fd1, fd2):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(fd2, FICLONE, fd1)
+    except (IOError, OSError):
+        return False
+    return True
+
+def _kernel_copy(fd1, pos1, fd2, pos2, length):
+    # Copy data between file descriptors without reading it into
+    # Python, returning the number of bytes copied, which is less
+    # than length if the operating system can't copy the rest.
+    if (pos1 == pos2 == 0 and os.fstat(fd2).st_size == 0 and
+        os.fstat(fd1).st_size == length and _clone(fd1, fd2)):
+        return length
+
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        while copied < length:
+            try:
+                n = copy_file_range(fd1, fd2, length - copied,
+                                    pos1 + copied, pos2 + copied)
+            except OSError:
+                break
+            if not n:
+                break
+            copied += n
+
+    sendfile = getattr(os, 'sendfile', None)
+    if (copied < length and sendfile is not None and
+        sys.platform.startswith('linux')):
+        # sendfile writes at the output's position.
+        os.lseek(fd2, pos2 + copied, os.SEEK_SET)
+        while copied < length:
+            try:
+                n = sendfile(fd2, fd1, pos1 + copied, length - copied)
+            except OSError:
+                break
+            if not n:
+                break
+            copied += n
+
+    return copied
+
+def fastcp(f1, f2, length=None):
+    """Copy data from one file to another, like cp.
+
+    If both files are operating-system files, the operating system is
+    asked to copy the data, by cloning the file on file systems
+    supporting reflinks, or with ``copy_file_range`` or ``sendfile``,
+    so the data isn't read into Python.  Otherwise, or for data the
+    operating system doesn't copy, cp is used.
+    """
+    try:
+        fd1 = f1.fileno()
+        fd2 = f2.fileno()
+        f2.flush()
+        pos1 = f1.tell()
+        pos2 = f2.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        # Not operating-system files, or not seekable.
+        return cp(f1, f2, length)
+
+    if length is None:
+        length = max(os.fstat(fd1).st_size - pos1, 0)
+    copied = _kernel_copy(fd1, pos1, fd2, pos2, length)
+    f1.seek(pos1 + copied)
+    f2.seek(pos2 + copied)
+    if copied < length:
+        cp(f1, f2, length - copied)
+
 def newTid(old):
     t = time.time()
     ts = TimeStamp(*time.gmtime(t)[:5]+(t%60,))